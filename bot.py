@@ -1,12 +1,19 @@
 __version__ = "3.4.1"
 
 
+import time
+
+# The import time is the first startup phase
+_import_started = time.perf_counter()
+
+# pylint: disable=wrong-import-position
 import asyncio
 import logging
 import os
 import re
 import sys
 import typing
+from contextlib import nullcontext
 from datetime import datetime
 from types import SimpleNamespace
 
@@ -17,8 +24,6 @@ from discord.ext.commands.view import StringView
 import isodate
 
 from aiohttp import ClientSession
-from emoji import UNICODE_EMOJI
-from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ConfigurationError
 
 from pkg_resources import parse_version
@@ -32,16 +37,42 @@ except ImportError:
     pass
 
 from core import checks
-from core.clients import ApiClient, PluginDatabaseClient
+from core.clients import ApiClient, PluginDatabaseClient, create_session
 from core.config import ConfigManager
 from core.utils import human_join, normalize_alias
-from core.models import PermissionLevel, SafeFormatter, getLogger, configure_logging
+from core.models import (
+    PermissionLevel,
+    SafeFormatter,
+    configure_logging,
+    getLogger,
+    stop_logging,
+)
+from core.search import LogSearchIndex
+from core.startup import StartupProfiler
+from core.archive import ArchiveStore
+from core.httpcache import HTTPCache
+from core.dbprofiler import QueryProfiler
+from core.perf import LatencyProfiler, TimedCoroutine
+from core.journal import WriteJournal
+from core.lifecycle import Lifecycle
+from core.loopmonitor import LoopMonitor
+from core.metrics import BotMetrics, MetricsServer, register_collectors
+from core.summary import backfill as backfill_summaries
+from core.storage import StorageBackend
 from core.thread import ThreadManager
+from core.tracing import Tracer, set_status, span
 from core.time import human_timedelta
 
+# pylint: enable=wrong-import-position
+
 
 logger = getLogger(__name__)
 
+IMPORT_TIME = time.perf_counter() - _import_started
+
+# The number of overdue threads closed at once after a restart.
+RECOVERY_CONCURRENCY = 10
+
 temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
 if not os.path.exists(temp_dir):
     os.mkdir(temp_dir)
@@ -52,27 +83,39 @@ class ModmailBot(commands.Bot):
         super().__init__(command_prefix=None)  # implemented in `get_prefix`
         self._session = None
         self._api = None
+        self.http_cache = HTTPCache(os.path.join(temp_dir, "http"))
+        self._emoji_cache = {}
         self.metadata_loop = None
         self.formatter = SafeFormatter()
+        self.metrics = BotMetrics()
+        self._instrument_http()
+        self.latency_profiler = None
         self.loaded_cogs = ["cogs.modmail", "cogs.plugins", "cogs.utility"]
         self._connected = asyncio.Event()
+        self._database_retry = None
         self.start_time = datetime.utcnow()
 
-        self.config = ConfigManager(self)
-        self.config.populate_cache()
+        self.startup_profile = StartupProfiler(
+            os.path.join(temp_dir, "startup.jsonl"), _import_started
+        )
+        self.startup_profile.add("imports", IMPORT_TIME)
+        self.lifecycle = Lifecycle(self.startup_profile)
+
+        with self.startup_profile.phase("config"):
+            self.config = ConfigManager(self)
+            self.config.populate_cache()
 
         self.threads = ThreadManager(self)
 
         self.log_file_name = os.path.join(temp_dir, f"{self.token.split('.')[0]}.log")
         self._configure_logging()
 
-        mongo_uri = self.config["mongo_uri"]
-        if mongo_uri is None:
-            logger.critical("A Mongo URI is necessary for the bot to function.")
-            raise RuntimeError
-
         try:
-            self.db = AsyncIOMotorClient(mongo_uri).modmail_bot
+            with self.startup_profile.phase("database"):
+                self.storage = StorageBackend.from_config(self.config, temp_dir)
+        except ValueError as e:
+            logger.critical(e)
+            raise RuntimeError
         except ConfigurationError as e:
             logger.critical(
                 "Your MONGO_URI might be copied wrong, try re-copying from the source again. "
@@ -80,10 +123,63 @@ class ModmailBot(commands.Bot):
             )
             logger.critical(e)
             sys.exit(0)
+        self.query_profiler = None
+        if self.config.get_bool("query_profiler", True):
+            self.query_profiler = QueryProfiler()
+            self.storage.profile(self.query_profiler)
+        self.db = self.storage.db
+        logger.info("Database: %s", self.storage.name)
+
+        if self.config.get_bool("latency_profiler", True):
+            self.latency_profiler = LatencyProfiler()
+            self._instrument_commands()
+
+        try:
+            self.tracer = Tracer(
+                sample_rate=float(self.config.get("relay_trace_rate", 0.1)),
+                slow_threshold=float(self.config.get("relay_trace_slow", 5)),
+            )
+        except ValueError:
+            logger.warning("Invalid RELAY_TRACE_RATE or RELAY_TRACE_SLOW, using the defaults.")
+            self.tracer = Tracer()
+
+        self.loop_monitor = None
+        if self.config.get_bool("loop_monitor", True):
+            try:
+                threshold = float(self.config.get("loop_block_threshold") or 500) / 1000
+            except ValueError:
+                logger.warning("Invalid LOOP_BLOCK_THRESHOLD, using 500ms.")
+                threshold = 0.5
+            self.loop_monitor = LoopMonitor(self.loop, threshold=threshold)
+
+        self.journal = None
+        if self.config.get_bool("write_journal", True):
+            self.journal = WriteJournal(os.path.join(temp_dir, "journal"), self.storage.relay_db)
+            self.journal.start(self.loop)
+
+        self.search_index = None
+        if self.config.get_bool("local_search"):
+            self.search_index = LogSearchIndex(os.path.join(temp_dir, "search"))
+            self.search_index.start(self.loop)
+            logger.info("Local search index: %d logs.", len(self.search_index))
+
+        self.archive = ArchiveStore.from_config(self.config, self.db, temp_dir)
+        self.archive_loop = None
+        self._summary_backfill = None
+        self._recovery = None
 
         self.plugin_db = PluginDatabaseClient(self)
         self.startup()
 
+        register_collectors(self)
+        self.metrics_server = None
+        if self.config.get("metrics_port"):
+            self.metrics_server = MetricsServer(
+                self,
+                self.config.get("metrics_host") or "127.0.0.1",
+                int(self.config["metrics_port"]),
+            )
+
     @property
     def uptime(self) -> str:
         now = datetime.utcnow()
@@ -107,13 +203,14 @@ class ModmailBot(commands.Bot):
         logger.info("Authors: kyb3r, fourjr, Taaku18")
         logger.line()
 
-        for cog in self.loaded_cogs:
-            logger.debug("Loading %s.", cog)
-            try:
-                self.load_extension(cog)
-                logger.debug("Successfully loaded %s.", cog)
-            except Exception:
-                logger.exception("Failed to load %s.", cog)
+        with self.startup_profile.phase("cogs"):
+            for cog in self.loaded_cogs:
+                logger.debug("Loading %s.", cog)
+                try:
+                    self.load_extension(cog)
+                    logger.debug("Successfully loaded %s.", cog)
+                except Exception:
+                    logger.exception("Failed to load %s.", cog)
         logger.line("debug")
 
     def _configure_logging(self):
@@ -146,7 +243,7 @@ class ModmailBot(commands.Bot):
     @property
     def session(self) -> ClientSession:
         if self._session is None:
-            self._session = ClientSession(loop=self.loop)
+            self._session = create_session(self.loop)
         return self._session
 
     @property
@@ -159,6 +256,13 @@ class ModmailBot(commands.Bot):
         return [self.prefix, f"<@{self.user.id}> ", f"<@!{self.user.id}> "]
 
     def run(self, *args, **kwargs):
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
+        if self.metrics_server is not None:
+            try:
+                self.loop.run_until_complete(self.metrics_server.start())
+            except OSError:
+                logger.error("Failed to start the metrics server.", exc_info=True)
         try:
             self.loop.run_until_complete(self.start(self.token))
         except KeyboardInterrupt:
@@ -169,6 +273,8 @@ class ModmailBot(commands.Bot):
             logger.critical("Fatal exception", exc_info=True)
         finally:
             self.loop.run_until_complete(self.logout())
+            if self.journal is not None:
+                self.loop.run_until_complete(self.journal.drain(timeout=10))
             for task in asyncio.all_tasks(self.loop):
                 task.cancel()
             try:
@@ -176,8 +282,23 @@ class ModmailBot(commands.Bot):
             except asyncio.CancelledError:
                 logger.debug("All pending tasks has been cancelled.")
             finally:
+                if self.loop_monitor is not None:
+                    self.loop_monitor.stop()
+                if self.metrics_server is not None:
+                    self.loop.run_until_complete(self.metrics_server.stop())
+                if self.latency_profiler is not None:
+                    try:
+                        self.latency_profiler.dump(os.path.join(temp_dir, "perf.json"))
+                    except OSError:
+                        logger.warning("Failed to dump the latency statistics.", exc_info=True)
+                if self.search_index is not None:
+                    self.search_index.close()
+                if self.journal is not None:
+                    self.journal.close()
+                self.storage.close()
                 self.loop.run_until_complete(self.session.close())
                 logger.error(" - Shutting down bot - ")
+                stop_logging()
 
     @property
     def owner_ids(self):
@@ -225,6 +346,79 @@ class ModmailBot(commands.Bot):
         )
         return None
 
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        if self.latency_profiler is not None:
+            coro = self.latency_profiler.wrap_listener(coro, event_name)
+        return super()._schedule_event(coro, event_name, *args, **kwargs)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        # Checks and converters run until the before invoke hooks, see `_instrument_commands`
+        ctx.prepared_at = None
+        started = time.perf_counter()
+        timed = TimedCoroutine(super().invoke(ctx))
+        await timed
+        elapsed = time.perf_counter() - started
+
+        name = ctx.command.qualified_name
+        self.metrics.commands.labels(name, "failed" if ctx.command_failed else "ok").inc()
+        self.metrics.command_seconds.labels(name).observe(elapsed)
+        if self.latency_profiler is None:
+            return
+
+        wall = elapsed * 1000
+        cog = ctx.cog.qualified_name if ctx.cog is not None else "-"
+        self.latency_profiler.record(
+            "command", cog, name, wall, timed.busy, timed.cpu, ctx.command_failed
+        )
+        if ctx.prepared_at is not None:
+            self.latency_profiler.record("checks", cog, name, (ctx.prepared_at - started) * 1000)
+
+    @staticmethod
+    def _instrument_commands():
+        """
+        Records in `ctx.prepared_at` when the checks and converters of a
+        command are done.
+
+        `Command.call_before_hooks` is wrapped rather than registering a
+        global before invoke hook, which a plugin could replace.
+        """
+        call_before_hooks = commands.Command.call_before_hooks
+        if getattr(call_before_hooks, "instrumented", False):
+            return
+
+        async def timed_call_before_hooks(command, ctx):
+            ctx.prepared_at = time.perf_counter()
+            await call_before_hooks(command, ctx)
+
+        timed_call_before_hooks.instrumented = True
+        commands.Command.call_before_hooks = timed_call_before_hooks
+
+    def _instrument_http(self):
+        """Records the Discord REST calls in the metrics."""
+        request = self.http.request
+        metrics = self.metrics
+
+        async def timed_request(route, **kwargs):
+            started = time.perf_counter()
+            status = "error"
+            try:
+                result = await request(route, **kwargs)
+                status = "ok"
+                return result
+            except discord.HTTPException as exc:
+                status = str(exc.status)
+                raise
+            finally:
+                metrics.http_requests.labels("discord", route.path, route.method, status).inc()
+                metrics.http_seconds.labels("discord", route.method).observe(
+                    time.perf_counter() - started
+                )
+
+        self.http.request = timed_request
+
     async def wait_for_connected(self) -> None:
         await self.wait_until_ready()
         await self._connected.wait()
@@ -369,17 +563,54 @@ class ModmailBot(commands.Bot):
         return level
 
     async def on_connect(self):
+        self.lifecycle.connected()
         try:
-            await self.validate_database_connection()
+            await self.lifecycle.run("database", self.validate_database_connection)
         except Exception:
-            logger.debug("Logging out due to failed database connection.")
-            return await self.logout()
+            if self.journal is None:
+                logger.debug("Logging out due to failed database connection.")
+                return await self.logout()
+            # Writes are journaled until the database is back, start with the local
+            # config. It is not saved until the stored one is loaded.
+            logger.warning("Starting without the database, writes will be journaled.")
+            self.config.ready_event.set()
+            self._connected.set()
+            if self._database_retry is None or self._database_retry.done():
+                self._database_retry = self.loop.create_task(self._retry_database())
+            return
 
         logger.debug("Connected to gateway.")
-        await self.config.refresh()
-        await self.setup_indexes()
+        # Only the first connection, or the first one with a database, initializes
+        await self.lifecycle.run("config.refresh", self.config.refresh)
+        await self.lifecycle.run("setup_indexes", self.setup_indexes)
         self._connected.set()
 
+    async def _retry_database(self):
+        """Waits for the database to be back, then loads the stored config."""
+        delay = 5
+        while not self.is_closed():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 300)
+            try:
+                await self.storage.validate()
+                await self.config.refresh()
+            except Exception as e:
+                logger.debug("The database is still unavailable: %s", e)
+                continue
+            logger.info("The database is back, the stored config is loaded.")
+            try:
+                await self.setup_indexes()
+            except Exception:
+                logger.error("Failed to set up the indexes.", exc_info=True)
+            return
+
+    async def on_disconnect(self):
+        self.lifecycle.disconnected()
+
+    async def on_resumed(self):
+        # The session is unchanged, the caches are still valid
+        self.lifecycle.resumed()
+
     async def setup_indexes(self):
         """Setup text indexes so we can use the $search operator"""
         coll = self.db.logs
@@ -393,7 +624,13 @@ class ModmailBot(commands.Bot):
             logger.info("Dropping old index: %s", old_index)
             await coll.drop_index(old_index)
 
-        if index_name not in index_info:
+        if self.search_index is not None:
+            if index_name in index_info:
+                logger.info(
+                    'The local search index is enabled, the "text" index %s can be dropped.',
+                    index_name,
+                )
+        elif index_name not in index_info:
             logger.info('Creating "text" index for logs collection.')
             logger.info("Name: %s", index_name)
             await coll.create_index(
@@ -411,81 +648,41 @@ class ModmailBot(commands.Bot):
             logger.error("Logging out due to invalid GUILD_ID.")
             return await self.logout()
 
-        logger.line()
-        logger.debug("Client ready.")
-        logger.info("Logged in as: %s", self.user)
-        logger.info("Bot ID: %s", self.user.id)
-        owners = ", ".join(
-            getattr(self.get_user(owner_id), "name", str(owner_id)) for owner_id in self.owner_ids
-        )
-        logger.info("Owners: %s", owners)
-        logger.info("Prefix: %s", self.prefix)
-        logger.info("Guild Name: %s", self.guild.name)
-        logger.info("Guild ID: %s", self.guild.id)
-        if self.using_multiple_server_setup:
-            logger.info("Receiving guild ID: %s", self.modmail_guild.id)
-        logger.line()
-
-        await self.threads.populate_cache()
-
-        # closures
-        closures = self.config["closures"]
-        logger.info("There are %d thread(s) pending to be closed.", len(closures))
-        logger.line()
-
-        for recipient_id, items in tuple(closures.items()):
-            after = (datetime.fromisoformat(items["time"]) - datetime.utcnow()).total_seconds()
-            if after <= 0:
-                logger.debug("Closing thread for recipient %s.", recipient_id)
-                after = 0
-            else:
-                logger.debug(
-                    "Thread for recipient %s will be closed after %s seconds.", recipient_id, after
-                )
+        if self.lifecycle.ready() == Lifecycle.REIDENTIFY:
+            # A new session rebuilt the guild cache, threads may point to stale
+            # channels and channels may have been deleted meanwhile.
+            logger.info("New gateway session, re-syncing threads.")
+            self.lifecycle.invalidate("threads.populate_cache", "orphaned_logs")
+            self.threads.resync()
+        else:
+            logger.line()
+            logger.debug("Client ready.")
+            logger.info("Logged in as: %s", self.user)
+            logger.info("Bot ID: %s", self.user.id)
+            owners = ", ".join(
+                getattr(self.get_user(owner_id), "name", str(owner_id))
+                for owner_id in self.owner_ids
+            )
+            logger.info("Owners: %s", owners)
+            logger.info("Prefix: %s", self.prefix)
+            logger.info("Guild Name: %s", self.guild.name)
+            logger.info("Guild ID: %s", self.guild.id)
+            if self.using_multiple_server_setup:
+                logger.info("Receiving guild ID: %s", self.modmail_guild.id)
+            logger.line()
 
-            thread = await self.threads.find(recipient_id=int(recipient_id))
+        await self.lifecycle.run("threads.populate_cache", self.threads.populate_cache)
 
-            if not thread:
-                # If the channel is deleted
-                logger.debug("Failed to close thread for recipient %s.", recipient_id)
-                self.config["closures"].pop(recipient_id)
-                await self.config.update()
-                continue
+        # Pending closures and orphaned logs are recovered in the background
+        if self._recovery is None or self._recovery.done():
+            self._recovery = self.loop.create_task(self.recover_threads())
 
-            await thread.close(
-                closer=self.get_user(items["closer_id"]),
-                after=after,
-                silent=items["silent"],
-                delete_channel=items["delete_channel"],
-                message=items["message"],
-                auto_close=items.get("auto_close", False),
-            )
+        await self.lifecycle.run("loops", self.start_loops)
 
-        for log in await self.api.get_open_logs():
-            if self.get_channel(int(log["channel_id"])) is None:
-                logger.debug("Unable to resolve thread with channel %s.", log["channel_id"])
-                log_data = await self.api.post_log(
-                    log["channel_id"],
-                    {
-                        "open": False,
-                        "closed_at": str(datetime.utcnow()),
-                        "close_message": "Channel has been deleted, no closer found.",
-                        "closer": {
-                            "id": str(self.user.id),
-                            "name": self.user.name,
-                            "discriminator": self.user.discriminator,
-                            "avatar_url": str(self.user.avatar_url),
-                            "mod": True,
-                        },
-                    },
-                )
-                if log_data:
-                    logger.debug("Successfully closed thread with channel %s.", log["channel_id"])
-                else:
-                    logger.debug(
-                        "Failed to close thread with channel %s, skipping.", log["channel_id"]
-                    )
+        if not self.startup_profile.reported:
+            self.loop.create_task(self.report_startup())
 
+    async def start_loops(self) -> None:
         self.metadata_loop = tasks.Loop(
             self.post_metadata,
             seconds=0,
@@ -498,17 +695,190 @@ class ModmailBot(commands.Bot):
         self.metadata_loop.before_loop(self.before_post_metadata)
         self.metadata_loop.start()
 
+        if self.archive is not None:
+            self.archive_loop = tasks.Loop(
+                self.archive_logs,
+                seconds=0,
+                minutes=0,
+                hours=6,
+                count=None,
+                reconnect=True,
+                loop=None,
+            )
+            self.archive_loop.start()
+
+    async def report_startup(self) -> None:
+        """Reports the startup profile once the plugins are loaded."""
+        if not await self.startup_profile.wait("plugins", timeout=120):
+            logger.debug("Plugins are still loading, reporting the startup profile without them.")
+        self.startup_profile.report(__version__)
+
+    async def recover_threads(self) -> None:
+        """
+        Restores the pending closures (once per process) and closes the logs
+        of deleted channels (once per session).
+
+        Runs in the background after READY, messages are relayed meanwhile.
+        Logs closed here are summarized by the summary backfill started
+        afterwards.
+        """
+        try:
+            await self.lifecycle.run("closures", self.restore_closures)
+        except Exception:
+            logger.error("Failed to restore thread closures.", exc_info=True)
+        try:
+            await self.lifecycle.run("orphaned_logs", self.close_orphaned_logs)
+        except Exception:
+            logger.error("Failed to close the logs of deleted channels.", exc_info=True)
+
+        if self._summary_backfill is None:
+            self._summary_backfill = self.loop.create_task(self.backfill_summaries())
+
+    async def restore_closures(self) -> None:
+        """
+        Reschedules the pending closures, overdue threads are closed with
+        bounded concurrency.
+        """
+        closures = self.config["closures"]
+        logger.info("There are %d thread(s) pending to be closed.", len(closures))
+
+        now = datetime.utcnow()
+        overdue = []
+        missing = []
+        for recipient_id, items in tuple(closures.items()):
+            thread = await self.threads.find(recipient_id=int(recipient_id))
+            if not thread:
+                # If the channel is deleted
+                logger.debug("Failed to close thread for recipient %s.", recipient_id)
+                missing.append(recipient_id)
+                continue
+
+            after = (datetime.fromisoformat(items["time"]) - now).total_seconds()
+            if after > 0:
+                logger.debug(
+                    "Thread for recipient %s will be closed after %s seconds.", recipient_id, after
+                )
+                thread.schedule_close(
+                    after,
+                    self.get_user(items["closer_id"]),
+                    items["silent"],
+                    items["delete_channel"],
+                    items["message"],
+                    items.get("auto_close", False),
+                )
+            else:
+                overdue.append((thread, items))
+
+        if missing:
+            for recipient_id in missing:
+                closures.pop(recipient_id, None)
+            await self.config.update()
+        logger.info(
+            "Rescheduled %d closures, closing %d overdue threads.",
+            len(closures) - len(overdue),
+            len(overdue),
+        )
+        if not overdue:
+            return
+
+        semaphore = asyncio.Semaphore(RECOVERY_CONCURRENCY)
+        closed = 0
+        last_progress = time.monotonic()
+
+        async def close(thread, items):
+            nonlocal closed, last_progress
+            async with semaphore:
+                logger.debug("Closing thread for recipient %s.", thread.id)
+                try:
+                    await thread.close(
+                        closer=self.get_user(items["closer_id"]),
+                        after=0,
+                        silent=items["silent"],
+                        delete_channel=items["delete_channel"],
+                        message=items["message"],
+                        auto_close=items.get("auto_close", False),
+                    )
+                except Exception:
+                    logger.error("Failed to close thread %s.", thread.id, exc_info=True)
+            closed += 1
+            if time.monotonic() - last_progress > 5:
+                last_progress = time.monotonic()
+                logger.info("Closed %d/%d overdue threads.", closed, len(overdue))
+
+        await asyncio.gather(*(close(thread, items) for thread, items in overdue))
+        logger.info("Closed %d overdue threads.", closed)
+
+    async def close_orphaned_logs(self) -> None:
+        """Closes the open logs whose channel was deleted, with a single update."""
+        orphaned = [
+            log["channel_id"]
+            for log in await self.api.get_open_logs()
+            if self.get_channel(int(log["channel_id"])) is None
+        ]
+        if not orphaned:
+            return
+        await self.api.close_logs(
+            orphaned,
+            {
+                "closed_at": str(datetime.utcnow()),
+                "close_message": "Channel has been deleted, no closer found.",
+                "closer": {
+                    "id": str(self.user.id),
+                    "name": self.user.name,
+                    "discriminator": self.user.discriminator,
+                    "avatar_url": str(self.user.avatar_url),
+                    "mod": True,
+                },
+            },
+        )
+        logger.info("Closed %d logs of deleted channels.", len(orphaned))
+
+    async def backfill_summaries(self) -> None:
+        """Computes the summaries of the logs closed before they were stored."""
+        try:
+            count = await backfill_summaries(self.db.logs, self.archive)
+        except Exception:
+            logger.error("Failed to backfill log summaries.", exc_info=True)
+            return
+        if count:
+            logger.info("Backfilled the summaries of %d logs.", count)
+
+    async def archive_logs(self) -> typing.Tuple[int, int]:
+        """Moves old closed logs to the archive and applies the purge rules."""
+        try:
+            archived = await self.archive.archive_all()
+            purged = await self.archive.purge()
+        except Exception:
+            logger.error("Failed to archive logs.", exc_info=True)
+            return 0, 0
+        if purged and self.search_index is not None:
+            self.search_index.remove(purged)
+        return archived, len(purged)
+
     async def convert_emoji(self, name: str) -> str:
+        # Conversions are cached, the emoji table is large and only loaded
+        # when a new emoji is configured.
+        converted = self._emoji_cache.get(name)
+        if converted is not None:
+            return converted
+
+        from emoji import UNICODE_EMOJI
+
         ctx = SimpleNamespace(bot=self, guild=self.modmail_guild)
         converter = commands.EmojiConverter()
 
+        converted = name
         if name not in UNICODE_EMOJI:
             try:
-                name = await converter.convert(ctx, name.strip(":"))
+                converted = await converter.convert(ctx, name.strip(":"))
             except commands.BadArgument as e:
-                logger.warning("%s is not a valid emoji. %s.", e)
+                logger.warning("%s is not a valid emoji. %s.", name, e)
                 raise
-        return name
+        self._emoji_cache[name] = converted
+        return converted
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        self._emoji_cache.clear()
 
     async def retrieve_emoji(self) -> typing.Tuple[str, str]:
 
@@ -708,15 +1078,23 @@ class ModmailBot(commands.Bot):
 
     async def process_dm_modmail(self, message: discord.Message) -> None:
         """Processes messages sent to the bot."""
-        blocked = await self._process_blocked(message)
+        started = time.perf_counter()
+        with span("process_blocked"):
+            blocked = await self._process_blocked(message)
         if blocked:
+            set_status("blocked")
+            self.metrics.relayed.labels("to_thread", "blocked").inc()
             return
-        sent_emoji, blocked_emoji = await self.retrieve_emoji()
+        with span("retrieve_emoji"):
+            sent_emoji, blocked_emoji = await self.retrieve_emoji()
 
-        thread = await self.threads.find(recipient=message.author)
+        with span("threads.find"):
+            thread = await self.threads.find(recipient=message.author)
         if thread is None:
-            delta = await self.get_thread_cooldown(message.author)
+            with span("get_thread_cooldown"):
+                delta = await self.get_thread_cooldown(message.author)
             if delta:
+                set_status("cooldown")
                 await message.channel.send(
                     embed=discord.Embed(
                         title="Message not sent!",
@@ -738,10 +1116,12 @@ class ModmailBot(commands.Bot):
                 logger.info(
                     "A new thread was blocked from %s due to disabled Modmail.", message.author
                 )
+                set_status("disabled")
                 await self.add_reaction(message, blocked_emoji)
                 return await message.channel.send(embed=embed)
 
-            thread = await self.threads.create(message.author)
+            with span("threads.create"):
+                thread = self.threads.create(message.author)
         else:
             if self.config["dm_disabled"] == 2:
                 embed = discord.Embed(
@@ -756,16 +1136,24 @@ class ModmailBot(commands.Bot):
                 logger.info(
                     "A message was blocked from %s due to disabled Modmail.", message.author
                 )
+                set_status("disabled")
                 await self.add_reaction(message, blocked_emoji)
                 return await message.channel.send(embed=embed)
 
         try:
-            await thread.send(message)
+            with span("thread.send"):
+                await thread.send(message)
         except Exception:
             logger.error("Failed to send message:", exc_info=True)
-            await self.add_reaction(message, blocked_emoji)
+            set_status("failed")
+            self.metrics.relayed.labels("to_thread", "failed").inc()
+            with span("add_reaction"):
+                await self.add_reaction(message, blocked_emoji)
         else:
-            await self.add_reaction(message, sent_emoji)
+            self.metrics.relayed.labels("to_thread", "sent").inc()
+            self.metrics.relay_seconds.labels("to_thread").observe(time.perf_counter() - started)
+            with span("add_reaction"):
+                await self.add_reaction(message, sent_emoji)
 
     async def get_contexts(self, message, *, cls=commands.Context):
         """
@@ -862,10 +1250,23 @@ class ModmailBot(commands.Bot):
         await self.config.update()
 
     async def on_message(self, message):
-        await self.wait_for_connected()
-        if message.type == discord.MessageType.pins_add and message.author == self.user:
-            await message.delete()
-        await self.process_commands(message)
+        relay = isinstance(message.channel, discord.DMChannel) and not message.author.bot
+        trace = (
+            self.tracer.trace(
+                "to_thread",
+                user=message.author.id,
+                message=message.id,
+                received_after=(datetime.utcnow() - message.created_at).total_seconds(),
+            )
+            if relay
+            else nullcontext()
+        )
+        with trace:
+            with span("wait_for_connected"):
+                await self.wait_for_connected()
+            if message.type == discord.MessageType.pins_add and message.author == self.user:
+                await message.delete()
+            await self.process_commands(message)
 
     async def process_commands(self, message):
         if message.author.bot:
@@ -1166,7 +1567,7 @@ class ModmailBot(commands.Bot):
 
     async def validate_database_connection(self):
         try:
-            await self.db.command("buildinfo")
+            await self.storage.validate()
         except Exception as exc:
             logger.critical("Something went wrong while connecting to the database.")
             message = f"{type(exc).__name__}: {str(exc)}"
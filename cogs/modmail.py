@@ -1,4 +1,5 @@
 import asyncio
+import io
 import os
 from datetime import datetime
 from typing import Optional, Union
@@ -11,12 +12,19 @@ from dateutil import parser
 from natural.date import duration
 
 from core import checks
+from core.analytics import LogFrame, TeamReport, build_query, format_duration
 from core.decorators import trigger_typing
+from core.export import LogExporter, build_query as build_export_query
+from core.importer import LogImporter
 from core.models import PermissionLevel
 from core.paginator import PaginatorSession
+from core.search import SearchQuery
 from core.time import UserFriendlyTime, human_timedelta
 from core.utils import format_preview, User
 
+EXPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "temp", "exports")
+MAX_ATTACHMENT_SIZE = 8 * 1024 * 1024
+
 
 class Modmail(commands.Cog):
     """Liste des commandes."""
@@ -589,15 +597,7 @@ class Modmail(commands.Cog):
         """
         user = user if user is not None else ctx.author
 
-        query = {
-            "guild_id": str(self.bot.guild_id),
-            "open": False,
-            "closer.id": str(user.id),
-        }
-
-        projection = {"messages": {"$slice": 5}}
-
-        entries = await self.bot.db.logs.find(query, projection).to_list(None)
+        entries = await self.bot.api.get_closed_by_logs(user.id)
 
         embeds = self.format_log_embeds(entries, avatar_url=self.bot.guild.icon_url)
 
@@ -618,19 +618,19 @@ class Modmail(commands.Cog):
         Retrieve all logs that contain messages with your query.
 
         Provide a `limit` to specify the maximum number of logs the bot should find.
+
+        When the local search index is enabled, words ending with `*` match
+        any word starting with them, and the results can be filtered with
+        `after:YYYY-MM-DD`, `before:YYYY-MM-DD`, `closer:<user ID>`
+        and `recipient:<user ID>`.
         """
 
         await ctx.trigger_typing()
 
-        query = {
-            "guild_id": str(self.bot.guild_id),
-            "open": False,
-            "$text": {"$search": f'"{query}"'},
-        }
-
-        projection = {"messages": {"$slice": 5}}
-
-        entries = await self.bot.db.logs.find(query, projection).to_list(limit)
+        try:
+            entries = await self.bot.api.search_logs(query, limit)
+        except ValueError as exc:
+            raise commands.BadArgument(str(exc))
 
         embeds = self.format_log_embeds(entries, avatar_url=self.bot.guild.icon_url)
 
@@ -644,6 +644,242 @@ class Modmail(commands.Cog):
         session = PaginatorSession(ctx, *embeds)
         await session.run()
 
+    @logs.command(name="reindex")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def logs_reindex(self, ctx):
+        """
+        Rebuild the local search index from the database.
+
+        Only available when the local search index is enabled.
+        """
+        if self.bot.search_index is None:
+            embed = discord.Embed(
+                color=discord.Color.red(),
+                description="The local search index is not enabled, "
+                "set `LOCAL_SEARCH` to enable it.",
+            )
+            return await ctx.send(embed=embed)
+
+        async with ctx.typing():
+            count = await self.bot.api.rebuild_search_index()
+
+        embed = discord.Embed(
+            color=self.bot.main_color,
+            description=f"Successfully indexed {count} logs.",
+        )
+        await ctx.send(embed=embed)
+
+    @logs.command(name="archive")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def logs_archive(self, ctx):
+        """
+        Archive old closed logs now.
+
+        Only available when `archive_after` is set, logs are
+        otherwise archived every 6 hours.
+        """
+        if self.bot.archive is None:
+            embed = discord.Embed(
+                color=discord.Color.red(),
+                description="Log archiving is not enabled, set `ARCHIVE_AFTER` to enable it.",
+            )
+            return await ctx.send(embed=embed)
+
+        async with ctx.typing():
+            archived, purged = await self.bot.archive_logs()
+
+        embed = discord.Embed(
+            color=self.bot.main_color,
+            description=f"Archived {archived} logs, purged {purged} logs.",
+        )
+        await ctx.send(embed=embed)
+
+    @logs.command(name="export")
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    async def logs_export(self, ctx, fmt: str.lower = "jsonl", *, filters: str = ""):
+        """
+        Export logs to a gzip JSONL or an HTML file.
+
+        `fmt` is `jsonl` or `html`. Logs can be filtered with
+        `recipient:<user>`, `closer:<user>`, `after:YYYY-MM-DD` and
+        `before:YYYY-MM-DD`, for example:
+        `{prefix}logs export html recipient:@user after:2019-06-01`
+
+        Small exports are uploaded, larger ones are saved on the bot's disk.
+        """
+        try:
+            query = SearchQuery(filters)
+            if not query.empty:
+                raise ValueError(
+                    "Only `recipient:`, `closer:`, `after:` and `before:` filters are allowed."
+                )
+            name = f"logs-{datetime.utcnow():%Y%m%d-%H%M%S}." + (
+                "jsonl.gz" if fmt == "jsonl" else fmt
+            )
+            exporter = LogExporter(os.path.join(EXPORT_DIR, name), fmt)
+        except ValueError as e:
+            raise commands.BadArgument(str(e))
+
+        query = build_export_query(
+            self.bot.guild_id, query.recipient_id, query.closer_id, query.after, query.before
+        )
+        total = await self.bot.api.read_logs.count_documents(query)
+        embed = discord.Embed(color=self.bot.main_color, description=f"Exporting {total} logs...")
+        status = await ctx.send(embed=embed)
+
+        async def progress(count):
+            await status.edit(
+                embed=discord.Embed(
+                    color=self.bot.main_color, description=f"Exported {count}/{total} logs..."
+                )
+            )
+
+        count = await exporter.export(
+            self.bot.api.read_logs, query, archive=self.bot.archive, progress=progress
+        )
+        size = os.path.getsize(exporter.path)
+        description = f"Exported {count} logs ({size / 1024:.1f} KiB)."
+        if exporter.stubs:
+            description += (
+                f"\n{exporter.stubs} archived logs could not be restored, "
+                "only their first messages are exported."
+            )
+
+        if size > MAX_ATTACHMENT_SIZE:
+            description += f"\nThe file is too large to upload, it was saved as `{exporter.path}`."
+        await status.edit(embed=discord.Embed(color=self.bot.main_color, description=description))
+
+        if size <= MAX_ATTACHMENT_SIZE:
+            await ctx.send(file=discord.File(exporter.path, filename=name))
+            os.remove(exporter.path)
+
+    @logs.command(name="import")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def logs_import(self, ctx, on_duplicate: str.lower = "skip"):
+        """
+        Import logs from an attached JSON or JSONL file.
+
+        The file can be gzip compressed, for example an export of
+        `{prefix}logs export`. Logs whose key already exists are skipped,
+        use `{prefix}logs import rekey` to import them with a new key.
+        """
+        if not ctx.message.attachments:
+            raise commands.BadArgument("Attach a `.json`, `.jsonl` or `.gz` file to import.")
+        try:
+            importer = LogImporter(
+                self.bot.api.logs,
+                guild_id=self.bot.guild_id,
+                bot_id=self.bot.user.id,
+                compact=self.bot.config.get_bool("compact_logs"),
+                on_duplicate=on_duplicate,
+                search_index=self.bot.search_index,
+            )
+        except ValueError as e:
+            raise commands.BadArgument(str(e))
+
+        attachment = ctx.message.attachments[0]
+        path = os.path.join(EXPORT_DIR, f"import-{attachment.id}")
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        embed = discord.Embed(
+            color=self.bot.main_color, description=f"Importing `{attachment.filename}`..."
+        )
+        status = await ctx.send(embed=embed)
+
+        async with ctx.typing():
+            await attachment.save(path)
+            try:
+                report = await importer.run(path)
+            finally:
+                os.remove(path)
+
+        description = str(report)
+        if report.errors:
+            description += "\n```\n" + "\n".join(report.errors[:10]) + "\n```"
+        await status.edit(embed=discord.Embed(color=self.bot.main_color, description=description))
+
+    @commands.command()
+    @checks.has_permissions(PermissionLevel.MODERATOR)
+    async def stats(self, ctx, days: int = 30):
+        """
+        Shows the team's statistics over the last `days` days.
+
+        Use `0` for all logs. Includes first response times, moderator
+        activity, the hourly load and the thread backlog, the raw
+        numbers are attached as CSV files.
+        """
+        try:
+            async with ctx.typing():
+                frame = await LogFrame.load(
+                    self.bot.api.read_logs, build_query(self.bot.guild_id, days)
+                )
+                report = await self.bot.loop.run_in_executor(None, TeamReport, frame)
+        except RuntimeError as e:
+            embed = discord.Embed(color=discord.Color.red(), description=str(e))
+            return await ctx.send(embed=embed)
+
+        period = f"last {days} days" if days else "all time"
+        embeds = []
+
+        embed = discord.Embed(title=f"Team Statistics ({period})", color=self.bot.main_color)
+        embed.add_field(name="Threads", value=str(report.logs))
+        embed.add_field(name="Messages", value=str(report.messages))
+        embed.add_field(name="Answered", value=str(report.answered))
+        embed.add_field(
+            name="First Response",
+            value="\n".join(
+                f"p{p}: {format_duration(value)}" for p, value in report.percentiles.items()
+            ),
+            inline=False,
+        )
+        if report.archived:
+            embed.add_field(
+                name="Archived",
+                value=f"{report.archived} archived threads are not included, "
+                "only the start of their transcript is kept in the database.",
+                inline=False,
+            )
+        embed.set_footer(text=f"Computed in {report.elapsed:.2f}s")
+        embeds.append(embed)
+
+        lines = []
+        for row in report.moderators[:15]:
+            user = self.bot.get_user(row["id"])
+            name = str(user) if user is not None else str(row["id"])
+            lines.append(
+                f"**{name}**: {row['replies']} replies in {row['threads']} threads, "
+                f"{row['closed']} closed, {row['active_days']} active days"
+            )
+        embeds.append(
+            discord.Embed(
+                title="Moderators",
+                color=self.bot.main_color,
+                description="\n".join(lines) or "No replies.",
+            )
+        )
+        embeds.append(
+            discord.Embed(
+                title="Hourly Load (UTC)",
+                color=self.bot.main_color,
+                description=f"```\n{report.format_heatmap()}\n```",
+            )
+        )
+        embeds.append(
+            discord.Embed(
+                title="Open Threads",
+                color=self.bot.main_color,
+                description=f"```\n{report.format_backlog()}\n```",
+            )
+        )
+
+        files = [
+            discord.File(io.BytesIO(content.encode("utf-8")), filename=name)
+            for name, content in report.csv_files().items()
+        ]
+        await ctx.send(files=files)
+
+        session = PaginatorSession(ctx, *embeds)
+        await session.run()
+
     @commands.command()
     @checks.has_permissions(PermissionLevel.SUPPORTER)
     @checks.thread_only()
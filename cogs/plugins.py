@@ -1,12 +1,11 @@
 import asyncio
+import hashlib
 import importlib
 import json
 import logging
 import os
 import random
-import shutil
 import site
-import stat
 import subprocess
 import sys
 from difflib import get_close_matches
@@ -14,16 +13,32 @@ from difflib import get_close_matches
 import discord
 from discord.ext import commands
 from discord.utils import async_all
+
+from aiohttp import ClientError
 from pkg_resources import parse_version
 
 from core import checks
+from core.clients import RequestClient
 from core.models import PermissionLevel
 from core.paginator import PaginatorSession
+from core.pluginhost import PluginHost, serialize_message, serialize_thread, serialize_user
+from core.pluginrepo import PluginRepoCache, RepoError
 from core.utils import error, info
 
 logger = logging.getLogger("Modmail")
 
 
+# The number of plugins downloaded at once on startup.
+PLUGIN_CONCURRENCY = 4
+
+TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "temp")
+# The combined requirements of the plugins, and the hash of the last installed ones.
+REQUIREMENTS_FILE = os.path.join(TEMP_DIR, "plugin_requirements.txt")
+REQUIREMENTS_HASH_FILE = os.path.join(TEMP_DIR, "plugin_requirements.sha256")
+# The bare mirrors of the plugin repositories, see core/pluginrepo.py.
+MIRROR_DIR = os.path.join(TEMP_DIR, "plugin_mirrors")
+
+
 class DownloadError(Exception):
     pass
 
@@ -41,13 +56,46 @@ class Plugins(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.registry = {}
+        self._pip_lock = asyncio.Lock()
+        self.workers = PluginHost(bot)
+        self.repos = PluginRepoCache(MIRROR_DIR, "plugins")
         self.bot.loop.create_task(self.download_initial_plugins())
         self.bot.loop.create_task(self.populate_registry())
 
+    def cog_unload(self):
+        self.bot.loop.create_task(self.workers.close())
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.author != self.bot.user:
+            self.workers.dispatch("message", serialize_message, message)
+
+    @commands.Cog.listener()
+    async def on_thread_ready(self, thread):
+        self.workers.dispatch("thread_ready", serialize_thread, thread)
+
+    @commands.Cog.listener()
+    async def on_thread_close(self, thread, closer, silent, delete_channel, message, scheduled):
+        def serialize():
+            return {
+                "thread": serialize_thread(thread),
+                "closer": serialize_user(closer),
+                "silent": silent,
+                "delete_channel": delete_channel,
+                "message": message,
+                "scheduled": scheduled,
+            }
+
+        self.workers.dispatch("thread_close", serialize)
+
     async def populate_registry(self):
         url = "https://raw.githubusercontent.com/kyb3r/modmail/master/plugins/registry.json"
-        async with self.bot.session.get(url) as resp:
-            self.registry = json.loads(await resp.text())
+        try:
+            data = await RequestClient(self.bot).request(url, cache=True, max_age=5 * 60)
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning("Failed to fetch the plugin registry: %r.", e)
+            return
+        self.registry = json.loads(data) if isinstance(data, str) else data
 
     @staticmethod
     def _asubprocess_run(cmd):
@@ -77,90 +125,228 @@ class Plugins(commands.Cog):
     async def download_initial_plugins(self):
         await self.bot._connected.wait()
 
-        for i in self.bot.config.plugins:
-            username, repo, name, branch = self.parse_plugin(i)
+        with self.bot.startup_profile.phase("plugins"):
+            await self._download_initial_plugins()
 
-            try:
+    async def _download_initial_plugins(self):
+        """
+        Downloads the plugins concurrently, installs all their requirements
+        with a single pip run and loads each plugin as soon as it is ready.
+
+        If the combined install fails, each plugin installs its own
+        requirements, so only the plugins at fault are skipped.
+        """
+        plugins = [p for p in map(self.parse_plugin, self.bot.config.plugins) if p is not None]
+        semaphore = asyncio.Semaphore(PLUGIN_CONCURRENCY)
+
+        async def download(username, repo, branch):
+            async with semaphore:
                 await self.download_plugin_repo(username, repo, branch)
+
+        downloads = {}
+        for username, repo, _, branch in plugins:
+            if (username, repo, branch) not in downloads:
+                downloads[username, repo, branch] = asyncio.ensure_future(
+                    download(username, repo, branch)
+                )
+
+        async def install_requirements():
+            await asyncio.gather(*downloads.values(), return_exceptions=True)
+            try:
+                return await self.install_requirements(
+                    self.plugin_dir(*plugin)
+                    for plugin in plugins
+                    if downloads[plugin[0], plugin[1], plugin[3]].exception() is None
+                )
+            except DownloadError:
+                logger.warning("Installing the requirements of each plugin separately.")
+                raise
+
+        requirements = asyncio.ensure_future(install_requirements())
+        reinstall = None
+
+        async def boot(username, repo, name, branch):
+            nonlocal reinstall
+            try:
+                await downloads[username, repo, branch]
             except DownloadError as exc:
                 msg = f"{username}/{repo}@{branch} - {exc}"
                 logger.error(error(msg))
-            else:
+                return
+
+            try:
+                dirname = self.plugin_dir(username, repo, name, branch)
+                if not os.path.exists(os.path.join(dirname, "requirements.txt")):
+                    return await self._load_extension(username, repo, name, branch)
                 try:
-                    await self.load_plugin(username, repo, name, branch)
+                    installed = await asyncio.shield(requirements)
+                except DownloadError:
+                    installed = await self.install_requirements([dirname])
+                try:
+                    await self._load_extension(username, repo, name, branch)
                 except DownloadError as exc:
-                    msg = f"{username}/{repo}@{branch}[{name}] - {exc}"
-                    logger.error(error(msg))
+                    original = getattr(exc.__cause__, "original", None)
+                    if installed or not isinstance(original, ImportError):
+                        raise
+                    # The last install was recorded but the packages are gone
+                    # (e.g. a new container), install them once more.
+                    if reinstall is None:
+                        reinstall = asyncio.ensure_future(
+                            self.install_requirements(
+                                [self.plugin_dir(*plugin) for plugin in plugins], force=True
+                            )
+                        )
+                    try:
+                        await asyncio.shield(reinstall)
+                    except DownloadError:
+                        await self.install_requirements([dirname], force=True)
+                    await self._load_extension(username, repo, name, branch)
+            except DownloadError as exc:
+                msg = f"{username}/{repo}@{branch}[{name}] - {exc}"
+                logger.error(error(msg))
 
-    async def download_plugin_repo(self, username, repo, branch):
-        try:
-            cmd = f"git clone https://github.com/{username}/{repo} "
-            cmd += f"plugins/{username}-{repo}-{branch} "
-            cmd += f"-b {branch} -q"
+        await asyncio.gather(*(boot(*plugin) for plugin in plugins))
+
+    @staticmethod
+    def plugin_dir(username, repo, name, branch) -> str:
+        return f"plugins/{username}-{repo}-{branch}/{name}"
 
-            await self.bot.loop.run_in_executor(None, self._asubprocess_run, cmd)
-            # -q (quiet) so there's no terminal output unless there's an error
+    @staticmethod
+    def _read_requirements(dirnames) -> list:
+        requirements = set()
+        for dirname in dirnames:
+            try:
+                with open(os.path.join(dirname, "requirements.txt"), encoding="utf-8") as f:
+                    for line in f:
+                        line = line.split(" #", 1)[0].strip()
+                        if line and not line.startswith("#"):
+                            requirements.add(line)
+            except OSError:
+                continue
+        return sorted(requirements)
+
+    async def install_requirements(self, dirnames, force: bool = False) -> bool:
+        """
+        Installs the combined requirements of plugin directories with one pip run.
+
+        The install is skipped when the requirements match the last successful
+        install, unless `force` is set.
+
+        Returns
+        -------
+        bool
+            Whether pip was run.
+        """
+        requirements = self._read_requirements(dirnames)
+        if not requirements:
+            return False
+
+        digest = hashlib.sha256(
+            "\n".join([sys.executable] + requirements).encode()
+        ).hexdigest()
+        async with self._pip_lock:
+            try:
+                with open(REQUIREMENTS_HASH_FILE, encoding="utf-8") as f:
+                    installed = f.read().strip()
+            except OSError:
+                installed = None
+
+            installed_now = False
+            if force or digest != installed:
+                with open(REQUIREMENTS_FILE, "w", encoding="utf-8") as f:
+                    f.write("\n".join(requirements) + "\n")
+                await self._pip_install(REQUIREMENTS_FILE)
+                with open(REQUIREMENTS_HASH_FILE, "w", encoding="utf-8") as f:
+                    f.write(digest)
+                installed_now = True
+
+        if site.USER_SITE not in sys.path:
+            if not os.path.exists(site.USER_SITE):
+                os.makedirs(site.USER_SITE)
+            sys.path.insert(0, site.USER_SITE)
+        return installed_now
+
+    async def _pip_install(self, path):
+        venv = hasattr(sys, "real_prefix")  # in a virtual env
+        user_install = "--user" if not venv else ""
+
+        logger.info("Installing plugin requirements.")
+        try:
+            if os.name == "nt":  # Windows
+                await self.bot.loop.run_in_executor(
+                    None, self._asubprocess_run, f"pip install -r {path} {user_install} -q -q"
+                )
+            else:
+                await self.bot.loop.run_in_executor(
+                    None,
+                    self._asubprocess_run,
+                    f"python3 -m pip install -U -r {path} {user_install} -q -q",
+                )
+                # -q -q (quiet)
+                # so there's no terminal output unless there's an error
         except subprocess.CalledProcessError as exc:
-            err = exc.stderr.decode("utf-8").strip()
+            err = exc.stderr.decode("utf8").strip()
+            logger.error(error("Requirements Download Error"))
+            raise DownloadError(f"Unable to download requirements: ```\n{err}\n```") from exc
 
-            if not err.endswith("already exists and is not an empty directory."):
-                # don't raise error if the plugin folder exists
-                msg = f"Download Error: {username}/{repo}@{branch}"
-                logger.error(msg)
-                raise DownloadError(err) from exc
+    async def download_plugin_repo(self, username, repo, branch):
+        try:
+            sha = await self.bot.loop.run_in_executor(
+                None, self.repos.install, username, repo, branch
+            )
+        except RepoError as exc:
+            logger.error("Download Error: %s/%s@%s", username, repo, branch)
+            raise DownloadError(str(exc)) from exc
+        logger.debug("Plugin repository %s/%s@%s is at %s.", username, repo, branch, sha[:7])
 
     async def load_plugin(self, username, repo, plugin_name, branch):
-        ext = f"plugins.{username}-{repo}-{branch}.{plugin_name}.{plugin_name}"
-        dirname = f"plugins/{username}-{repo}-{branch}/{plugin_name}"
-
-        if "requirements.txt" in os.listdir(dirname):
-            # Install PIP requirements
-
-            venv = hasattr(sys, "real_prefix")  # in a virtual env
-            user_install = "--user" if not venv else ""
+        dirname = self.plugin_dir(username, repo, plugin_name, branch)
+        # The requirements of every plugin are installed together, so the
+        # next startup matches this install and skips pip.
+        dirnames = {dirname}
+        for plugin in map(self.parse_plugin, self.bot.config.plugins):
+            if plugin is not None:
+                dirnames.add(self.plugin_dir(*plugin))
+        await self.install_requirements(sorted(dirnames))
+        await self._load_extension(username, repo, plugin_name, branch)
 
-            try:
-                if os.name == "nt":  # Windows
-                    await self.bot.loop.run_in_executor(
-                        None,
-                        self._asubprocess_run,
-                        f"pip install -r {dirname}/requirements.txt {user_install} -q -q",
-                    )
-                else:
-                    await self.bot.loop.run_in_executor(
-                        None,
-                        self._asubprocess_run,
-                        f"python3 -m pip install -U -r {dirname}/"
-                        f"requirements.txt {user_install} -q -q",
-                    )
-                    # -q -q (quiet)
-                    # so there's no terminal output unless there's an error
-            except subprocess.CalledProcessError as exc:
-                err = exc.stderr.decode("utf8").strip()
-
-                if err:
-                    msg = f"Requirements Download Error: {username}/{repo}@{branch}[{plugin_name}]"
-                    logger.error(error(msg))
-                    raise DownloadError(
-                        f"Unable to download requirements: ```\n{err}\n```"
-                    ) from exc
-            else:
-                if not os.path.exists(site.USER_SITE):
-                    os.makedirs(site.USER_SITE)
+    @staticmethod
+    def plugin_key(username, repo, name, branch) -> str:
+        return f"{username}/{repo}/{name}@{branch}"
 
-                sys.path.insert(0, site.USER_SITE)
+    def is_isolated(self, username, repo, name, branch) -> bool:
+        key = self.plugin_key(username, repo, name, branch)
+        return key in (self.bot.config.get("isolated_plugins") or [])
 
-        await asyncio.sleep(0.5)
+    async def _load_extension(self, username, repo, plugin_name, branch):
+        ext = f"plugins.{username}-{repo}-{branch}.{plugin_name}.{plugin_name}"
         try:
-            self.bot.load_extension(ext)
+            if self.is_isolated(username, repo, plugin_name, branch):
+                key = self.plugin_key(username, repo, plugin_name, branch)
+                await self.workers.start(key, ext)
+            else:
+                self.bot.load_extension(ext)
         except commands.ExtensionError as exc:
             msg = f"Plugin Load Failure: {username}/{repo}@{branch}[{plugin_name}]"
             logger.error(error(msg))
             raise DownloadError("Invalid plugin") from exc
+        except RuntimeError as exc:
+            msg = f"Plugin Worker Failure: {username}/{repo}@{branch}[{plugin_name}]"
+            logger.error(error(msg))
+            raise DownloadError(str(exc)) from exc
         else:
             msg = f"Loaded Plugin: {username}/{repo}@{branch}[{plugin_name}]"
             logger.info(info(msg))
 
+    async def _unload_extension(self, username, repo, plugin_name, branch):
+        key = self.plugin_key(username, repo, plugin_name, branch)
+        if key in self.workers.workers:
+            await self.workers.stop(key)
+        else:
+            self.bot.unload_extension(
+                f"plugins.{username}-{repo}-{branch}.{plugin_name}.{plugin_name}"
+            )
+
     @commands.group(aliases=["plugins"], invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.OWNER)
     async def plugin(self, ctx):
@@ -265,9 +451,7 @@ class Plugins(commands.Cog):
             try:
                 username, repo, name, branch = self.parse_plugin(plugin_name)
 
-                self.bot.unload_extension(
-                    f"plugins.{username}-{repo}-{branch}.{name}.{name}"
-                )
+                await self._unload_extension(username, repo, name, branch)
             except Exception:
                 pass
 
@@ -278,15 +462,10 @@ class Plugins(commands.Cog):
                 if not any(
                     i.startswith(f"{username}/{repo}") for i in self.bot.config.plugins
                 ):
-                    # if there are no more of such repos, delete the folder
-                    def onerror(func, path, exc_info):  # pylint: disable=W0613
-                        if not os.access(path, os.W_OK):
-                            # Is the error an access error?
-                            os.chmod(path, stat.S_IWUSR)
-                            func(path)
-
-                    shutil.rmtree(
-                        f"plugins/{username}-{repo}-{branch}", onerror=onerror
+                    # if there are no more of such repos, delete the worktree,
+                    # the mirror is kept so a reinstall doesn't download it again
+                    await self.bot.loop.run_in_executor(
+                        None, self.repos.remove, username, repo, branch
                     )
             except Exception as exc:
                 logger.error(str(exc))
@@ -328,31 +507,27 @@ class Plugins(commands.Cog):
             username, repo, name, branch = self.parse_plugin(plugin_name)
 
             try:
-                cmd = f"cd plugins/{username}-{repo}-{branch} && git reset --hard origin/{branch} && git fetch --all && git pull"
-                cmd = await self.bot.loop.run_in_executor(
-                    None, self._asubprocess_run, cmd
+                previous, sha = await self.bot.loop.run_in_executor(
+                    None, self.repos.update, username, repo, branch
                 )
-            except subprocess.CalledProcessError as exc:
-                err = exc.stderr.decode("utf8").strip()
-
+            except RepoError as exc:
                 embed = discord.Embed(
-                    description=f"An error occured while updating: {err}.",
+                    description=f"An error occured while updating: {exc}.",
                     color=self.bot.main_color,
                 )
                 await ctx.send(embed=embed)
 
             else:
-                output = cmd.stdout.decode("utf8").strip()
-
-                embed = discord.Embed(
-                    description=f"```\n{output}\n```", color=self.bot.main_color
-                )
+                if previous == sha:
+                    output = f"Already up to date at `{sha[:7]}`."
+                else:
+                    output = f"Updated from `{(previous or 'unknown')[:7]}` to `{sha[:7]}`."
+                embed = discord.Embed(description=output, color=self.bot.main_color)
                 await ctx.send(embed=embed)
 
-                if output != "Already up to date.":
+                if previous != sha:
                     # repo was updated locally, now perform the cog reload
-                    ext = f"plugins.{username}-{repo}-{branch}.{name}.{name}"
-                    self.bot.unload_extension(ext)
+                    await self._unload_extension(username, repo, name, branch)
 
                     try:
                         await self.load_plugin(username, repo, name, branch)
@@ -363,6 +538,133 @@ class Plugins(commands.Cog):
                         )
                         await ctx.send(embed=em)
 
+    def _resolve_plugin(self, plugin_name):
+        if plugin_name in self.registry:
+            details = self.registry[plugin_name]
+            plugin_name = details["repository"] + "/" + plugin_name + "@" + details["branch"]
+        if plugin_name not in self.bot.config.plugins:
+            return None
+        return self.parse_plugin(plugin_name)
+
+    @plugin.command(name="isolate")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def plugin_isolate(self, ctx, *, plugin_name: str):
+        """
+        Run a plugin in its own process, or back inside the bot.
+
+        An isolated plugin can't slow down the bot: it runs in a separate
+        process, receives the messages and thread events, and answers with
+        actions. The plugin must support it with a `setup_worker` function.
+        """
+        plugin = self._resolve_plugin(plugin_name)
+        if plugin is None:
+            embed = discord.Embed(
+                description="That plugin is not installed.", color=self.bot.main_color
+            )
+            return await ctx.send(embed=embed)
+
+        key = self.plugin_key(*plugin)
+        isolated = list(self.bot.config.get("isolated_plugins") or [])
+        async with ctx.typing():
+            if key in isolated:
+                await self._unload_extension(*plugin)
+                isolated.remove(key)
+                self.bot.config["isolated_plugins"] = isolated
+                try:
+                    await self._load_extension(*plugin)
+                except DownloadError as exc:
+                    description = f"The worker is stopped, but the plugin failed to load: `{exc}`."
+                else:
+                    description = "The plugin now runs inside the bot."
+            else:
+                username, repo, name, branch = plugin
+                try:
+                    self.bot.unload_extension(f"plugins.{username}-{repo}-{branch}.{name}.{name}")
+                except commands.ExtensionNotLoaded:
+                    pass
+                self.bot.config["isolated_plugins"] = isolated + [key]
+                try:
+                    await self._load_extension(*plugin)
+                except DownloadError as exc:
+                    # Back to the way it was
+                    self.bot.config["isolated_plugins"] = isolated
+                    try:
+                        await self._load_extension(*plugin)
+                    except DownloadError:
+                        pass
+                    description = f"Unable to isolate the plugin: `{exc}`."
+                else:
+                    description = "The plugin now runs in its own process."
+            await self.bot.config.update()
+
+        embed = discord.Embed(description=description, color=self.bot.main_color)
+        await ctx.send(embed=embed)
+
+    @plugin.command(name="workers")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def plugin_workers(self, ctx):
+        """Shows the processes of the isolated plugins and their load."""
+
+        def ms(seconds):
+            return f"{seconds * 1000:.0f}ms" if seconds is not None else "-"
+
+        embeds = []
+        for key, worker in sorted(self.workers.workers.items()):
+            stats = worker.to_dict()
+            embed = discord.Embed(title=key, color=self.bot.main_color)
+            embed.add_field(name="Status", value=f"{stats['status']} (pid {stats['pid']})")
+            embed.add_field(name="Listens to", value=", ".join(stats["listens_to"]) or "nothing")
+            embed.add_field(
+                name="Events",
+                value=f"{stats['events']} handled, {stats['queued']} queued, "
+                f"{stats['dropped']} dropped, {stats['errors']} failed",
+                inline=False,
+            )
+            embed.add_field(
+                name="Latency",
+                value=f"p50 {ms(stats['latency_p50'])}, p95 {ms(stats['latency_p95'])}, "
+                f"max {ms(stats['latency_max'])}",
+            )
+            embed.add_field(
+                name="CPU",
+                value=f"{stats['cpu']:.1f}s ({stats['handler_cpu']:.1f}s in listeners)",
+            )
+            embed.add_field(
+                name="Restarts",
+                value=f"{stats['restarts']} ({stats['timeouts']} after a timeout)",
+            )
+            embeds.append(embed)
+
+        if not embeds:
+            embed = discord.Embed(
+                description="No plugin is isolated.", color=self.bot.main_color
+            )
+            return await ctx.send(embed=embed)
+        paginator = PaginatorSession(ctx, *embeds)
+        await paginator.run()
+
+    @plugin.command(name="restart")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def plugin_restart(self, ctx, *, plugin_name: str):
+        """Restart the process of an isolated plugin."""
+        plugin = self._resolve_plugin(plugin_name)
+        worker = self.workers.workers.get(self.plugin_key(*plugin)) if plugin else None
+        if worker is None:
+            embed = discord.Embed(
+                description="That plugin is not isolated.", color=self.bot.main_color
+            )
+            return await ctx.send(embed=embed)
+
+        async with ctx.typing():
+            try:
+                await worker.restart()
+            except RuntimeError as exc:
+                description = f"Unable to restart the plugin: `{exc}`."
+            else:
+                description = f"The plugin was restarted (pid {worker.pid})."
+        embed = discord.Embed(description=description, color=self.bot.main_color)
+        await ctx.send(embed=embed)
+
     @plugin.command(name="enabled", aliases=["installed"])
     @checks.has_permissions(PermissionLevel.OWNER)
     async def plugin_enabled(self, ctx):
@@ -7,13 +7,14 @@ import random
 from contextlib import redirect_stdout
 from datetime import datetime
 from difflib import get_close_matches
-from io import StringIO
+from glob import glob
+from io import BytesIO, StringIO
 from typing import Union
 from types import SimpleNamespace as param
-from json import JSONDecodeError, loads
+from json import JSONDecodeError, dumps, loads
 from textwrap import indent
 
-from discord import Embed, Color, Activity, Role
+from discord import Embed, Color, Activity, File, Role
 from discord.enums import ActivityType, Status
 from discord.ext import commands
 
@@ -22,9 +23,12 @@ from pkg_resources import parse_version
 
 from core import checks
 from core.changelog import Changelog
+from core.dbprofiler import plan_summary
 from core.decorators import trigger_typing
+from core.logfile import LogTail, paginate as paginate_log, read_chunks
 from core.models import InvalidConfigError, PermissionLevel
-from core.paginator import PaginatorSession, MessagePaginatorSession
+from core.paginator import PaginatorSession, LogPaginatorSession
+from core.sampler import StackSampler
 from core.utils import cleanup_code, info, error, User, get_perm_level
 
 logger = logging.getLogger("Modmail")
@@ -214,6 +218,7 @@ class Utility(commands.Cog):
 
         # Class Variables
         self.presence = None
+        self.sampler = None
 
         # Tasks
         self.presence_task = self.bot.loop.create_task(self.loop_presence())
@@ -289,21 +294,19 @@ class Utility(commands.Cog):
     @commands.group(invoke_without_command=True)
     @checks.has_permissions(PermissionLevel.OWNER)
     @trigger_typing
-    async def debug(self, ctx):
-        """Shows the recent application-logs of the bot."""
-
-        log_file_name = self.bot.config.token.split(".")[0]
+    async def debug(self, ctx, size: int = 64):
+        """
+        Shows the recent application-logs of the bot.
 
-        with open(
-            os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                f"../temp/{log_file_name}.log",
-            ),
-            "r+",
-        ) as f:
-            logs = f.read().strip()
+        The last `size` KB of logs are shown first (64 by default), the
+        older ones are read when you go back.
+        """
+        tail = LogTail(self.bot.log_file_name, chunk_size=max(size, 1) * 1024)
+        messages = []
+        while not messages and not tail.exhausted:
+            messages = paginate_log(await self.bot.loop.run_in_executor(None, tail.older))
 
-        if not logs:
+        if not messages:
             embed = Embed(
                 color=self.bot.main_color,
                 title="Debug Logs:",
@@ -312,33 +315,10 @@ class Utility(commands.Cog):
             embed.set_footer(text="Go to Heroku to see your logs.")
             return await ctx.send(embed=embed)
 
-        messages = []
-
-        # Using Scala formatting because it's similar to Python for exceptions
-        # and it does a fine job formatting the logs.
-        msg = "```Scala\n"
-
-        for line in logs.splitlines(keepends=True):
-            if msg != "```Scala\n":
-                if len(line) + len(msg) + 3 > 2000:
-                    msg += "```"
-                    messages.append(msg)
-                    msg = "```Scala\n"
-            msg += line
-            if len(msg) + 3 > 2000:
-                msg = msg[:1993] + "[...]```"
-                messages.append(msg)
-                msg = "```Scala\n"
-
-        if msg != "```Scala\n":
-            msg += "```"
-            messages.append(msg)
-
         embed = Embed(color=self.bot.main_color)
         embed.set_footer(text="Debug logs - Navigate using the reactions below.")
 
-        session = MessagePaginatorSession(ctx, *messages, embed=embed)
-        session.current = len(messages) - 1
+        session = LogPaginatorSession(ctx, tail, *messages, embed=embed)
         return await session.run()
 
     @debug.command(name="hastebin", aliases=["haste"])
@@ -348,20 +328,19 @@ class Utility(commands.Cog):
         """Posts application-logs to Hastebin."""
 
         haste_url = os.environ.get("HASTE_URL", "https://hasteb.in")
-        log_file_name = self.bot.config.token.split(".")[0]
 
-        with open(
-            os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                f"../temp/{log_file_name}.log",
-            ),
-            "r+",
-        ) as f:
-            logs = f.read().strip()
+        async def upload():
+            # Streamed with a chunked request, the file is never fully in memory
+            chunks = read_chunks(self.bot.log_file_name)
+            while True:
+                chunk = await self.bot.loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
 
         try:
             async with self.bot.session.post(
-                haste_url + "/documents", data=logs
+                haste_url + "/documents", data=upload()
             ) as resp:
                 key = (await resp.json())["key"]
                 embed = Embed(
@@ -369,7 +348,7 @@ class Utility(commands.Cog):
                     color=self.bot.main_color,
                     description=f"{haste_url}/" + key,
                 )
-        except (JSONDecodeError, ClientResponseError, IndexError):
+        except (JSONDecodeError, ClientResponseError, IndexError, KeyError, OSError):
             embed = Embed(
                 title="Debug Logs",
                 color=self.bot.main_color,
@@ -385,22 +364,377 @@ class Utility(commands.Cog):
     async def debug_clear(self, ctx):
         """Clears the locally cached logs."""
 
-        log_file_name = self.bot.config.token.split(".")[0]
-
-        with open(
-            os.path.join(
-                os.path.dirname(os.path.abspath(__file__)),
-                f"../temp/{log_file_name}.log",
-            ),
-            "w",
-        ):
+        # The file stays open in append mode in the logging thread, it can
+        # be truncated under it
+        with open(self.bot.log_file_name, "w", encoding="utf-8"):
             pass
+        for backup in glob(self.bot.log_file_name + ".*.gz"):
+            os.remove(backup)
         await ctx.send(
             embed=Embed(
                 color=self.bot.main_color, description="Logs nettoyé"
             )
         )
 
+    @debug.command(name="pool")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_pool(self, ctx):
+        """Shows the database connection pool statistics."""
+
+        stats = self.bot.storage.pool_stats()
+        embed = Embed(
+            title="Database Pools",
+            color=self.bot.main_color,
+            description=f"Backend: `{self.bot.storage.name}`",
+        )
+        if not stats:
+            embed.description += "\nThis backend has no connection pool."
+        for name, pool in stats.items():
+            embed.add_field(
+                name=name.title(),
+                value=f"Checkouts: {pool['checkouts']} ({pool['failed']} failed)\n"
+                f"Connections: {pool['in_use']} in use, {pool['open']} open\n"
+                f"Wait: {pool['wait_mean']:.2f}ms mean, {pool['wait_p50']:.2f}ms p50, "
+                f"{pool['wait_p99']:.2f}ms p99, {pool['wait_max']:.2f}ms max",
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
+    @debug.command(name="queries")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_queries(self, ctx, action: str.lower = None):
+        """
+        Shows the database operations latency statistics.
+
+        `{prefix}debug queries` shows the latency and result size per
+        collection and operation, and the slowest queries.
+        `{prefix}debug queries json` attaches all the statistics.
+        `{prefix}debug queries reset` clears them.
+        Use `{prefix}debug explain <number>` to get the plan of a slow query.
+        """
+        profiler = self.bot.query_profiler
+        if profiler is None:
+            embed = Embed(
+                color=Color.red(),
+                description="The query profiler is disabled, set `QUERY_PROFILER` to enable it.",
+            )
+            return await ctx.send(embed=embed)
+
+        if action == "reset":
+            profiler.reset()
+            embed = Embed(color=self.bot.main_color, description="Query statistics cleared.")
+            return await ctx.send(embed=embed)
+        if action == "json":
+            data = dumps(profiler.to_dict(), default=str, indent=2).encode()
+            return await ctx.send(file=File(BytesIO(data), filename="queries.json"))
+        if action is not None:
+            raise commands.BadArgument("The action must be `json` or `reset`.")
+
+        lines = [f"{'Operation':<32}{'Count':>7}{'Mean':>8}{'p99':>8}{'Max':>8}{'KiB/op':>8}"]
+        for name, op, stats in profiler.summary()[:15]:
+            lines.append(
+                f"{(name + '.' + op)[:31]:<32}{stats['count']:>7}{stats['mean']:>8.1f}"
+                f"{stats['p99']:>8.1f}{stats['max']:>8.1f}"
+                f"{stats['bytes'] / stats['count'] / 1024:>8.1f}"
+            )
+        overview = Embed(
+            title="Database Operations",
+            color=self.bot.main_color,
+            description="Latencies in ms, sorted by total time.\n```\n"
+            + "\n".join(lines)
+            + "\n```",
+        )
+        overview.set_footer(text=f"Since {profiler.started:%Y-%m-%d %H:%M:%S} UTC")
+
+        slowest = Embed(title="Slowest Queries", color=self.bot.main_color)
+        for i, query in enumerate(profiler.slowest()[:10], start=1):
+            slowest.add_field(
+                name=f"{i}. {query.name}.{query.op} - {query.elapsed:.1f}ms",
+                value=f"{query.docs} documents, {query.size / 1024:.1f} KiB\n"
+                f"```{str(query.filter)[:200]}```",
+                inline=False,
+            )
+        if not slowest.fields:
+            slowest.description = "No queries recorded yet."
+
+        session = PaginatorSession(ctx, overview, slowest)
+        await session.run()
+
+    @debug.command(name="perf")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_perf(self, ctx, action: str.lower = None):
+        """
+        Shows the latency of the event listeners and commands.
+
+        `{prefix}debug perf` shows, per cog and per handler, the wall time
+        percentiles and the time they held the event loop.
+        `{prefix}debug perf json` attaches all the statistics.
+        `{prefix}debug perf reset` clears them.
+        """
+        profiler = self.bot.latency_profiler
+        if profiler is None:
+            embed = Embed(
+                color=Color.red(),
+                description="The latency profiler is disabled, "
+                "set `LATENCY_PROFILER` to enable it.",
+            )
+            return await ctx.send(embed=embed)
+
+        if action == "reset":
+            profiler.reset()
+            embed = Embed(color=self.bot.main_color, description="Latency statistics cleared.")
+            return await ctx.send(embed=embed)
+        if action == "json":
+            data = dumps(profiler.to_dict(), indent=2).encode()
+            return await ctx.send(file=File(BytesIO(data), filename="perf.json"))
+        if action is not None:
+            raise commands.BadArgument("The action must be `json` or `reset`.")
+
+        def table(rows, title):
+            lines = [f"{'Handler':<28}{'Count':>7}{'p50':>7}{'p95':>7}{'p99':>7}{'Loop':>8}"]
+            for *name, stats in rows[:15]:
+                lines.append(
+                    f"{'.'.join(name)[:27]:<28}{stats['count']:>7}{stats['wall']['p50']:>7.0f}"
+                    f"{stats['wall']['p95']:>7.0f}{stats['wall']['p99']:>7.0f}"
+                    f"{stats['busy_total'] / 1000:>7.1f}s"
+                )
+            embed = Embed(
+                title=title,
+                color=self.bot.main_color,
+                description="Wall time in ms, Loop is the total time the event loop was held."
+                "\n```\n" + "\n".join(lines) + "\n```",
+            )
+            embed.set_footer(
+                text=f"Last {profiler.window} calls, since "
+                f"{profiler.started:%Y-%m-%d %H:%M:%S} UTC"
+            )
+            return embed
+
+        embeds = [
+            table(profiler.summary(by_cog=True), "Latency by Cog"),
+            table([row[1:] for row in profiler.summary("listener")], "Listeners"),
+            table([row[2:] for row in profiler.summary("command")], "Commands"),
+            table([row[2:] for row in profiler.summary("checks")], "Checks and Converters"),
+        ]
+        session = PaginatorSession(ctx, *embeds)
+        await session.run()
+
+    @debug.command(name="loop")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_loop(self, ctx, action: str.lower = None):
+        """
+        Shows the event loop lag and the code that blocked it.
+
+        `{prefix}debug loop` shows the lag percentiles and the recent stalls
+        with the stack of the blocking code.
+        `{prefix}debug loop json` attaches everything.
+        """
+        monitor = self.bot.loop_monitor
+        if monitor is None:
+            embed = Embed(
+                color=Color.red(),
+                description="The loop monitor is disabled, set `LOOP_MONITOR` to enable it.",
+            )
+            return await ctx.send(embed=embed)
+
+        if action == "json":
+            data = dumps(monitor.to_dict(), indent=2).encode()
+            return await ctx.send(file=File(BytesIO(data), filename="loop.json"))
+        if action is not None:
+            raise commands.BadArgument("The action must be `json`.")
+
+        lag = monitor.percentiles()
+        overview = Embed(title="Event Loop", color=self.bot.main_color)
+        overview.add_field(
+            name="Lag",
+            value=" / ".join(f"{name} {lag[name] * 1000:.1f}ms" for name in lag),
+            inline=False,
+        )
+        overview.add_field(
+            name="Stalls",
+            value=f"{monitor.stall_count} longer than {monitor.threshold * 1000:.0f}ms",
+        )
+        overview.set_footer(
+            text=f"Last {len(monitor.lag)} samples, every {monitor.interval * 1000:.0f}ms"
+        )
+        embeds = [overview]
+        for stall in reversed(monitor.stalls):
+            embed = Embed(
+                title=f"Blocked for {stall.duration * 1000:.0f}ms"
+                + ("" if stall.ended else " (still blocked)"),
+                color=self.bot.error_color,
+                description="```py\n" + "".join(stall.stack)[-1900:] + "```",
+                timestamp=stall.timestamp,
+            )
+            embeds.append(embed)
+        session = PaginatorSession(ctx, *embeds)
+        await session.run()
+
+    @debug.command(name="relays")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_relays(self, ctx, action: str.lower = None):
+        """
+        Shows where the time of the slowest relayed messages went.
+
+        `{prefix}debug relays` shows the slowest traced messages, one page
+        each with the time spent in every stage, from the reception of the
+        DM to the post in the thread channel (or the other way around).
+        `{prefix}debug relays json` attaches all the kept traces.
+        """
+        tracer = self.bot.tracer
+        if action == "json":
+            data = dumps(tracer.to_dict(), indent=2).encode()
+            return await ctx.send(file=File(BytesIO(data), filename="relays.json"))
+        if action is not None:
+            raise commands.BadArgument("The action must be `json`.")
+
+        slowest = tracer.slowest()
+        overview = Embed(title="Relayed Messages", color=self.bot.main_color)
+        overview.add_field(name="Traced", value=str(tracer.count))
+        overview.add_field(
+            name="Kept", value=f"{len(tracer.sampled)} sampled, {len(tracer.slow)} slow"
+        )
+        overview.add_field(
+            name="Slowest",
+            value="\n".join(
+                f"`{trace.duration * 1000:.0f}ms` {trace.kind} ({trace.status})"
+                for trace in slowest
+            )
+            or "No traces yet.",
+            inline=False,
+        )
+        overview.set_footer(
+            text=f"Sampling {tracer.sample_rate:.0%}, "
+            f"keeping all relays slower than {tracer.slow_threshold}s"
+        )
+
+        embeds = [overview]
+        for trace in slowest:
+            lines = []
+            for span in trace.to_dict()["spans"]:
+                duration = span["duration"]
+                lines.append(
+                    f"{'  ' * span['depth'] + span['name']:<30}{span['start']:>7.0f}"
+                    + (f"{duration:>7.0f}" if duration is not None else "      -")
+                    + (" *" if span["background"] else "")
+                )
+            embed = Embed(
+                title=f"{trace.kind}: {trace.duration * 1000:.0f}ms ({trace.status})",
+                color=self.bot.main_color if trace.status == "ok" else self.bot.error_color,
+                description=f"```\n{'Stage':<30}{'Start':>7}{'Took':>7}\n"
+                + "\n".join(lines)[-1900:]
+                + "\n```\nTimes in ms, * ran on after the message was relayed.",
+                timestamp=trace.timestamp,
+            )
+            for name, value in trace.attributes.items():
+                if isinstance(value, float):
+                    value = f"{value:.2f}s"
+                embed.add_field(name=name.replace("_", " ").capitalize(), value=str(value))
+            embeds.append(embed)
+        session = PaginatorSession(ctx, *embeds)
+        await session.run()
+
+    @debug.command(name="profile")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_profile(self, ctx, seconds: float = 10, threads: str.lower = None):
+        """
+        Profiles the CPU usage of the bot for a few seconds.
+
+        The stack of the event loop is sampled every 5ms while the bot keeps
+        running, `{prefix}debug profile 30 all` samples every thread.
+        Shows the functions and coroutines the most samples were taken in,
+        and attaches the stacks in the collapsed format, to make a flame
+        graph with `flamegraph.pl` or https://www.speedscope.app.
+        """
+        if not 1 <= seconds <= 300:
+            raise commands.BadArgument("The duration must be between 1 and 300 seconds.")
+        if threads not in (None, "all"):
+            raise commands.BadArgument("The second argument must be `all`.")
+        if self.sampler is not None:
+            embed = Embed(color=Color.red(), description="A profile is already running.")
+            return await ctx.send(embed=embed)
+
+        self.sampler = sampler = StackSampler(self.bot.loop, all_threads=threads == "all")
+        try:
+            async with ctx.typing():
+                await sampler.profile(seconds)
+        finally:
+            self.sampler = None
+
+        if not sampler.samples:
+            embed = Embed(color=Color.red(), description="No samples were taken.")
+            return await ctx.send(embed=embed)
+
+        def table(rows, title):
+            lines = [f"{'Function':<46}{'Self':>7}{'Total':>7}"]
+            for function, own, total in rows:
+                name = function if len(function) <= 45 else "…" + function[-44:]
+                lines.append(
+                    f"{name:<46}{own / sampler.samples:>7.1%}{total / sampler.samples:>7.1%}"
+                )
+            embed = Embed(
+                title=title,
+                color=self.bot.main_color,
+                description="```\n" + "\n".join(lines) + "\n```",
+            )
+            embed.set_footer(
+                text=f"{sampler.samples} samples over {sampler.duration:.1f}s"
+            )
+            return embed
+
+        loop_samples = sum(sampler.coroutines.values()) or 1
+        coroutines = Embed(
+            title="Coroutines",
+            color=self.bot.main_color,
+            description="```\n"
+            + "\n".join(
+                f"{name[-50:]:<50}{count / loop_samples:>7.1%}"
+                for name, count in sampler.coroutines.most_common(15)
+            )
+            + "\n```",
+        )
+        coroutines.set_footer(text="(idle) is the loop waiting for I/O")
+
+        data = sampler.collapsed().encode()
+        await ctx.send(file=File(BytesIO(data), filename="profile.folded"))
+        session = PaginatorSession(
+            ctx,
+            table(sampler.top(), "Self Time"),
+            table(sampler.top(cumulative=True), "Total Time"),
+            coroutines,
+        )
+        await session.run()
+
+    @debug.command(name="explain")
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def debug_explain(self, ctx, number: int):
+        """
+        Shows the query plan of a slow query.
+
+        `number` is the position of the query in `{prefix}debug queries`.
+        """
+        profiler = self.bot.query_profiler
+        slowest = profiler.slowest() if profiler is not None else []
+        if not 0 < number <= len(slowest):
+            raise commands.BadArgument(f"There is no slow query number {number}.")
+
+        query = slowest[number - 1]
+        try:
+            async with ctx.typing():
+                plan = await profiler.explain(query)
+        except (ValueError, NotImplementedError) as e:
+            embed = Embed(color=Color.red(), description=str(e))
+            return await ctx.send(embed=embed)
+
+        embed = Embed(
+            title=f"{query.name}.{query.op} - {query.elapsed:.1f}ms",
+            color=self.bot.main_color,
+            description=f"```{str(query.filter)[:500]}```\n"
+            + "\n".join(plan_summary(plan))[:1400],
+        )
+        data = dumps(plan, default=str, indent=2).encode()
+        await ctx.send(embed=embed, file=File(BytesIO(data), filename="explain.json"))
+
     @commands.command(aliases=["presence"])
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     async def activity(self, ctx, activity_type: str.lower, *, message: str = ""):
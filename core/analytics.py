@@ -0,0 +1,513 @@
+"""
+Team analytics over the logs collection.
+
+Logs are loaded with a projection-only query into flat NumPy arrays, one
+entry per message (log index, timestamp, author ID, moderator flag, kind),
+and every statistic is computed with array operations:
+
+- response times: delay between the first recipient message of a log and
+  the first moderator reply after it;
+- moderator throughput: replies, threads replied to and threads closed;
+- hourly load: recipient messages per weekday and hour (UTC);
+- backlog: number of open threads at the end of each day.
+
+NumPy is an optional dependency, install it to use the `stats` command.
+
+The module can also be run as a script::
+
+    python -m core.analytics report --days 30 --csv-dir stats/
+    python -m core.analytics bench --messages 1000000
+"""
+import asyncio
+import csv
+import io
+import logging
+import math
+import os
+import time
+import typing
+from datetime import datetime, timedelta
+
+from core.logschema import expand_log
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("Modmail")
+
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+REPLY_TYPES = ("thread_message", "anonymous")
+PERCENTILES = (50, 75, 90, 99)
+TIME_UNIT = "datetime64[us]"
+
+
+def _each_message(field: str, default=None) -> dict:
+    expr = field if default is None else {"$ifNull": [field, default]}
+    return {"$map": {"input": {"$ifNull": ["$messages", []]}, "as": "m", "in": expr}}
+
+
+# One document per log with parallel arrays, both log schema versions are handled
+# by the database: version 2 authors are plain IDs and the mod flag is on the message.
+LOAD_PIPELINE_PROJECTION = {
+    "created_at": 1,
+    "closed_at": 1,
+    "closer": "$closer.id",
+    "ts": _each_message("$$m.timestamp"),
+    "author": _each_message("$$m.author.id", "$$m.author"),
+    "mod": _each_message("$$m.author.mod", {"$ifNull": ["$$m.mod", False]}),
+    "type": _each_message("$$m.type", "thread_message"),
+}
+
+LOAD_PROJECTION = {
+    "created_at": 1,
+    "closed_at": 1,
+    "closer.id": 1,
+    "participants": 1,
+    "messages.timestamp": 1,
+    "messages.author": 1,
+    "messages.mod": 1,
+    "messages.type": 1,
+}
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("NumPy is required for analytics, install it with `pip install numpy`.")
+
+
+def _dates(values: list) -> "np.ndarray":
+    """Converts stringified or native dates, missing dates become NaT."""
+    return np.array(values, dtype=TIME_UNIT)
+
+
+class LogFrame:
+    """
+    Columnar view of logs and their messages.
+
+    Attributes
+    ----------
+    created, closed : np.ndarray
+        The creation and closing dates of the logs, `closed` is NaT for open logs.
+    closer : np.ndarray
+        The ID of the moderator who closed each log, 0 for open logs.
+    log : np.ndarray
+        For each message, the index of its log.
+    ts : np.ndarray
+        The timestamp of each message.
+    author : np.ndarray
+        The author ID of each message.
+    mod : np.ndarray
+        Whether each message was sent by a moderator.
+    reply : np.ndarray
+        Whether each message is a relayed message, as opposed to notes and
+        system messages.
+    archived : int
+        The number of matching logs left out because they are archived, only
+        the first messages of their transcript are in the logs collection.
+    """
+
+    def __init__(self, created, closed, closer, log, ts, author, mod, reply, archived=0):
+        self.created = created
+        self.closed = closed
+        self.closer = closer
+        self.log = log
+        self.ts = ts
+        self.author = author
+        self.mod = mod
+        self.reply = reply
+        self.archived = archived
+
+    def __len__(self) -> int:
+        return len(self.created)
+
+    @property
+    def messages(self) -> int:
+        return len(self.ts)
+
+    @classmethod
+    def from_columns(cls, logs: typing.List[dict]) -> "LogFrame":
+        """
+        Builds the frame from per-log columns.
+
+        Each item has the `created_at`, `closed_at` and `closer` of a log and
+        the `ts`, `author`, `mod` and `type` lists of its messages.
+        """
+        _require_numpy()
+        lengths = np.array([len(log["ts"]) for log in logs], dtype=np.int64)
+        created = _dates([log.get("created_at") for log in logs])
+        closed = _dates([log.get("closed_at") for log in logs])
+        closer = np.array([int(log.get("closer") or 0) for log in logs], dtype=np.int64)
+
+        def flat(field, dtype):
+            if not logs:
+                return np.array([], dtype=dtype)
+            return np.concatenate([np.asarray(log[field], dtype=dtype) for log in logs])
+
+        ts = np.concatenate([_dates(log["ts"]) for log in logs]) if logs else _dates([])
+        types = flat("type", object)
+        return cls(
+            created=created,
+            closed=closed,
+            closer=closer,
+            log=np.repeat(np.arange(len(logs)), lengths),
+            ts=ts,
+            author=flat("author", np.int64),
+            mod=flat("mod", bool),
+            reply=np.isin(types, REPLY_TYPES),
+        )
+
+    @classmethod
+    async def load(cls, collection, query: dict) -> "LogFrame":
+        """
+        Loads the logs matching `query`.
+
+        The columns are built by the database with an aggregation pipeline,
+        backends without `aggregate` fall back to a projected `find`.
+        Archived logs are left out and counted in `archived`, their stubs
+        would skew the statistics.
+        """
+        _require_numpy()
+        archived = await collection.count_documents(dict(query, archived={"$exists": True}))
+        query = dict(query, archived={"$exists": False})
+        if hasattr(collection, "aggregate"):
+            pipeline = [{"$match": query}, {"$project": LOAD_PIPELINE_PROJECTION}]
+            docs = await collection.aggregate(pipeline, allowDiskUse=True).to_list(None)
+        else:
+            docs = []
+            async for log in collection.find(query, LOAD_PROJECTION):
+                messages = expand_log(log).get("messages") or []
+                docs.append(
+                    {
+                        "created_at": log.get("created_at"),
+                        "closed_at": log.get("closed_at"),
+                        "closer": (log.get("closer") or {}).get("id"),
+                        "ts": [m.get("timestamp") for m in messages],
+                        "author": [m["author"]["id"] for m in messages],
+                        "mod": [m["author"]["mod"] for m in messages],
+                        "type": [m.get("type", "thread_message") for m in messages],
+                    }
+                )
+        frame = await asyncio.get_event_loop().run_in_executor(None, cls.from_columns, docs)
+        frame.archived = archived
+        return frame
+
+
+# Statistics
+
+
+def response_times(frame: LogFrame) -> "np.ndarray":
+    """
+    Returns the first response time of each log, in seconds.
+
+    Logs without a recipient message or without a reply after it are NaN.
+    """
+    count = len(frame)
+    valid = frame.reply & ~np.isnat(frame.ts)
+    recipient = valid & ~frame.mod
+    first_message = np.full(count, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_message, frame.log[recipient], frame.ts[recipient].astype(np.int64))
+
+    replies = valid & frame.mod
+    replies &= frame.ts.astype(np.int64) > first_message[frame.log]
+    first_reply = np.full(count, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_reply, frame.log[replies], frame.ts[replies].astype(np.int64))
+
+    answered = first_reply != np.iinfo(np.int64).max
+    result = np.full(count, np.nan)
+    result[answered] = (first_reply[answered] - first_message[answered]) / 1e6
+    return result
+
+
+def moderator_throughput(frame: LogFrame) -> typing.List[dict]:
+    """
+    Returns the activity of each moderator, sorted by replies.
+
+    Each row has the moderator `id`, the number of `replies`, of `threads`
+    replied to, of threads `closed` and of `active_days`.
+    """
+    replies = frame.reply & frame.mod & ~np.isnat(frame.ts)
+    authors = frame.author[replies]
+    ids, counts = np.unique(authors, return_counts=True)
+
+    pairs = np.unique(np.stack([authors, frame.log[replies]]), axis=1)
+    _, threads = np.unique(pairs[0], return_counts=True)
+
+    days = frame.ts[replies].astype("datetime64[D]").astype(np.int64)
+    active = np.unique(np.stack([authors, days]), axis=1)
+    _, active_days = np.unique(active[0], return_counts=True)
+
+    closers, closed = np.unique(frame.closer[frame.closer != 0], return_counts=True)
+    closed_by = dict(zip(closers.tolist(), closed.tolist()))
+
+    rows = [
+        {
+            "id": mod_id,
+            "replies": count,
+            "threads": thread_count,
+            "closed": closed_by.pop(mod_id, 0),
+            "active_days": day_count,
+        }
+        for mod_id, count, thread_count, day_count in zip(
+            ids.tolist(), counts.tolist(), threads.tolist(), active_days.tolist()
+        )
+    ]
+    # Moderators who closed threads without replying
+    rows += [
+        {"id": mod_id, "replies": 0, "threads": 0, "closed": count, "active_days": 0}
+        for mod_id, count in closed_by.items()
+    ]
+    rows.sort(key=lambda row: (row["replies"], row["closed"]), reverse=True)
+    return rows
+
+
+def hourly_heatmap(frame: LogFrame) -> "np.ndarray":
+    """Returns the number of recipient messages per weekday (rows, Monday first) and hour."""
+    ts = frame.ts[frame.reply & ~frame.mod & ~np.isnat(frame.ts)]
+    days = ts.astype("datetime64[D]")
+    weekday = (days.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+    hour = (ts.astype("datetime64[h]") - days).astype(np.int64)
+    grid = np.zeros((7, 24), dtype=np.int64)
+    np.add.at(grid, (weekday, hour), 1)
+    return grid
+
+
+def backlog(frame: LogFrame) -> typing.Tuple["np.ndarray", "np.ndarray"]:
+    """
+    Returns the days and the number of threads still open at the end of each day.
+    """
+    valid = ~np.isnat(frame.created)
+    if not valid.any():
+        return np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64)
+    opened = frame.created[valid].astype("datetime64[D]")
+    closed = frame.closed[valid].astype("datetime64[D]")
+    start = opened.min()
+    end = max(np.datetime64(datetime.utcnow().date()), opened.max())
+    span = int((end - start).astype(np.int64)) + 1
+
+    delta = np.bincount((opened - start).astype(np.int64), minlength=span)
+    is_closed = ~np.isnat(closed)
+    delta -= np.bincount((closed[is_closed] - start).astype(np.int64), minlength=span)[:span]
+    days = start + np.arange(span)
+    return days, np.cumsum(delta)
+
+
+class TeamReport:
+    """
+    The statistics of a `LogFrame`.
+
+    Attributes
+    ----------
+    logs, messages : int
+        The number of logs and messages covered.
+    archived : int
+        The number of archived logs left out.
+    response : np.ndarray
+        The first response time of each log, in seconds.
+    percentiles : Dict[int, float]
+        Response time percentiles, in seconds.
+    moderators : List[dict]
+        See `moderator_throughput`.
+    heatmap : np.ndarray
+        See `hourly_heatmap`.
+    backlog_days, backlog : np.ndarray
+        See `backlog`.
+    elapsed : float
+        The time spent computing the report, in seconds.
+    """
+
+    def __init__(self, frame: LogFrame):
+        started = time.perf_counter()
+        self.logs = len(frame)
+        self.messages = frame.messages
+        self.archived = frame.archived
+        self.response = response_times(frame)
+        answered = self.response[~np.isnan(self.response)]
+        self.answered = len(answered)
+        self.percentiles = {
+            p: float(v)
+            for p, v in zip(
+                PERCENTILES,
+                np.percentile(answered, PERCENTILES) if len(answered) else [float("nan")] * 4,
+            )
+        }
+        self.moderators = moderator_throughput(frame)
+        self.heatmap = hourly_heatmap(frame)
+        self.backlog_days, self.backlog = backlog(frame)
+        self.elapsed = time.perf_counter() - started
+
+    # CSV
+
+    def csv_files(self) -> typing.Dict[str, str]:
+        """Returns the report as CSV documents, keyed by file name."""
+        files = {}
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["moderator_id", "replies", "threads", "closed", "active_days"])
+        for row in self.moderators:
+            writer.writerow(
+                [row["id"], row["replies"], row["threads"], row["closed"], row["active_days"]]
+            )
+        files["moderators.csv"] = out.getvalue()
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["weekday"] + [f"{h:02d}h" for h in range(24)])
+        for day, counts in zip(WEEKDAYS, self.heatmap.tolist()):
+            writer.writerow([day] + counts)
+        files["hourly_load.csv"] = out.getvalue()
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["day", "open_threads"])
+        writer.writerows(zip(self.backlog_days.astype(str).tolist(), self.backlog.tolist()))
+        files["backlog.csv"] = out.getvalue()
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["percentile", "first_response_seconds"])
+        writer.writerows(self.percentiles.items())
+        files["response_times.csv"] = out.getvalue()
+        return files
+
+    # Text
+
+    def format_heatmap(self) -> str:
+        shades = " ░▒▓█"
+        peak = self.heatmap.max() or 1
+        levels = np.ceil(self.heatmap / peak * (len(shades) - 1)).astype(int)
+        lines = ["    " + "".join(str(h // 10) if h % 6 == 0 else " " for h in range(24))]
+        lines.append("    " + "".join(str(h % 10) if h % 6 == 0 else " " for h in range(24)))
+        for day, row in zip(WEEKDAYS, levels.tolist()):
+            lines.append(day + " " + "".join(shades[level] for level in row))
+        return "\n".join(lines)
+
+    def format_backlog(self, points: int = 30) -> str:
+        if self.backlog.size == 0:
+            return "No threads."
+        # Weekly points when the range is long
+        step = max(1, len(self.backlog) // points)
+        days = self.backlog_days[::-step][::-1]
+        values = self.backlog[::-step][::-1]
+        peak = values.max() or 1
+        width = 20
+        return "\n".join(
+            f"{day} {'█' * int(round(value / peak * width)):<{width}} {value}"
+            for day, value in zip(days.astype(str).tolist(), values.tolist())
+        )
+
+
+def format_duration(seconds: float) -> str:
+    if math.isnan(seconds):
+        return "n/a"
+    return str(timedelta(seconds=int(seconds)))
+
+
+def build_query(guild_id=None, days: int = None) -> dict:
+    query = {}
+    if guild_id is not None:
+        query["guild_id"] = str(guild_id)
+    if days:
+        query["created_at"] = {"$gte": str(datetime.utcnow() - timedelta(days=days))}
+    return query
+
+
+def synthetic_frame(messages: int, logs: int = None, seed: int = 0) -> LogFrame:
+    """Generates a random frame, for benchmarks."""
+    _require_numpy()
+    rng = np.random.default_rng(seed)
+    logs = logs or max(1, messages // 50)
+    now = np.datetime64(datetime.utcnow(), "us")
+    created = now - rng.integers(0, 365 * 86400 * 10 ** 6, logs).astype("timedelta64[us]")
+    closed = created + rng.integers(3600, 7 * 86400, logs).astype("timedelta64[s]")
+    closed[rng.random(logs) < 0.02] = np.datetime64("NaT")
+    mods = rng.integers(10 ** 17, 10 ** 18, 12)
+    log = np.sort(rng.integers(0, logs, messages))
+    ts = created[log] + rng.integers(0, 86400 * 10 ** 6, messages).astype("timedelta64[us]")
+    mod = rng.random(messages) < 0.5
+    author = np.where(mod, mods[rng.integers(0, len(mods), messages)], 1 + log)
+    closer = np.where(np.isnat(closed), 0, mods[rng.integers(0, len(mods), logs)])
+    return LogFrame(created, closed, closer, log, ts, author, mod, rng.random(messages) < 0.95)
+
+
+def main() -> None:
+    import argparse
+
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Modmail team analytics.")
+    parser.add_argument("action", choices=["report", "bench"])
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--guild-id", default=os.getenv("GUILD_ID"))
+    parser.add_argument("--days", type=int, default=None)
+    parser.add_argument("--csv-dir", default=None)
+    parser.add_argument("--messages", type=int, default=1000000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    _require_numpy()
+
+    if args.action == "bench":
+        started = time.perf_counter()
+        frame = synthetic_frame(args.messages)
+        logger.info(
+            "Generated %d messages in %d logs (%.2fs).",
+            frame.messages,
+            len(frame),
+            time.perf_counter() - started,
+        )
+    else:
+        storage = StorageBackend.from_config(
+            {
+                "database_type": args.database_type,
+                "mongo_uri": args.mongo_uri,
+                "sqlite_path": args.sqlite_path,
+            },
+            "temp",
+        )
+        started = time.perf_counter()
+        query = build_query(args.guild_id, args.days)
+        frame = asyncio.get_event_loop().run_until_complete(
+            LogFrame.load(storage.read_db.logs, query)
+        )
+        storage.close()
+        logger.info(
+            "Loaded %d messages in %d logs (%.2fs).",
+            frame.messages,
+            len(frame),
+            time.perf_counter() - started,
+        )
+
+    report = TeamReport(frame)
+    logger.info("Computed the report in %.3fs.", report.elapsed)
+    if report.archived:
+        logger.warning("%d archived logs are not included in the report.", report.archived)
+    print(f"First response ({report.answered} answered threads):")
+    for p, value in report.percentiles.items():
+        print(f"  p{p}: {format_duration(value)}")
+    print()
+    print("Moderators (id, replies, threads, closed, active days):")
+    for row in report.moderators[:15]:
+        print(
+            f"  {row['id']}: {row['replies']}, {row['threads']}, "
+            f"{row['closed']}, {row['active_days']}"
+        )
+    print()
+    print(report.format_heatmap())
+    print()
+    print(report.format_backlog())
+
+    if args.csv_dir:
+        os.makedirs(args.csv_dir, exist_ok=True)
+        for name, content in report.csv_files().items():
+            with open(os.path.join(args.csv_dir, name), "w", encoding="utf-8", newline="") as f:
+                f.write(content)
+        logger.info("CSV files written to %s.", args.csv_dir)
+
+
+if __name__ == "__main__":
+    main()
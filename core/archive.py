@@ -0,0 +1,341 @@
+"""
+Hot/cold tiering of closed logs.
+
+Closed logs older than `archive_after` days are moved out of the `logs`
+collection into compressed, append-only archive segments. A segment holds
+up to `SEGMENT_LOGS` logs sorted by key and split in blocks of
+`BLOCK_LOGS` logs, each block is a compressed JSONL chunk. The sparse
+index of a segment keeps the first key of each block, so fetching a log
+decompresses a single block.
+
+The archived log stays in the `logs` collection as a stub: every field but
+the messages, of which only the first few are kept for previews, and an
+`archived` field pointing to its segment. Listings keep working from the
+stubs and `ArchiveStore.fetch` restores the whole log when needed.
+
+Segments are stored either on disk (``archive_storage=disk``, the default)
+or in the `logs_archive` collection (``archive_storage=collection``).
+"""
+import asyncio
+import bisect
+import json
+import logging
+import lzma
+import os
+import typing
+import zlib
+from datetime import datetime, timedelta
+
+from core.storage import dumps, loads
+from core.summary import summarize_log
+
+logger = logging.getLogger("Modmail")
+
+SEGMENT_LOGS = 4096
+BLOCK_LOGS = 64
+PREVIEW_MESSAGES = 5
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def _compress_block(logs: typing.List[dict], codec: str) -> bytes:
+    data = "\n".join(dumps(log) for log in logs).encode("utf-8")
+    return CODECS[codec][0](data)
+
+
+def _decompress_block(data: bytes, codec: str) -> typing.List[dict]:
+    return [loads(line) for line in CODECS[codec][1](data).decode("utf-8").splitlines()]
+
+
+class DiskSegments:
+    """
+    Archive segments stored as files.
+
+    ``<id>.seg`` is the concatenation of the compressed blocks, ``<id>.idx``
+    the JSON segment header with the sparse index of ``(first key, offset,
+    length)`` triples.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _write_sync(self, header: dict, blocks: typing.List[bytes]) -> None:
+        base = os.path.join(self.path, header["_id"])
+        offset = 0
+        with open(base + ".seg.tmp", "wb") as f:
+            for entry, block in zip(header["index"], blocks):
+                entry.extend([offset, len(block)])
+                f.write(block)
+                offset += len(block)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(base + ".idx.tmp", "w", encoding="utf-8") as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(base + ".seg.tmp", base + ".seg")
+        os.replace(base + ".idx.tmp", base + ".idx")
+
+    def _read_sync(self, segment_id: str, entry: list) -> bytes:
+        with open(os.path.join(self.path, segment_id + ".seg"), "rb") as f:
+            f.seek(entry[1])
+            return f.read(entry[2])
+
+    def _headers_sync(self) -> typing.List[dict]:
+        headers = []
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith(".idx"):
+                with open(os.path.join(self.path, name), encoding="utf-8") as f:
+                    headers.append(json.load(f))
+        return headers
+
+    def _delete_sync(self, segment_id: str) -> None:
+        for ext in (".idx", ".seg"):
+            try:
+                os.remove(os.path.join(self.path, segment_id + ext))
+            except FileNotFoundError:
+                pass
+
+    async def write(self, header: dict, blocks: typing.List[bytes]) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._write_sync, header, blocks)
+
+    async def read(self, header: dict, block: int) -> bytes:
+        entry = header["index"][block]
+        return await asyncio.get_event_loop().run_in_executor(
+            None, self._read_sync, header["_id"], entry
+        )
+
+    async def headers(self) -> typing.List[dict]:
+        return await asyncio.get_event_loop().run_in_executor(None, self._headers_sync)
+
+    async def delete(self, segment_id: str) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._delete_sync, segment_id)
+
+
+class CollectionSegments:
+    """
+    Archive segments stored in a collection.
+
+    The segment header is a document of its own, each block is stored as a
+    ``<segment id>:<block number>`` document to stay under the BSON size limit.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def write(self, header: dict, blocks: typing.List[bytes]) -> None:
+        for n, block in enumerate(blocks):
+            await self.collection.replace_one(
+                {"_id": f"{header['_id']}:{n}"},
+                {"_id": f"{header['_id']}:{n}", "segment": header["_id"], "data": block},
+                upsert=True,
+            )
+        # The header goes last, a segment without one is ignored
+        await self.collection.replace_one(
+            {"_id": header["_id"]}, dict(header, header=True), upsert=True
+        )
+
+    async def read(self, header: dict, block: int) -> bytes:
+        doc = await self.collection.find_one({"_id": f"{header['_id']}:{block}"})
+        return bytes(doc["data"])
+
+    async def headers(self) -> typing.List[dict]:
+        return await self.collection.find({"header": True}).sort("_id", 1).to_list(None)
+
+    async def delete(self, segment_id: str) -> None:
+        await self.collection.delete_one({"_id": segment_id})
+        await self.collection.delete_many({"segment": segment_id})
+
+
+class ArchiveStore:
+    """
+    Moves old closed logs to archive segments and reads them back.
+
+    Parameters
+    ----------
+    logs : AsyncIOMotorCollection
+        The logs collection.
+    segments : Union[DiskSegments, CollectionSegments]
+        Where the segments are stored.
+    archive_after : int
+        The age, in days, after which closed logs are archived.
+    purge_after : int, optional
+        The age, in days, after which archived logs are deleted.
+        Logs are never deleted by default.
+    codec : str, optional
+        ``zlib`` (default) or ``lzma``.
+    """
+
+    def __init__(
+        self,
+        logs,
+        segments,
+        archive_after: int,
+        purge_after: int = None,
+        codec: str = "zlib",
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"Invalid archive codec {codec}, use zlib or lzma.")
+        self.logs = logs
+        self.segments = segments
+        self.archive_after = archive_after
+        self.purge_after = purge_after
+        self.codec = codec
+        self._headers = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, config, db, data_dir: str) -> typing.Optional["ArchiveStore"]:
+        """Creates the archive store, or returns `None` if `archive_after` is not set."""
+        archive_after = config.get("archive_after")
+        if not archive_after:
+            return None
+        if str(config.get("archive_storage") or "disk").lower() == "collection":
+            segments = CollectionSegments(db.logs_archive)
+        else:
+            segments = DiskSegments(os.path.join(data_dir, "archive"))
+        purge_after = config.get("archive_purge_after")
+        return cls(
+            db.logs,
+            segments,
+            int(archive_after),
+            int(purge_after) if purge_after else None,
+            str(config.get("archive_codec") or "zlib").lower(),
+        )
+
+    async def headers(self) -> typing.Dict[str, dict]:
+        if self._headers is None:
+            self._headers = {h["_id"]: h for h in await self.segments.headers()}
+        return self._headers
+
+    # Reads
+
+    async def fetch(self, stub: dict) -> typing.Optional[dict]:
+        """
+        Returns the archived log of a stub, with all of its messages.
+
+        Parameters
+        ----------
+        stub : Dict[str, Any]
+            The log stub, as found in the logs collection.
+        """
+        header = (await self.headers()).get(stub["archived"]["segment"])
+        if header is None:
+            logger.error("Archive segment of log %s is missing.", stub["key"])
+            return None
+        keys = [entry[0] for entry in header["index"]]
+        block = bisect.bisect_right(keys, stub["key"]) - 1
+        if block < 0:
+            return None
+        data = await self.segments.read(header, block)
+        for log in _decompress_block(data, header["codec"]):
+            if log["key"] == stub["key"]:
+                return log
+        return None
+
+    # Tiering
+
+    def _cutoff(self, days: int) -> str:
+        return str(datetime.utcnow() - timedelta(days=days))
+
+    async def archive(self, limit: int = SEGMENT_LOGS) -> int:
+        """
+        Moves up to `limit` old closed logs into a new segment.
+
+        Returns the number of archived logs.
+        """
+        async with self._lock:
+            query = {
+                "open": False,
+                "archived": {"$exists": False},
+                "closed_at": {"$lt": self._cutoff(self.archive_after)},
+            }
+            logs = await self.logs.find(query).sort("closed_at", 1).to_list(limit)
+            if not logs:
+                return 0
+
+            logs.sort(key=lambda log: log["key"])
+            for log in logs:
+                # Summaries can't be computed from the stubs
+                if "summary" not in log:
+                    log["summary"] = summarize_log(log)
+            segment_id = f"{datetime.utcnow():%Y%m%d%H%M%S}-{logs[0]['key']}"
+            blocks, index = [], []
+            for i in range(0, len(logs), BLOCK_LOGS):
+                chunk = logs[i : i + BLOCK_LOGS]
+                blocks.append(_compress_block(chunk, self.codec))
+                index.append([chunk[0]["key"]])
+            header = {
+                "_id": segment_id,
+                "codec": self.codec,
+                "count": len(logs),
+                "closed_before": max(str(log.get("closed_at")) for log in logs),
+                "index": index,
+            }
+            # The segment must be durable before the messages leave the logs collection
+            await self.segments.write(header, blocks)
+            (await self.headers())[segment_id] = header
+
+            for log in logs:
+                await self.logs.update_one(
+                    {"_id": log["_id"], "archived": {"$exists": False}},
+                    {
+                        "$set": {
+                            "messages": log.get("messages", [])[:PREVIEW_MESSAGES],
+                            "summary": log["summary"],
+                            "archived": {
+                                "segment": segment_id,
+                                "messages": len(log.get("messages", [])),
+                            },
+                        }
+                    },
+                )
+            size = sum(len(b) for b in blocks)
+            logger.info(
+                "Archived %d logs in segment %s (%.1f KiB).", len(logs), segment_id, size / 1024
+            )
+            return len(logs)
+
+    async def purge(self, batch_size: int = 100, interval: float = 1.0) -> typing.List[str]:
+        """
+        Deletes the archived logs older than `purge_after` days.
+
+        Stubs are deleted in batches of `batch_size`, `interval` seconds apart,
+        segments once all of their logs are past the cutoff.
+        Returns the keys of the deleted logs.
+        """
+        if not self.purge_after:
+            return []
+        cutoff = self._cutoff(self.purge_after)
+        query = {"archived": {"$exists": True}, "closed_at": {"$lt": cutoff}}
+        deleted = []
+        while True:
+            stubs = await self.logs.find(query, {"key": 1}).to_list(batch_size)
+            if not stubs:
+                break
+            keys = [stub["key"] for stub in stubs]
+            await self.logs.delete_many({"key": {"$in": keys}})
+            deleted.extend(keys)
+            await asyncio.sleep(interval)
+
+        for segment_id, header in list((await self.headers()).items()):
+            if header["closed_before"] < cutoff:
+                await self.segments.delete(segment_id)
+                del self._headers[segment_id]
+                logger.info("Purged archive segment %s.", segment_id)
+        if deleted:
+            logger.info("Purged %d archived logs.", len(deleted))
+        return deleted
+
+    async def archive_all(self) -> int:
+        """Archives every log past the cutoff, one segment at a time."""
+        total = 0
+        while True:
+            count = await self.archive()
+            total += count
+            if count < SEGMENT_LOGS:
+                return total
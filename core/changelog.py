@@ -4,6 +4,8 @@ from typing import List
 
 from discord import Embed, Color
 
+from core.clients import RequestClient
+
 
 class Version:
     """
@@ -108,6 +110,9 @@ class Changelog:
         The URL to Modmail changelog directly from in GitHub.
     VERSION_REGEX : re.Pattern
         The regex used to parse the versions.
+    CACHE_MAX_AGE : int
+        The number of seconds the cached changelog is used without
+        checking for a new one.
     """
 
     RAW_CHANGELOG_URL = (
@@ -115,6 +120,7 @@ class Changelog:
     )
     CHANGELOG_URL = "https://github.com/kyb3r/modmail/blob/master/CHANGELOG.md"
     VERSION_REGEX = re.compile(r"# (v\d+\.\d+\.\d+)([\S\s]*?(?=# v|$))")
+    CACHE_MAX_AGE = 60 * 60
 
     def __init__(self, bot, text: str):
         self.bot = bot
@@ -154,5 +160,5 @@ class Changelog:
             The newly created `Changelog` parsed from the `url`.
         """
         url = url or cls.RAW_CHANGELOG_URL
-        resp = await bot.session.get(url)
-        return cls(bot, await resp.text())
+        text = await RequestClient(bot).request(url, cache=True, max_age=cls.CACHE_MAX_AGE)
+        return cls(bot, text)
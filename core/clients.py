@@ -1,15 +1,30 @@
+import asyncio
+import functools
+import json
 import os
 import logging
+import random
 import secrets
+import time
 from datetime import datetime
-from json import JSONDecodeError
-from typing import Union, Optional
+from typing import Iterable, Union, Optional
+from urllib.parse import urlsplit
 
 from discord import Member, DMChannel, TextChannel, Message
 from discord.ext import commands
 
-from aiohttp import ClientResponseError, ClientResponse
-
+from aiohttp import (
+    ClientConnectionError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+)
+
+from core.journal import TRANSIENT_ERRORS
+from core.logschema import SCHEMA_VERSION, compact_author, expand_log, message_update
+from core.search import rebuild_index
+from core.summary import SUMMARY_PROJECTION, SummaryBuilder, summarize_log
 from core.utils import info
 
 logger = logging.getLogger("Modmail")
@@ -18,6 +33,33 @@ prefix = os.getenv("LOG_URL_PREFIX", "/logs")
 if prefix == "NONE":
     prefix = ""
 
+# HTTP client tuning, timeouts are in seconds.
+HTTP_POOL_SIZE = 100
+HTTP_HOST_POOL_SIZE = 10
+HTTP_DNS_CACHE_TTL = 300
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 2
+HTTP_RETRY_BASE_DELAY = 0.5
+HTTP_RETRY_MAX_DELAY = 10
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def create_session(loop=None) -> ClientSession:
+    """
+    Creates the bot's HTTP session, connections and DNS lookups are pooled
+    and reused across requests.
+    """
+    connector = TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=HTTP_HOST_POOL_SIZE,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        loop=loop,
+    )
+    timeout = ClientTimeout(total=5 * 60, connect=HTTP_CONNECT_TIMEOUT)
+    return ClientSession(loop=loop, connector=connector, timeout=timeout)
+
 
 class RequestClient:
     """
@@ -43,6 +85,35 @@ class RequestClient:
         self.session = bot.session
         self.headers: dict = None
 
+    def _record(self, url: str, method: str, status: str, started: float) -> None:
+        """Records an attempt, until the response headers, in the metrics."""
+        host = urlsplit(url).netloc
+        self.bot.metrics.http_requests.labels("external", host, method, status).inc()
+        self.bot.metrics.http_seconds.labels("external", method).observe(
+            time.perf_counter() - started
+        )
+
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: str = None) -> float:
+        """Exponential backoff with jitter, `Retry-After` is honoured when sent."""
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), HTTP_RETRY_MAX_DELAY)
+            except ValueError:
+                pass
+        delay = min(HTTP_RETRY_BASE_DELAY * 2 ** attempt, HTTP_RETRY_MAX_DELAY)
+        return delay * random.uniform(0.5, 1.5)
+
+    @staticmethod
+    def _decode(body: bytes, content_type: str) -> Union[dict, list, str]:
+        text = body.decode("utf-8", errors="replace")
+        if "json" in content_type:
+            try:
+                return json.loads(text)
+            except ValueError:
+                pass
+        return text
+
     async def request(
         self,
         url: str,
@@ -50,10 +121,17 @@ class RequestClient:
         payload: dict = None,
         return_response: bool = False,
         headers: dict = None,
+        timeout: float = HTTP_TIMEOUT,
+        retries: int = None,
+        cache: bool = False,
+        max_age: float = 0,
     ) -> Union[ClientResponse, dict, str]:
         """
         Makes a HTTP request.
 
+        Connection errors, timeouts, 429 and 5xx responses are retried with
+        a jittered exponential backoff.
+
         Parameters
         ----------
         url : str
@@ -66,6 +144,18 @@ class RequestClient:
             Whether the `ClientResponse` object should be returned.
         headers : Dict[str, str]
             Additional headers to `headers`.
+        timeout : float
+            The total timeout of each attempt, in seconds.
+        retries : int, optional
+            The number of retries, defaults to 2 for idempotent methods
+            and 0 for the others.
+        cache : bool
+            Whether the response of a GET request is cached on disk and
+            revalidated with `ETag` and `Last-Modified`. The cached
+            response is returned when the server can't be reached.
+        max_age : float
+            With `cache`, the number of seconds during which a cached
+            response is used without revalidation.
 
         Returns
         -------
@@ -76,19 +166,74 @@ class RequestClient:
             `str` if the returned data is not a valid json data,
             the raw response.
         """
-        if headers is not None:
-            headers.update(self.headers)
+        method = method.upper()
+        headers = {**(self.headers or {}), **(headers or {})}
+        if retries is None:
+            retries = HTTP_RETRIES if method in IDEMPOTENT_METHODS else 0
+
+        http_cache = None
+        cached = None
+        if cache and method == "GET" and not return_response:
+            http_cache = self.bot.http_cache
+            cached = await self.bot.loop.run_in_executor(None, http_cache.get, url, headers)
+        if cached is not None:
+            if max_age and time.time() - cached.fetched_at < max_age:
+                return self._decode(cached.body, cached.content_type)
+            validators = {}
+            if cached.etag:
+                validators["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                validators["If-Modified-Since"] = cached.last_modified
+            request_headers = {**headers, **validators}
         else:
-            headers = self.headers
-        async with self.session.request(
-            method, url, headers=headers, json=payload
-        ) as resp:
-            if return_response:
-                return resp
+            request_headers = headers
+
+        for attempt in range(retries + 1):
+            started = time.perf_counter()
             try:
-                return await resp.json()
-            except (JSONDecodeError, ClientResponseError):
-                return await resp.text()
+                async with self.session.request(
+                    method,
+                    url,
+                    headers=request_headers,
+                    json=payload,
+                    timeout=ClientTimeout(total=timeout),
+                ) as resp:
+                    self._record(url, method, str(resp.status), started)
+                    if resp.status in RETRY_STATUSES and attempt < retries:
+                        delay = self._retry_delay(attempt, resp.headers.get("Retry-After"))
+                        logger.debug(
+                            "%s %s: %d, retrying in %.1fs.", method, url, resp.status, delay
+                        )
+                        await asyncio.sleep(delay)
+                        continue
+                    if return_response:
+                        return resp
+                    if resp.status == 304 and cached is not None:
+                        await self.bot.loop.run_in_executor(None, http_cache.touch, url, headers)
+                        return self._decode(cached.body, cached.content_type)
+                    if resp.status >= 500 and cached is not None:
+                        logger.warning(
+                            "%s responded %d, using the cached response.", url, resp.status
+                        )
+                        return self._decode(cached.body, cached.content_type)
+
+                    body = await resp.read()
+                    if http_cache is not None and resp.status == 200:
+                        await self.bot.loop.run_in_executor(
+                            None, http_cache.store, url, headers, resp.headers, body
+                        )
+                    return self._decode(body, resp.headers.get("Content-Type", ""))
+            except (ClientConnectionError, asyncio.TimeoutError) as e:
+                self._record(url, method, "error", started)
+                if attempt < retries:
+                    delay = self._retry_delay(attempt)
+                    logger.debug("%s %s failed (%r), retrying in %.1fs.", method, url, e, delay)
+                    await asyncio.sleep(delay)
+                    continue
+                if cached is None:
+                    raise
+                logger.warning("%s is unreachable (%r), using the cached response.", url, e)
+                return self._decode(cached.body, cached.content_type)
 
     def filter_valid(self, data):
         """
@@ -190,7 +335,7 @@ class GitHub(RequestClient):
             raise commands.CommandInvokeError("Username not found.")
 
         if sha is None:
-            resp: dict = await self.request(self.HEAD)
+            resp: dict = await self.request(self.HEAD, cache=True)
             sha = resp["object"]["sha"]
 
         payload = {"base": "master", "head": sha, "commit_message": "Updating bot"}
@@ -242,7 +387,7 @@ class GitHub(RequestClient):
             The newly created `GitHub` object.
         """
         self = cls(bot, bot.config.get("github_access_token"))
-        resp: dict = await self.request("https://api.github.com/user")
+        resp: dict = await self.request(cls.BASE + "/user", cache=True)
         self.username: str = resp["login"]
         self.avatar_url: str = resp["avatar_url"]
         self.url: str = resp["html_url"]
@@ -250,9 +395,99 @@ class GitHub(RequestClient):
         return self
 
 
+# The fields of open logs kept in memory, the first message is the preview.
+LOG_METADATA_PROJECTION = {
+    "key": 1,
+    "channel_id": 1,
+    "recipient": 1,
+    "created_at": 1,
+    "open": 1,
+    "messages": {"$slice": 1},
+}
+
+
+class OpenLogCache:
+    """
+    Metadata of the open logs, keyed by channel ID.
+
+    Entries are dicts with the `key`, `channel_id`, `recipient` and
+    `created_at` of the log, and the `preview` (content) and `preview_id`
+    (message ID) of its first message, which are `None` until a message is
+    logged. Logs created by this process also keep a `SummaryBuilder` in
+    `summary`, it is `None` for logs loaded from the database.
+    """
+
+    def __init__(self):
+        self._logs = {}
+
+    def __len__(self) -> int:
+        return len(self._logs)
+
+    def __iter__(self):
+        return iter(list(self._logs.values()))
+
+    def get(self, channel_id: Union[str, int]) -> Optional[dict]:
+        return self._logs.get(str(channel_id))
+
+    def add(self, doc: dict, new: bool = False) -> dict:
+        """
+        Caches a log document, only the `LOG_METADATA_PROJECTION` fields are used.
+
+        `new` is set for logs without messages, created by this process.
+        """
+        messages = doc.get("messages") or [None]
+        first = messages[0] or {}
+        entry = {
+            "key": doc["key"],
+            "channel_id": str(doc["channel_id"]),
+            "recipient": doc.get("recipient"),
+            "created_at": doc.get("created_at"),
+            "preview": first.get("content"),
+            "preview_id": first.get("message_id"),
+            "summary": SummaryBuilder(doc.get("created_at")) if new else None,
+        }
+        self._logs[entry["channel_id"]] = entry
+        return entry
+
+    def merge(self, docs: list) -> None:
+        """
+        Caches the log documents `docs`, loaded from the database.
+
+        Cached entries missing from `docs` are kept, their insert may still
+        be journaled. The summaries and previews of cached logs are kept too.
+        """
+        for doc in docs:
+            cached = self.get(doc["channel_id"])
+            entry = self.add(doc)
+            if cached is None:
+                continue
+            entry["summary"] = cached["summary"]
+            if entry["preview_id"] is None:
+                entry["preview"] = cached["preview"]
+                entry["preview_id"] = cached["preview_id"]
+
+    def pop(self, channel_id: Union[str, int]) -> Optional[dict]:
+        return self._logs.pop(str(channel_id), None)
+
+    def message_logged(self, channel_id: Union[str, int], message: dict) -> None:
+        entry = self.get(channel_id)
+        if entry is not None and entry["summary"] is not None:
+            entry["summary"].add(message)
+        if entry is not None and entry["preview_id"] is None:
+            entry["preview"] = message["content"]
+            entry["preview_id"] = message["message_id"]
+
+    def message_edited(self, message_id: str, content: str) -> None:
+        for entry in self._logs.values():
+            if entry["preview_id"] == message_id:
+                entry["preview"] = content
+                break
+
+
 class ApiClient(RequestClient):
     def __init__(self, bot):
         super().__init__(bot)
+        self.open_logs = OpenLogCache()
         if self.token:
             self.headers = {"Authorization": "Bearer " + self.token}
 
@@ -268,54 +503,130 @@ class ApiClient(RequestClient):
     def logs(self):
         return self.db.logs
 
+    @property
+    def read_logs(self):
+        """The logs collection used for heavy reads, possibly served by a secondary."""
+        return self.bot.storage.read_db.logs
+
+    async def _write(self, collection: str, op: str, *args, wait: float = None, **kwargs):
+        """
+        Runs a write operation on `collection`, through the write journal if enabled.
+
+        Journaled writes return `None` once they are durable, unless `wait` is
+        set, then the result is awaited for up to `wait` seconds.
+        Operations must be idempotent so they can be replayed.
+        """
+        journal = self.bot.journal
+        if journal is None:
+            method = getattr(self.bot.storage.relay_db[collection], op)
+            return await method(*args, **kwargs)
+
+        seq = await journal.append(collection, op, *args, **kwargs)
+        if wait is None:
+            return None
+        try:
+            return await journal.wait_applied(seq, wait)
+        except asyncio.TimeoutError:
+            logger.warning("Journaled %s on %s is not applied yet.", op, collection)
+            return None
+
+    @property
+    def search_index(self):
+        return self.bot.search_index
+
     async def get_user_logs(self, user_id: Union[str, int]) -> list:
         query = {"recipient.id": str(user_id), "guild_id": str(self.bot.guild_id)}
 
         projection = {"messages": {"$slice": 5}}
-        return await self.logs.find(query, projection).to_list(None)
+        logs = await self.read_logs.find(query, projection).to_list(None)
+        return [expand_log(log) for log in logs]
+
+    async def get_latest_user_logs(self, user_id: Union[str, int]) -> Optional[dict]:
+        query = {"recipient.id": str(user_id), "guild_id": str(self.bot.guild_id), "open": False}
+        projection = {"messages": 0}
+        logs = await self.read_logs.find(query, projection).sort("closed_at", -1).to_list(1)
+        return expand_log(logs[0]) if logs else None
+
+    async def get_closed_by_logs(self, user_id: Union[str, int]) -> list:
+        query = {"guild_id": str(self.bot.guild_id), "open": False, "closer.id": str(user_id)}
+
+        projection = {"messages": {"$slice": 5}}
+        logs = await self.read_logs.find(query, projection).to_list(None)
+        return [expand_log(log) for log in logs]
+
+    async def get_open_logs(self) -> list:
+        """Loads the metadata of the open logs into `open_logs` and returns it."""
+        query = {"open": True}
+        docs = await self.logs.find(query, LOG_METADATA_PROJECTION).to_list(None)
+        self.open_logs.merge(docs)
+        return list(self.open_logs)
 
     async def get_log(self, channel_id: Union[str, int]) -> dict:
-        return await self.logs.find_one({"channel_id": str(channel_id)})
+        doc = await self.logs.find_one({"channel_id": str(channel_id)})
+        if doc is not None and "archived" in doc and self.bot.archive is not None:
+            # Only a stub is left in the logs collection
+            doc = await self.bot.archive.fetch(doc) or doc
+        return expand_log(doc)
+
+    async def get_log_metadata(self, channel_id: Union[str, int]) -> Optional[dict]:
+        """Returns the `OpenLogCache` entry of a log, without fetching its messages."""
+        entry = self.open_logs.get(channel_id)
+        if entry is not None:
+            return entry
+        doc = await self.logs.find_one({"channel_id": str(channel_id)}, LOG_METADATA_PROJECTION)
+        if doc is None:
+            return None
+        if doc.get("open"):
+            return self.open_logs.add(doc)
+        return OpenLogCache().add(doc)
+
+    def format_log_link(self, key: str) -> str:
+        return f"{self.bot.config.log_url.strip('/')}{prefix}/{key}"
 
     async def get_log_link(self, channel_id: Union[str, int]) -> str:
-        doc = await self.get_log(channel_id)
-        return f"{self.bot.config.log_url.strip('/')}{prefix}/{doc['key']}"
+        doc = await self.get_log_metadata(channel_id)
+        return self.format_log_link(doc["key"])
 
     async def create_log_entry(
         self, recipient: Member, channel: TextChannel, creator: Member
     ) -> str:
         key = secrets.token_hex(6)
 
-        await self.logs.insert_one(
-            {
-                "_id": key,
-                "key": key,
-                "open": True,
-                "created_at": str(datetime.utcnow()),
-                "closed_at": None,
-                "channel_id": str(channel.id),
-                "guild_id": str(self.bot.guild_id),
-                "bot_id": str(self.bot.user.id),
-                "recipient": {
-                    "id": str(recipient.id),
-                    "name": recipient.name,
-                    "discriminator": recipient.discriminator,
-                    "avatar_url": str(recipient.avatar_url),
-                    "mod": False,
-                },
-                "creator": {
-                    "id": str(creator.id),
-                    "name": creator.name,
-                    "discriminator": creator.discriminator,
-                    "avatar_url": str(creator.avatar_url),
-                    "mod": isinstance(creator, Member),
-                },
-                "closer": None,
-                "messages": [],
-            }
-        )
+        log = {
+            "_id": key,
+            "key": key,
+            "open": True,
+            "created_at": str(datetime.utcnow()),
+            "closed_at": None,
+            "channel_id": str(channel.id),
+            "guild_id": str(self.bot.guild_id),
+            "bot_id": str(self.bot.user.id),
+            "recipient": {
+                "id": str(recipient.id),
+                "name": recipient.name,
+                "discriminator": recipient.discriminator,
+                "avatar_url": str(recipient.avatar_url),
+                "mod": False,
+            },
+            "creator": {
+                "id": str(creator.id),
+                "name": creator.name,
+                "discriminator": creator.discriminator,
+                "avatar_url": str(creator.avatar_url),
+                "mod": isinstance(creator, Member),
+            },
+            "closer": None,
+            "messages": [],
+        }
+        if self.bot.config.get_bool("compact_logs"):
+            log["version"] = SCHEMA_VERSION
+            log["participants"] = dict([compact_author(log["recipient"])])
+        await self._write("logs", "insert_one", log)
+        self.open_logs.add(log, new=True)
+        if self.search_index is not None:
+            self.search_index.add_log(log)
 
-        return f"{self.bot.config.log_url.strip('/')}{prefix}/{key}"
+        return self.format_log_link(key)
 
     async def get_config(self) -> dict:
         conf = await self.db.config.find_one({"bot_id": self.bot.user.id})
@@ -324,20 +635,34 @@ class ApiClient(RequestClient):
             return {"bot_id": self.bot.user.id}
         return conf
 
-    async def update_config(self, data: dict):
+    async def update_config(self, data: dict, removed: Iterable[str] = ()):
+        """
+        Saves the config `data`.
+
+        Only the keys in `removed` are unset, a write is journaled and may be
+        replayed later, so it must never delete what it does not know about.
+        """
         valid_keys = self.bot.config.valid_keys.difference(
             self.bot.config.protected_keys
         )
 
+        update = {}
         toset = {k: v for k, v in data.items() if k in valid_keys}
-        unset = {k: 1 for k in valid_keys if k not in data}
+        if toset:
+            update["$set"] = toset
+        unset = {k: 1 for k in removed if k in valid_keys and k not in data}
+        if unset:
+            update["$unset"] = unset
+        if not update:
+            return None
 
-        return await self.db.config.update_one(
-            {"bot_id": self.bot.user.id}, {"$set": toset, "$unset": unset}
-        )
+        return await self._write("config", "update_one", {"bot_id": self.bot.user.id}, update)
 
     async def edit_message(self, message_id: Union[int, str], new_content: str) -> None:
-        await self.logs.update_one(
+        self.open_logs.message_edited(str(message_id), new_content)
+        await self._write(
+            "logs",
+            "update_one",
             {"messages.message_id": str(message_id)},
             {"$set": {"messages.$.content": new_content, "messages.$.edited": True}},
         )
@@ -373,18 +698,135 @@ class ApiClient(RequestClient):
             ],
         }
 
-        return await self.logs.find_one_and_update(
-            {"channel_id": channel_id},
-            {"$push": {f"messages": data}},
-            return_document=True,
+        self.open_logs.message_logged(channel_id, data)
+        if self.search_index is not None:
+            self.search_index.add_message(channel_id, message.content, message.author.name)
+
+        # The message ID guard makes the push idempotent when it is replayed
+        return await self._write(
+            "logs",
+            "find_one_and_update",
+            {"channel_id": channel_id, "messages.message_id": {"$ne": data["message_id"]}},
+            message_update(data, self.bot.config.get_bool("compact_logs")),
+            projection={"key": 1},
+            **self.bot.storage.relay_options,
         )
 
-    async def post_log(self, channel_id: Union[int, str], data: dict) -> dict:
-        return await self.logs.find_one_and_update(
-            {"channel_id": str(channel_id)},
-            {"$set": {k: v for k, v in data.items()}},
-            return_document=True,
+    async def post_log(self, channel_id: Union[int, str], data: dict) -> Optional[dict]:
+        """
+        Updates the fields of a log.
+
+        Returns the `OpenLogCache` entry of the log, or `None` if it wasn't found.
+        Closing a log (``"open": False``) removes it from the cache.
+        """
+        entry = self.open_logs.get(channel_id)
+        if data.get("open") is False and "summary" not in data:
+            data = dict(data, summary=await self.summarize_log(channel_id, data.get("closed_at")))
+
+        if self.search_index is not None:
+            self.search_index.update_log(channel_id, data)
+
+        update = {"$set": {k: v for k, v in data.items()}}
+        if entry is None:
+            # Not cached, the metadata comes with the update
+            doc = await self._write(
+                "logs",
+                "find_one_and_update",
+                {"channel_id": str(channel_id)},
+                update,
+                projection=LOG_METADATA_PROJECTION,
+                wait=5,
+            )
+            entry = OpenLogCache().add(doc) if doc is not None else None
+        else:
+            await self._write("logs", "update_one", {"channel_id": str(channel_id)}, update)
+
+        if data.get("open") is False:
+            self.open_logs.pop(channel_id)
+        return entry
+
+    async def close_logs(self, channel_ids: list, data: dict) -> None:
+        """
+        Closes several logs with a single update.
+
+        `data` are the fields set on each log, as in `post_log`. Summaries
+        are left to the background backfill.
+        """
+        channel_ids = [str(channel_id) for channel_id in channel_ids]
+        data = dict(data, open=False)
+        for channel_id in channel_ids:
+            if self.search_index is not None:
+                self.search_index.update_log(channel_id, data)
+            self.open_logs.pop(channel_id)
+        query = {"channel_id": {"$in": channel_ids}, "open": True}
+        await self._write("logs", "update_many", query, {"$set": data})
+
+    async def summarize_log(self, channel_id: Union[int, str], closed_at=None) -> dict:
+        """
+        Computes the summary of a log being closed.
+
+        Logs created by this process are summarized from memory, the others
+        are read from the database without their message contents.
+        """
+        entry = self.open_logs.get(channel_id)
+        if entry is not None and entry["summary"] is not None:
+            return entry["summary"].result(closed_at)
+
+        # When the database is unavailable the summary is left to
+        # core.summary.backfill, closing the thread must not wait for it
+        if self.bot.journal is not None and not await self.bot.journal.drain(timeout=5):
+            return None
+        try:
+            doc = await asyncio.wait_for(
+                self.logs.find_one({"channel_id": str(channel_id)}, SUMMARY_PROJECTION), 5
+            )
+        except TRANSIENT_ERRORS:
+            logger.warning("Failed to read log %s, it will be summarized later.", channel_id)
+            return None
+        if doc is None:
+            return None
+        return summarize_log(doc, closed_at)
+
+    async def search_logs(self, query: str, limit: int = None) -> list:
+        """
+        Finds closed logs containing `query`.
+
+        Uses the local search index when enabled, otherwise MongoDB's `$text` index.
+        Results include the first 5 messages of each log.
+        """
+        projection = {"messages": {"$slice": 5}}
+
+        if self.search_index is None:
+            query = {
+                "guild_id": str(self.bot.guild_id),
+                "open": False,
+                "$text": {"$search": f'"{query}"'},
+            }
+            logs = await self.read_logs.find(query, projection).to_list(limit)
+            return [expand_log(log) for log in logs]
+
+        results = await self.bot.loop.run_in_executor(
+            None,
+            functools.partial(
+                self.search_index.search, query, guild_id=self.bot.guild_id, limit=limit
+            ),
         )
+        ranks = {key: i for i, (key, _) in enumerate(results)}
+        entries = await self.read_logs.find(
+            {"key": {"$in": list(ranks)}}, projection
+        ).to_list(None)
+        return sorted((expand_log(e) for e in entries), key=lambda e: ranks[e["key"]])
+
+    async def rebuild_search_index(self) -> int:
+        """Rebuilds the local search index from the logs collection."""
+        index = self.search_index
+        if index is None:
+            raise commands.CommandInvokeError("The local search index is not enabled.")
+        rebuilt = await rebuild_index(index.path, self.read_logs, live=index)
+        # Swapped before anything else runs, so no update is lost
+        self.bot.search_index = rebuilt
+        rebuilt.start(self.bot.loop)
+        return len(rebuilt)
 
     async def update_repository(self) -> dict:
         user = await GitHub.login(self.bot)
@@ -414,5 +856,11 @@ class PluginDatabaseClient:
         self.bot = bot
 
     def get_partition(self, cog):
+        """
+        Returns the collection reserved to a plugin.
+
+        The collection exposes the same API as a Motor collection,
+        whichever storage backend the bot runs on.
+        """
         cls_name = cog.__class__.__name__
-        return self.bot.db.plugins[cls_name]
+        return self.bot.storage.get_partition(cls_name)
@@ -1,5 +1,6 @@
 import asyncio
 import json
+import logging
 import os
 import typing
 
@@ -7,10 +8,11 @@ from dotenv import load_dotenv
 import isodate
 from discord.ext.commands import BadArgument
 
-from core._color_data import ALL_COLORS
 from core.models import InvalidConfigError
 from core.time import UserFriendlyTime
 
+logger = logging.getLogger("Modmail")
+
 
 load_dotenv()
 
@@ -76,6 +78,7 @@ class ConfigManager:
         # misc
         "aliases",
         "plugins",
+        "isolated_plugins",
     }
 
     protected_keys = {
@@ -84,6 +87,31 @@ class ConfigManager:
         "guild_id",
         "log_url",
         "mongo_uri",
+        "database_type",
+        "sqlite_path",
+        "mongo_max_pool_size",
+        "mongo_min_pool_size",
+        "mongo_max_idle_time",
+        "mongo_wait_queue_timeout",
+        "mongo_connect_timeout",
+        "mongo_server_selection_timeout",
+        "mongo_read_pool_size",
+        "mongo_read_preference",
+        "mongo_relay_timeout",
+        "write_journal",
+        "query_profiler",
+        "latency_profiler",
+        "loop_monitor",
+        "loop_block_threshold",
+        "metrics_host",
+        "metrics_port",
+        "relay_trace_rate",
+        "relay_trace_slow",
+        "compact_logs",
+        "archive_after",
+        "archive_purge_after",
+        "archive_storage",
+        "archive_codec",
         "owners",
         # bot
         "token",
@@ -91,6 +119,8 @@ class ConfigManager:
         "github_access_token",
         # Logging
         "log_level",
+        # Search
+        "local_search",
     }
 
     colors = {"mod_color", "recipient_color", "main_color"}
@@ -103,6 +133,10 @@ class ConfigManager:
         self.bot = bot
         self._cache = {}
         self._ready_event = asyncio.Event()
+        # Whether the config was loaded from the database, it is not saved before
+        self.loaded = False
+        # The keys stored in the database, to unset the ones removed from the cache
+        self._stored_keys = set()
         self.populate_cache()
 
     def __repr__(self):
@@ -128,6 +162,7 @@ class ConfigManager:
         data = {
             "snippets": {},
             "plugins": [],
+            "isolated_plugins": [],
             "aliases": {},
             "blocked": {},
             "blocked_whitelist": [],
@@ -158,6 +193,9 @@ class ConfigManager:
 
         # when setting a color
         if key in self.colors:
+            # The color table is only needed when a color is set
+            from core._color_data import ALL_COLORS
+
             hex_ = ALL_COLORS.get(val)
 
             if hex_ is None:
@@ -218,13 +256,23 @@ class ConfigManager:
         """Updates the config with data from the cache"""
         if data is not None:
             self.cache.update(data)
-        await self.api.update_config(self.cache)
+        if not self.loaded:
+            # Saving the local config would overwrite the stored one, which
+            # takes over when it is loaded
+            logger.debug("The config is not loaded from the database, not saving it.")
+            return self.cache
+        removed = self._stored_keys.difference(self.cache)
+        await self.api.update_config(self.cache, removed)
+        self._stored_keys = set(self.cache)
+        self.bot.metrics.config_writes.inc()
         return self.cache
 
     async def refresh(self) -> dict:
         """Refreshes internal cache with data from database"""
         data = await self.api.get_config()
         self.cache.update(data)
+        self._stored_keys = set(data)
+        self.loaded = True
         self.ready_event.set()
         return self.cache
 
@@ -242,3 +290,12 @@ class ConfigManager:
 
     def get(self, key: str, default: typing.Any = None) -> typing.Any:
         return self.cache.get(key, default)
+
+    def get_bool(self, key: str, default: bool = False) -> bool:
+        """Gets a yes or no config var, which may come as a string from the environment."""
+        value = self.cache.get(key)
+        if value is None:
+            return default
+        if isinstance(value, str):
+            return value.strip().lower() not in {"", "0", "false", "no", "off", "disable"}
+        return bool(value)
@@ -0,0 +1,486 @@
+"""
+Latency profiling of database operations.
+
+`StorageBackend.profile` wraps every collection handed out by the backend
+(logs, config, plugin partitions, on the main, read and relay databases)
+in a `ProfiledCollection`. Each operation is timed and recorded in a
+`QueryProfiler`, which keeps, per collection and operation:
+
+- a latency histogram, with exact mean and maximum,
+- the number and approximate size of the documents returned,
+- the number of errors.
+
+The slowest queries are kept with their filter, projection and sort, so
+their query plan can be fetched with `QueryProfiler.explain` afterwards.
+"""
+import bisect
+import copy
+import heapq
+import json
+import time
+import typing
+from datetime import datetime
+
+try:
+    from bson import BSON
+except ImportError:  # motor (and pymongo) are optional with the SQLite backend
+    BSON = None
+
+# Upper bounds of the latency histogram buckets, in milliseconds.
+BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+# Only the first documents of a result are measured, the rest are extrapolated.
+SIZE_SAMPLE = 50
+
+# Operations returning a value, cursors (`find`, `aggregate`) are handled apart.
+TIMED_OPERATIONS = {
+    "find_one",
+    "count_documents",
+    "estimated_document_count",
+    "insert_one",
+    "insert_many",
+    "update_one",
+    "update_many",
+    "replace_one",
+    "find_one_and_update",
+    "find_one_and_replace",
+    "find_one_and_delete",
+    "delete_one",
+    "delete_many",
+    "distinct",
+}
+
+UNEXPLAINABLE = {"insert_one", "insert_many", "aggregate", "estimated_document_count"}
+
+
+def document_size(doc) -> int:
+    """Returns the BSON size of a document, or its JSON size without BSON."""
+    if BSON is not None:
+        try:
+            return len(BSON.encode(doc))
+        except Exception:
+            pass
+    return len(json.dumps(doc, default=str))
+
+
+def _result_size(docs: list) -> int:
+    if not docs:
+        return 0
+    sample = docs[:SIZE_SAMPLE]
+    size = sum(document_size(d) for d in sample if isinstance(d, dict))
+    return size * len(docs) // len(sample)
+
+
+class OperationStats:
+    """The statistics of one operation on one collection."""
+
+    __slots__ = ("buckets", "count", "errors", "total", "max", "docs", "bytes")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.docs = 0
+        self.bytes = 0
+
+    def add(self, elapsed: float, docs: int, size: int, error: bool) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        self.count += 1
+        self.errors += error
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.docs += docs
+        self.bytes += size
+
+    def percentile(self, p: float) -> float:
+        """Returns the upper bound of the bucket holding the `p` percentile."""
+        rank = self.count * p
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "docs": self.docs,
+            "bytes": self.bytes,
+            "histogram": {str(b): c for b, c in zip(BUCKETS, self.buckets) if c},
+        }
+
+
+class SlowQuery:
+    """A recorded slow query, the filter is copied when recorded."""
+
+    def __init__(self, collection, name, op, elapsed, docs, size, filter, projection, sort):
+        self.collection = collection
+        self.name = name
+        self.op = op
+        self.elapsed = elapsed
+        self.docs = docs
+        self.size = size
+        self.filter = filter
+        self.projection = projection
+        self.sort = sort
+        self.timestamp = datetime.utcnow()
+
+    def __lt__(self, other: "SlowQuery") -> bool:
+        return self.elapsed < other.elapsed
+
+    @property
+    def explainable(self) -> bool:
+        return isinstance(self.filter, (dict, type(None))) and self.op not in UNEXPLAINABLE
+
+    def to_dict(self) -> dict:
+        return {
+            "collection": self.name,
+            "op": self.op,
+            "elapsed": self.elapsed,
+            "docs": self.docs,
+            "bytes": self.size,
+            "filter": self.filter,
+            "projection": self.projection,
+            "sort": self.sort,
+            "timestamp": str(self.timestamp),
+        }
+
+
+class QueryProfiler:
+    """
+    Records the latency of database operations.
+
+    Parameters
+    ----------
+    slow_queries : int, optional
+        The number of slowest queries kept.
+
+    Attributes
+    ----------
+    operations : Dict[Tuple[str, str], OperationStats]
+        The statistics keyed by ``(collection name, operation)``.
+    started : datetime
+        When the statistics were last reset.
+    """
+
+    def __init__(self, slow_queries: int = 20):
+        self.slow_queries = slow_queries
+        self.operations = {}
+        self._slowest = []
+        self.started = datetime.utcnow()
+
+    def reset(self) -> None:
+        self.operations.clear()
+        self._slowest.clear()
+        self.started = datetime.utcnow()
+
+    def record(
+        self,
+        collection,
+        op: str,
+        elapsed: float,
+        docs: int = 0,
+        size: int = 0,
+        error: bool = False,
+        filter: dict = None,
+        projection: dict = None,
+        sort: list = None,
+    ) -> None:
+        """
+        Records an operation, `elapsed` is in milliseconds.
+
+        The filter, projection and sort are only kept, and copied, when the
+        operation is one of the slowest.
+        """
+        name = getattr(collection, "name", str(collection))
+        stats = self.operations.get((name, op))
+        if stats is None:
+            stats = self.operations[name, op] = OperationStats()
+        stats.add(elapsed, docs, size, error)
+
+        if len(self._slowest) >= self.slow_queries and elapsed <= self._slowest[0].elapsed:
+            return
+        try:
+            filter, projection, sort = copy.deepcopy((filter, projection, sort))
+        except Exception:
+            filter, projection, sort = repr(filter), repr(projection), repr(sort)
+        query = SlowQuery(collection, name, op, elapsed, docs, size, filter, projection, sort)
+        if len(self._slowest) < self.slow_queries:
+            heapq.heappush(self._slowest, query)
+        else:
+            heapq.heapreplace(self._slowest, query)
+
+    def slowest(self) -> typing.List[SlowQuery]:
+        """Returns the slowest queries, slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def summary(self) -> typing.List[typing.Tuple[str, str, dict]]:
+        """Returns ``(collection, operation, stats)`` sorted by total time, highest first."""
+        items = sorted(self.operations.items(), key=lambda item: item[1].total, reverse=True)
+        return [(name, op, stats.to_dict()) for (name, op), stats in items]
+
+    async def explain(self, query: SlowQuery) -> dict:
+        """
+        Returns the query plan of a recorded query.
+
+        Writes are explained as a `find` on their filter, which shows how
+        the documents to update are looked up.
+        """
+        if not query.explainable:
+            raise ValueError(f"`{query.op}` queries cannot be explained.")
+        cursor = query.collection.find(query.filter or {}, query.projection)
+        if query.sort:
+            cursor = cursor.sort(query.sort)
+        return await cursor.explain()
+
+    def to_dict(self) -> dict:
+        return {
+            "started": str(self.started),
+            "operations": [
+                dict(stats, collection=name, op=op) for name, op, stats in self.summary()
+            ],
+            "slowest": [query.to_dict() for query in self.slowest()],
+        }
+
+
+def plan_summary(plan: dict) -> typing.List[str]:
+    """Extracts the winning plan stages and the execution counters of an explain output."""
+    lines = []
+    planner = plan.get("queryPlanner") or {}
+    stage = planner.get("winningPlan")
+    stages = []
+    while isinstance(stage, dict):
+        name = stage.get("stage", "?")
+        if stage.get("indexName"):
+            name += f" ({stage['indexName']})"
+        stages.append(name)
+        stage = stage.get("inputStage") or (stage.get("inputStages") or [None])[0]
+    if stages:
+        lines.append("Plan: " + " <- ".join(stages))
+    for detail in planner.get("plan") or []:
+        lines.append(f"Plan: {detail}")
+    if planner.get("sql"):
+        lines.append(f"SQL: {planner['sql']}")
+
+    stats = plan.get("executionStats") or {}
+    if stats:
+        lines.append(
+            f"Returned {stats.get('nReturned')}, examined {stats.get('totalKeysExamined')} "
+            f"keys and {stats.get('totalDocsExamined')} documents "
+            f"in {stats.get('executionTimeMillis')}ms"
+        )
+    return lines
+
+
+class ProfiledCursor:
+    """Wraps a Motor cursor, its `to_list` or iteration is timed as one operation."""
+
+    def __init__(self, cursor, collection, profiler, op, filter, projection):
+        self._cursor = cursor
+        self._collection = collection
+        self._profiler = profiler
+        self._op = op
+        self._filter = filter
+        self._projection = projection
+        self._sort = None
+        self._elapsed = 0.0
+        self._docs = 0
+        self._size = 0
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._cursor, name)
+
+    def sort(self, key, direction: int = None) -> "ProfiledCursor":
+        if isinstance(key, list):
+            self._sort = key
+            self._cursor = self._cursor.sort(key)
+        else:
+            self._sort = [(key, direction or 1)]
+            self._cursor = self._cursor.sort(key, direction or 1)
+        return self
+
+    def skip(self, count: int) -> "ProfiledCursor":
+        self._cursor = self._cursor.skip(count)
+        return self
+
+    def limit(self, count: int) -> "ProfiledCursor":
+        self._cursor = self._cursor.limit(count)
+        return self
+
+    def _record(self, error: bool = False) -> None:
+        self._profiler.record(
+            self._collection,
+            self._op,
+            self._elapsed,
+            self._docs,
+            self._size,
+            error,
+            self._filter,
+            self._projection,
+            self._sort,
+        )
+
+    async def to_list(self, length: typing.Optional[int] = None) -> list:
+        started = time.perf_counter()
+        try:
+            docs = await self._cursor.to_list(length)
+        except Exception:
+            self._elapsed += (time.perf_counter() - started) * 1000
+            self._record(error=True)
+            raise
+        self._elapsed += (time.perf_counter() - started) * 1000
+        self._docs += len(docs)
+        self._size += _result_size(docs)
+        self._record()
+        return docs
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        started = time.perf_counter()
+        try:
+            doc = await self._cursor.__anext__()
+        except StopAsyncIteration:
+            self._elapsed += (time.perf_counter() - started) * 1000
+            self._record()
+            raise
+        except Exception:
+            self._elapsed += (time.perf_counter() - started) * 1000
+            self._record(error=True)
+            raise
+        self._elapsed += (time.perf_counter() - started) * 1000
+        if self._docs < SIZE_SAMPLE:
+            self._size += document_size(doc)
+        elif self._docs:
+            self._size += self._size // self._docs
+        self._docs += 1
+        return doc
+
+
+def _is_collection(value) -> bool:
+    return hasattr(value, "find_one") and hasattr(value, "insert_one")
+
+
+class ProfiledCollection:
+    """
+    Wraps a Motor (or `SQLiteCollection`) collection, every operation is
+    recorded in the profiler. Sub-collections are wrapped as well.
+    """
+
+    def __init__(self, collection, profiler: QueryProfiler):
+        self._collection = collection
+        self._profiler = profiler
+        self._children = {}
+
+    def __repr__(self):
+        return f"ProfiledCollection({self._collection!r})"
+
+    def __getitem__(self, name: str) -> "ProfiledCollection":
+        if name not in self._children:
+            self._children[name] = ProfiledCollection(self._collection[name], self._profiler)
+        return self._children[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        value = getattr(self._collection, name)
+        if name in TIMED_OPERATIONS:
+            return self._timed(name, value)
+        if name in {"find", "aggregate"}:
+            return self._cursor(name, value)
+        if _is_collection(value):
+            return self[name]
+        return value
+
+    def _timed(self, op: str, method):
+        collection, profiler = self._collection, self._profiler
+
+        async def timed(*args, **kwargs):
+            if op == "distinct":
+                filter = args[1] if len(args) > 1 else kwargs.get("filter")
+            elif op in {"insert_one", "insert_many"}:
+                filter = None
+            else:
+                filter = args[0] if args else kwargs.get("filter")
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                elapsed = (time.perf_counter() - started) * 1000
+                profiler.record(collection, op, elapsed, error=True, filter=filter)
+                raise
+            elapsed = (time.perf_counter() - started) * 1000
+            docs = size = 0
+            if isinstance(result, dict):
+                docs, size = 1, document_size(result)
+            profiler.record(
+                collection,
+                op,
+                elapsed,
+                docs,
+                size,
+                filter=filter,
+                projection=kwargs.get("projection"),
+            )
+            return result
+
+        return timed
+
+    def _cursor(self, op: str, method):
+        collection, profiler = self._collection, self._profiler
+
+        def cursor(*args, **kwargs):
+            filter = args[0] if args else kwargs.get("filter", kwargs.get("pipeline"))
+            projection = args[1] if len(args) > 1 else kwargs.get("projection")
+            return ProfiledCursor(
+                method(*args, **kwargs), collection, profiler, op, filter, projection
+            )
+
+        return cursor
+
+
+class ProfiledDatabase:
+    """Wraps a database, its collections are handed out as `ProfiledCollection`."""
+
+    def __init__(self, db, profiler: QueryProfiler):
+        self._db = db
+        self._profiler = profiler
+        self._children = {}
+
+    def __repr__(self):
+        return f"ProfiledDatabase({self._db!r})"
+
+    def __getitem__(self, name: str):
+        if name not in self._children:
+            value = self._db[name]
+            if _is_collection(value):
+                value = ProfiledCollection(value, self._profiler)
+            else:
+                value = ProfiledDatabase(value, self._profiler)
+            self._children[name] = value
+        return self._children[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        if name in self._children:
+            return self._children[name]
+        value = getattr(self._db, name)
+        if _is_collection(value):
+            value = self._children[name] = ProfiledCollection(value, self._profiler)
+        elif hasattr(value, "__getitem__") and not isinstance(value, (str, bytes, dict, list)):
+            # Plugin partitions of the SQLite backend
+            value = self._children[name] = ProfiledDatabase(value, self._profiler)
+        return value
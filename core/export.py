@@ -0,0 +1,280 @@
+"""
+Streaming export of logs to gzip JSONL or single-file HTML.
+
+Logs are read from a cursor and written as they arrive, in small batches
+on a worker thread, so memory use does not depend on the export size.
+Archived logs are restored from the archive and every log is exported in
+the version 1 schema.
+
+The module can be run as a script::
+
+    python -m core.export --recipient <user id> --after 2019-01-01 --format html
+"""
+import asyncio
+import gzip
+import html
+import json
+import logging
+import os
+import time
+import typing
+from datetime import datetime
+
+from core.logschema import expand_log
+
+logger = logging.getLogger("Modmail")
+
+FORMATS = ("jsonl", "html")
+BATCH_LOGS = 50
+
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; background: #36393f; color: #dcddde; margin: 2em; }}
+section {{ border-top: 1px solid #4f545c; padding: 1em 0; }}
+h2 {{ font-size: 1.1em; margin: 0 0 .5em; }}
+.meta {{ color: #8e9297; font-size: .85em; }}
+.message {{ margin: .3em 0; white-space: pre-wrap; }}
+.author {{ font-weight: bold; }}
+.mod .author {{ color: #7289da; }}
+.note {{ color: #faa61a; }}
+.time {{ color: #72767d; font-size: .8em; margin-right: .5em; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+"""
+
+HTML_FOOT = '<p class="meta">{count} logs exported on {date} UTC.</p>\n</body>\n</html>\n'
+
+
+def build_query(
+    guild_id=None, recipient_id=None, closer_id=None, after: str = None, before: str = None
+) -> dict:
+    """Builds the logs query of an export, dates are compared to `created_at`."""
+    query = {}
+    if guild_id is not None:
+        query["guild_id"] = str(guild_id)
+    if recipient_id is not None:
+        query["recipient.id"] = str(recipient_id)
+    if closer_id is not None:
+        query["closer.id"] = str(closer_id)
+    if after is not None or before is not None:
+        query["created_at"] = {}
+        if after is not None:
+            query["created_at"]["$gte"] = str(after)
+        if before is not None:
+            query["created_at"]["$lt"] = str(before)
+    return query
+
+
+def _html_log(log: dict) -> str:
+    e = html.escape
+    recipient = log.get("recipient") or {}
+    closer = log.get("closer") or {}
+    parts = [
+        "<section>",
+        f"<h2>{e(log['key'])} &mdash; {e(str(recipient.get('name')))}"
+        f"#{e(str(recipient.get('discriminator')))} ({e(str(recipient.get('id')))})</h2>",
+        f"<p class=\"meta\">Opened {e(str(log.get('created_at')))}, "
+        f"closed {e(str(log.get('closed_at')))}"
+        + (f" by {e(str(closer.get('name')))}" if closer else "")
+        + "</p>",
+    ]
+    for message in log.get("messages") or []:
+        author = message.get("author") or {}
+        classes = ["message"]
+        if author.get("mod"):
+            classes.append("mod")
+        if message.get("type") == "note":
+            classes.append("note")
+        content = e(str(message.get("content") or ""))
+        for attachment in message.get("attachments") or []:
+            content += f'\n<a href="{e(attachment["url"])}">{e(attachment["filename"])}</a>'
+        parts.append(
+            f'<div class="{" ".join(classes)}">'
+            f'<span class="time">{e(str(message.get("timestamp")))}</span>'
+            f'<span class="author">{e(str(author.get("name")))}</span>: {content}</div>'
+        )
+    parts.append("</section>\n")
+    return "\n".join(parts)
+
+
+class LogExporter:
+    """
+    Writes logs to a file as they are read.
+
+    Parameters
+    ----------
+    path : str
+        The output file.
+    fmt : str
+        ``jsonl`` (gzip compressed) or ``html``.
+    title : str, optional
+        The title of HTML exports.
+
+    Attributes
+    ----------
+    count : int
+        The number of exported logs.
+    stubs : int
+        The number of archived logs which could not be restored, only the
+        first messages of their transcript are exported.
+    """
+
+    def __init__(self, path: str, fmt: str, title: str = "Modmail logs"):
+        if fmt not in FORMATS:
+            raise ValueError(f"Invalid export format {fmt}, use jsonl or html.")
+        self.path = path
+        self.fmt = fmt
+        self.title = title
+        self.count = 0
+        self.stubs = 0
+        self._file = None
+
+    def _open(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.fmt == "jsonl":
+            self._file = gzip.open(self.path, "wt", encoding="utf-8", compresslevel=6)
+        else:
+            self._file = open(self.path, "w", encoding="utf-8")
+            self._file.write(HTML_HEAD.format(title=html.escape(self.title)))
+
+    def _write(self, logs: typing.List[dict]) -> None:
+        if self._file is None:
+            self._open()
+        for log in logs:
+            if self.fmt == "jsonl":
+                self._file.write(json.dumps(log, default=str, ensure_ascii=False) + "\n")
+            else:
+                self._file.write(_html_log(log))
+        self.count += len(logs)
+
+    def _close(self) -> None:
+        if self._file is None:
+            self._open()
+        if self.fmt == "html":
+            self._file.write(HTML_FOOT.format(count=self.count, date=datetime.utcnow()))
+        self._file.close()
+
+    async def export(
+        self,
+        collection,
+        query: dict,
+        archive=None,
+        progress: typing.Callable[[int], typing.Awaitable[None]] = None,
+        progress_interval: float = 5,
+    ) -> int:
+        """
+        Exports the logs of `collection` matching `query`.
+
+        Parameters
+        ----------
+        collection : AsyncIOMotorCollection
+            The logs collection.
+        query : dict
+            The logs to export, see `build_query`.
+        archive : ArchiveStore, optional
+            Where archived logs are restored from.
+        progress : Callable[[int], Awaitable[None]], optional
+            Called with the number of exported logs, at most every
+            `progress_interval` seconds.
+
+        Returns
+        -------
+        int
+            The number of exported logs.
+        """
+        loop = asyncio.get_event_loop()
+        batch = []
+        last_progress = time.monotonic()
+        try:
+            async for log in collection.find(query).sort("created_at", 1):
+                if "archived" in log:
+                    restored = await archive.fetch(log) if archive is not None else None
+                    if restored is None:
+                        self.stubs += 1
+                    log = restored or log
+                batch.append(expand_log(log))
+                if len(batch) < BATCH_LOGS:
+                    continue
+                await loop.run_in_executor(None, self._write, batch)
+                batch = []
+                if progress is not None and time.monotonic() - last_progress > progress_interval:
+                    last_progress = time.monotonic()
+                    await progress(self.count)
+            if batch:
+                await loop.run_in_executor(None, self._write, batch)
+        finally:
+            await loop.run_in_executor(None, self._close)
+        return self.count
+
+
+def main() -> None:
+    import argparse
+
+    from core.archive import ArchiveStore
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Export Modmail logs.")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--recipient", default=None, help="Recipient user ID.")
+    parser.add_argument("--closer", default=None, help="Closer user ID.")
+    parser.add_argument("--after", default=None, help="YYYY-MM-DD")
+    parser.add_argument("--before", default=None, help="YYYY-MM-DD")
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--guild-id", default=os.getenv("GUILD_ID"))
+    parser.add_argument("--archive-after", default=os.getenv("ARCHIVE_AFTER"))
+    parser.add_argument("--archive-storage", default=os.getenv("ARCHIVE_STORAGE"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    output = args.output or f"logs-{datetime.utcnow():%Y%m%d-%H%M%S}." + (
+        "jsonl.gz" if args.format == "jsonl" else "html"
+    )
+    after = str(datetime.fromisoformat(args.after)) if args.after else None
+    before = str(datetime.fromisoformat(args.before)) if args.before else None
+    query = build_query(args.guild_id, args.recipient, args.closer, after, before)
+
+    config = {
+        "database_type": args.database_type,
+        "mongo_uri": args.mongo_uri,
+        "sqlite_path": args.sqlite_path,
+        "archive_after": args.archive_after,
+        "archive_storage": args.archive_storage,
+    }
+    storage = StorageBackend.from_config(config, "temp")
+    archive = ArchiveStore.from_config(config, storage.read_db, "temp")
+
+    async def progress(count):
+        logger.info("Exported %d logs.", count)
+
+    started = time.perf_counter()
+    exporter = LogExporter(output, args.format)
+    count = asyncio.get_event_loop().run_until_complete(
+        exporter.export(storage.read_db.logs, query, archive=archive, progress=progress)
+    )
+    storage.close()
+    logger.info(
+        "Exported %d logs to %s (%.1f KiB) in %.1fs.",
+        count,
+        output,
+        os.path.getsize(output) / 1024,
+        time.perf_counter() - started,
+    )
+    if exporter.stubs:
+        logger.warning(
+            "%d archived logs could not be restored and only have their first messages, "
+            "set --archive-after (ARCHIVE_AFTER) to read them from the archive.",
+            exporter.stubs,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+A disk cache of HTTP responses, revalidated with conditional requests.
+
+`RequestClient.request(..., cache=True)` sends the ``ETag`` and
+``Last-Modified`` validators of the cached response, an unchanged
+resource is answered with a bodyless ``304 Not Modified``. The cached
+response is also used when the server can't be reached, so the registry,
+the changelog and the GitHub profile are available offline.
+
+Entries are keyed by URL and ``Authorization`` header, each is a small JSON
+metadata file next to the raw body.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+import typing
+from types import SimpleNamespace
+
+logger = logging.getLogger("Modmail")
+
+
+class HTTPCache:
+    """
+    Cached HTTP responses, stored in a directory.
+
+    Parameters
+    ----------
+    path : str
+        The cache directory.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _files(self, url: str, headers: dict) -> typing.Tuple[str, str]:
+        auth = (headers or {}).get("Authorization", "")
+        key = hashlib.sha1(f"{url}\0{auth}".encode()).hexdigest()
+        base = os.path.join(self.path, key)
+        return base + ".json", base + ".body"
+
+    def get(self, url: str, headers: dict = None) -> typing.Optional[SimpleNamespace]:
+        """
+        Returns the cached response of `url`, or `None`.
+
+        The response has the `etag`, `last_modified`, `content_type`,
+        `fetched_at` (epoch) and `body` (bytes) attributes.
+        """
+        meta_path, body_path = self._files(url, headers)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return SimpleNamespace(body=body, **meta)
+
+    def store(self, url: str, headers: dict, response_headers, body: bytes) -> None:
+        """Caches a ``200 OK`` response, the files are replaced atomically."""
+        meta_path, body_path = self._files(url, headers)
+        meta = {
+            "url": url,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "content_type": response_headers.get("Content-Type", ""),
+            "fetched_at": time.time(),
+        }
+        try:
+            with open(body_path + ".tmp", "wb") as f:
+                f.write(body)
+            os.replace(body_path + ".tmp", body_path)
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except OSError:
+            logger.warning("Failed to cache %s.", url, exc_info=True)
+
+    def touch(self, url: str, headers: dict = None) -> None:
+        """Marks a cached response as revalidated now."""
+        meta_path, _ = self._files(url, headers)
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            meta["fetched_at"] = time.time()
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            os.replace(meta_path + ".tmp", meta_path)
+        except (OSError, ValueError):
+            pass
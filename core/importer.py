@@ -0,0 +1,459 @@
+"""
+Bulk import of logs from JSON or JSONL archives.
+
+Archives are read as a stream: JSONL files line by line and JSON arrays
+with an incremental decoder, both optionally gzip compressed, so their
+size doesn't matter. Every document is validated and normalized into the
+`ApiClient.create_log_entry` schema, then inserted in unordered
+`insert_many` batches, several batches in flight at once.
+
+Logs whose key already exists are skipped by default, or given a new key
+and inserted again with ``on_duplicate="rekey"``. Closed logs are
+summarized as they are read, and the inserted logs are added to the local
+search index if one is given, so an import never rescans the collection.
+
+The module can be run as a script::
+
+    python -m core.importer logs.jsonl.gz --mongo-uri <uri> --guild-id <id>
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import typing
+from datetime import datetime
+
+from core.logschema import compact_log, expand_log
+from core.storage import BulkWriteError
+from core.summary import summarize_log
+
+logger = logging.getLogger("Modmail")
+
+DUPLICATE_KEY = 11000
+READ_SIZE = 1 << 16
+
+
+class InvalidLogError(ValueError):
+    """Raised when a document can't be normalized into a log."""
+
+
+# Reading
+
+
+def _open(path: str):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    if compressed:
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def iter_documents(path: str) -> typing.Iterator[dict]:
+    """
+    Yields the documents of a JSONL file, a JSON array or a single JSON object.
+
+    The file is never loaded at once, JSON arrays are decoded incrementally.
+    """
+    decoder = json.JSONDecoder()
+    with _open(path) as f:
+        buffer = f.read(READ_SIZE)
+        stripped = buffer.lstrip()
+        in_array = stripped.startswith("[")
+        pos = len(buffer) - len(stripped) + (1 if in_array else 0)
+        eof = False
+
+        while True:
+            # Skip separators between documents
+            while True:
+                while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    break
+                buffer, pos = f.read(READ_SIZE), 0
+                eof = not buffer
+
+            if pos >= len(buffer) or (in_array and buffer[pos] == "]"):
+                return
+
+            try:
+                doc, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The document continues in the next chunk
+                chunk = f.read(READ_SIZE)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield doc
+            pos = end
+            if len(buffer) - pos < READ_SIZE // 4 and not eof:
+                chunk = f.read(READ_SIZE)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+
+
+# Normalization
+
+
+def _date(value, field: str, required: bool = True) -> typing.Optional[str]:
+    if value is None or value == "":
+        if required:
+            raise InvalidLogError(f"Missing `{field}`.")
+        return None
+    if isinstance(value, dict) and "$date" in value:
+        value = value["$date"]
+    if isinstance(value, (int, float)):
+        # Epoch, in milliseconds when it's too large for seconds
+        value = datetime.utcfromtimestamp(value / 1000 if value > 1e11 else value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00").replace("T", " "))
+        except ValueError as e:
+            raise InvalidLogError(f"Invalid date in `{field}`: {value}.") from e
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        return str(value)
+    raise InvalidLogError(f"Invalid date in `{field}`: {value!r}.")
+
+
+def _user(value, field: str, mod: bool = False) -> typing.Optional[dict]:
+    if value is None:
+        return None
+    if not isinstance(value, dict) or value.get("id") in (None, ""):
+        raise InvalidLogError(f"Invalid user in `{field}`.")
+    return {
+        "id": str(value["id"]),
+        "name": str(value.get("name") or value.get("username") or value["id"]),
+        "discriminator": str(value.get("discriminator") or "0000"),
+        "avatar_url": str(value.get("avatar_url") or ""),
+        "mod": bool(value.get("mod", mod)),
+    }
+
+
+def _message(value: dict, n: int) -> dict:
+    if not isinstance(value, dict):
+        raise InvalidLogError(f"Invalid message {n}.")
+    field = f"messages.{n}"
+    author = _user(value.get("author"), f"{field}.author")
+    if author is None:
+        raise InvalidLogError(f"Missing `{field}.author`.")
+    attachments = []
+    for attachment in value.get("attachments") or []:
+        if isinstance(attachment, str):
+            attachment = {"url": attachment}
+        url = attachment.get("url")
+        if not url:
+            continue
+        attachments.append(
+            {
+                "id": attachment.get("id"),
+                "filename": attachment.get("filename") or url.rsplit("/", 1)[-1],
+                "is_image": bool(attachment.get("is_image", False)),
+                "size": attachment.get("size") or 0,
+                "url": url,
+            }
+        )
+    return {
+        "timestamp": _date(value.get("timestamp"), f"{field}.timestamp"),
+        "message_id": str(value.get("message_id") or value.get("id") or ""),
+        "author": author,
+        "content": str(value.get("content") or ""),
+        "type": str(value.get("type") or "thread_message"),
+        "attachments": attachments,
+        **({"edited": True} if value.get("edited") else {}),
+    }
+
+
+def normalize_log(doc: dict, guild_id=None, bot_id=None) -> dict:
+    """
+    Validates a log and converts it to the `ApiClient.create_log_entry` schema.
+
+    Parameters
+    ----------
+    doc : Dict[str, Any]
+        The imported document, any log schema version.
+    guild_id, bot_id : Union[int, str], optional
+        Override the guild and bot IDs of the log.
+
+    Raises
+    ------
+    InvalidLogError
+        The document is not a valid log.
+    """
+    if not isinstance(doc, dict):
+        raise InvalidLogError("Not an object.")
+    doc = expand_log(doc)
+    key = str(doc.get("key") or doc.get("_id") or secrets.token_hex(6))
+    recipient = _user(doc.get("recipient"), "recipient")
+    if recipient is None:
+        raise InvalidLogError("Missing `recipient`.")
+    if doc.get("channel_id") in (None, ""):
+        raise InvalidLogError("Missing `channel_id`.")
+
+    messages = doc.get("messages") or []
+    if not isinstance(messages, list):
+        raise InvalidLogError("`messages` is not a list.")
+    is_open = bool(doc.get("open", False))
+    return {
+        "_id": key,
+        "key": key,
+        "open": is_open,
+        "created_at": _date(doc.get("created_at"), "created_at"),
+        "closed_at": _date(doc.get("closed_at"), "closed_at", required=False),
+        "channel_id": str(doc["channel_id"]),
+        "guild_id": str(guild_id if guild_id is not None else doc.get("guild_id")),
+        "bot_id": str(bot_id if bot_id is not None else doc.get("bot_id")),
+        "recipient": recipient,
+        "creator": _user(doc.get("creator"), "creator") or recipient,
+        "closer": _user(doc.get("closer"), "closer", mod=True),
+        "close_message": doc.get("close_message"),
+        "messages": [_message(m, n) for n, m in enumerate(messages)],
+    }
+
+
+# Import
+
+
+class ImportReport:
+    """The counters of an import."""
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rekeyed = 0
+        self.invalid = 0
+        self.failed = 0
+        self.errors = []
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def __str__(self) -> str:
+        rate = self.inserted / self.elapsed if self.elapsed else 0
+        return (
+            f"Read {self.read} logs, inserted {self.inserted} ({self.rekeyed} with a new key), "
+            f"skipped {self.duplicates} duplicates and {self.invalid} invalid logs, "
+            f"{self.failed} failed. {self.elapsed:.1f}s, {rate:.0f} logs/s, "
+            f"{self.bytes / self.elapsed / 1024 / 1024 if self.elapsed else 0:.1f} MiB/s."
+        )
+
+
+def _raise_first(tasks: typing.Iterable[asyncio.Task]) -> None:
+    """Raises the first error of `tasks`, after retrieving all of them."""
+    errors = [task.exception() for task in tasks]
+    for error in errors:
+        if error is not None:
+            raise error
+
+
+class LogImporter:
+    """
+    Imports logs into a logs collection.
+
+    Parameters
+    ----------
+    collection : AsyncIOMotorCollection
+        The logs collection.
+    guild_id, bot_id : Union[int, str], optional
+        Override the guild and bot IDs of the imported logs.
+    compact : bool, optional
+        Whether to store the logs in the version 2 schema.
+    on_duplicate : str, optional
+        ``skip`` (default) or ``rekey``.
+    batch_size : int, optional
+        The number of logs per `insert_many`.
+    concurrency : int, optional
+        The number of batches inserted at once.
+    search_index : LogSearchIndex, optional
+        The local search index the inserted logs are added to.
+    """
+
+    def __init__(
+        self,
+        collection,
+        guild_id=None,
+        bot_id=None,
+        compact: bool = False,
+        on_duplicate: str = "skip",
+        batch_size: int = 500,
+        concurrency: int = 4,
+        search_index=None,
+    ):
+        if on_duplicate not in {"skip", "rekey"}:
+            raise ValueError("on_duplicate must be skip or rekey.")
+        self.collection = collection
+        self.guild_id = guild_id
+        self.bot_id = bot_id
+        self.compact = compact
+        self.on_duplicate = on_duplicate
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.search_index = search_index
+        self.report = ImportReport()
+
+    def _read_batches(
+        self, path: str, queue: asyncio.Queue, loop, cancelled: threading.Event
+    ) -> None:
+        """Reads and normalizes the archive, runs on a worker thread."""
+        batch = []
+        try:
+            for doc in iter_documents(path):
+                if cancelled.is_set():
+                    return
+                self.report.read += 1
+                try:
+                    log = normalize_log(doc, self.guild_id, self.bot_id)
+                except InvalidLogError as e:
+                    self.report.invalid += 1
+                    if len(self.report.errors) < 20:
+                        self.report.errors.append(f"Log {self.report.read}: {e}")
+                    continue
+                if not log["open"]:
+                    log["summary"] = summarize_log(log)
+                batch.append(compact_log(log) if self.compact else log)
+                if len(batch) >= self.batch_size:
+                    asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+                    batch = []
+            if batch:
+                asyncio.run_coroutine_threadsafe(queue.put(batch), loop).result()
+        finally:
+            asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    async def _insert(
+        self, batch: typing.List[dict], attempt: int = 0, rekeyed: typing.Set[str] = frozenset()
+    ) -> None:
+        """Inserts `batch`, the logs with an ``_id`` in `rekeyed` were given a new key."""
+        try:
+            await self.collection.insert_many(batch, ordered=False)
+            errors = []
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+        failed = {error["index"] for error in errors}
+        self._inserted([doc for i, doc in enumerate(batch) if i not in failed], rekeyed)
+
+        retry = []
+        rekeyed = set(rekeyed)
+        for error in errors:
+            doc = batch[error["index"]]
+            if error.get("code") != DUPLICATE_KEY:
+                if attempt < 3:
+                    retry.append(doc)
+                else:
+                    self.report.failed += 1
+                    logger.warning("Failed to import log %s: %s", doc["key"], error.get("errmsg"))
+            elif self.on_duplicate == "rekey" and attempt < 3:
+                key = secrets.token_hex(6)
+                retry.append(dict(doc, _id=key, key=key))
+                # Counted once the new key is inserted
+                rekeyed.add(key)
+            else:
+                self.report.duplicates += 1
+        if retry:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            await self._insert(retry, attempt + 1, rekeyed)
+
+    def _inserted(self, docs: typing.List[dict], rekeyed: typing.Set[str]) -> None:
+        self.report.inserted += len(docs)
+        self.report.rekeyed += sum(1 for doc in docs if doc["_id"] in rekeyed)
+        if self.search_index is not None:
+            for doc in docs:
+                self.search_index.add_log(expand_log(doc))
+
+    async def run(self, path: str) -> ImportReport:
+        """Imports the archive at `path`, returns the report."""
+        loop = asyncio.get_event_loop()
+        self.report.bytes = os.path.getsize(path)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        cancelled = threading.Event()
+        reader = loop.run_in_executor(None, self._read_batches, path, queue, loop, cancelled)
+
+        in_flight = set()
+        batches = 0
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    break
+                in_flight.add(loop.create_task(self._insert(batch)))
+                if len(in_flight) >= self.concurrency:
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    _raise_first(done)
+                batches += 1
+                if batches % 20 == 0:
+                    logger.info("Imported %d logs.", self.report.inserted)
+            if in_flight:
+                done, in_flight = await asyncio.wait(in_flight)
+                _raise_first(done)
+        finally:
+            # On an error, stop the reader, it may be blocked on the full queue
+            cancelled.set()
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            while not reader.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.wait([reader], timeout=0.1)
+        await reader
+
+        self.report.elapsed = time.perf_counter() - self.report.started
+        return self.report
+
+
+def main() -> None:
+    import argparse
+
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Import logs from JSON or JSONL archives.")
+    parser.add_argument("paths", nargs="+")
+    parser.add_argument("--on-duplicate", choices=["skip", "rekey"], default="skip")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--compact", action="store_true", help="Store logs in schema version 2.")
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--guild-id", default=os.getenv("GUILD_ID"))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    storage = StorageBackend.from_config(
+        {
+            "database_type": args.database_type,
+            "mongo_uri": args.mongo_uri,
+            "sqlite_path": args.sqlite_path,
+        },
+        "temp",
+    )
+    loop = asyncio.get_event_loop()
+    for path in args.paths:
+        importer = LogImporter(
+            storage.db.logs,
+            guild_id=args.guild_id,
+            compact=args.compact,
+            on_duplicate=args.on_duplicate,
+            batch_size=args.batch_size,
+            concurrency=args.concurrency,
+        )
+        report = loop.run_until_complete(importer.run(path))
+        logger.info("%s: %s", path, report)
+        for error in report.errors:
+            logger.warning(error)
+    logger.info("Rebuild the local search index with `python -m core.search rebuild` if used.")
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
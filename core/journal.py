@@ -0,0 +1,369 @@
+"""
+A local write-ahead journal for log and config writes.
+
+Every write the bot makes to the database is first appended to a segmented,
+append-only journal on disk, then applied to the database by a replayer
+task. Appends are fsynced in small batches, so relaying a message only
+waits for the local disk, and a slow or unavailable database delays the
+replayer instead of the relay.
+
+Journaled operations must be idempotent: records are replayed in order and
+the last applied sequence number is checkpointed after each batch, so a
+record may be applied twice after a crash but never skipped.
+
+Record format, one per line::
+
+    <crc32 hex> <json>
+"""
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import typing
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from core.storage import DuplicateKeyError, dumps, loads
+
+try:
+    from pymongo.errors import ConnectionFailure, ExecutionTimeout, WTimeoutError
+
+    TRANSIENT_ERRORS = (ConnectionFailure, ExecutionTimeout, WTimeoutError)
+except ImportError:
+    TRANSIENT_ERRORS = ()
+
+TRANSIENT_ERRORS += (sqlite3.OperationalError, asyncio.TimeoutError)
+
+logger = logging.getLogger("Modmail")
+
+SEGMENT_PREFIX = "journal-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT = "checkpoint"
+
+
+def _segment_name(seq: int) -> str:
+    return f"{SEGMENT_PREFIX}{seq:016d}{SEGMENT_SUFFIX}"
+
+
+def _encode_record(record: dict) -> bytes:
+    data = dumps(record).encode("utf-8")
+    return b"%08x %s\n" % (zlib.crc32(data), data)
+
+
+def _decode_record(line: bytes) -> typing.Optional[dict]:
+    try:
+        checksum, data = line.rstrip(b"\n").split(b" ", 1)
+        if int(checksum, 16) != zlib.crc32(data):
+            return None
+        return loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+
+
+class WriteJournal:
+    """
+    Segmented append-only journal, drained into the database by a replayer.
+
+    Parameters
+    ----------
+    path : str
+        The directory where the segments are stored.
+    db : Any
+        The database the records are applied to.
+    segment_size : int, optional
+        The size after which a new segment is started, in bytes.
+        Defaults to 4 MiB.
+    fsync_interval : float, optional
+        How long appends are batched before being fsynced, in seconds.
+        Defaults to 0.01.
+
+    Attributes
+    ----------
+    appended : int
+        The sequence number of the last durable record.
+    applied : int
+        The sequence number of the last record applied to the database.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        db,
+        segment_size: int = 4 * 1024 * 1024,
+        fsync_interval: float = 0.01,
+    ):
+        self.path = path
+        self.db = db
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+
+        self.applied = self._read_checkpoint()
+        self.appended = self.applied
+        self._seq = self.applied
+        self._segments = []  # (first seq, file name)
+        self._pending = deque()
+        self._buffer = []
+        self._waiters = {}
+        self._file = None
+        self._size = 0
+        self._flusher = None
+        self._replayer = None
+        self._new_records = None
+        self.loop = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+        self._recover()
+
+    def __len__(self) -> int:
+        """The number of records waiting to be applied."""
+        return self.appended - self.applied
+
+    # Files
+
+    def _read_checkpoint(self) -> int:
+        try:
+            with open(os.path.join(self.path, CHECKPOINT), encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_checkpoint(self, seq: int) -> None:
+        tmp = os.path.join(self.path, CHECKPOINT + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, CHECKPOINT))
+
+    def _recover(self) -> None:
+        """Loads the records which were not applied before the last shutdown."""
+        names = sorted(
+            n
+            for n in os.listdir(self.path)
+            if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX)
+        )
+        for name in names:
+            first = int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+            self._segments.append((first, name))
+            with open(os.path.join(self.path, name), "rb") as f:
+                valid = 0
+                for line in f:
+                    record = _decode_record(line) if line.endswith(b"\n") else None
+                    if record is None:
+                        break
+                    valid += len(line)
+                    self._seq = max(self._seq, record["seq"])
+                    if record["seq"] > self.applied:
+                        self._pending.append(record)
+            if valid != os.path.getsize(os.path.join(self.path, name)):
+                logger.warning("Truncating torn write at the end of journal segment %s.", name)
+                with open(os.path.join(self.path, name), "r+b") as f:
+                    f.truncate(valid)
+        self.appended = self._seq
+        if self._pending:
+            logger.info("Write journal: %d records to replay.", len(self._pending))
+
+    def _open_segment(self, first_seq: int) -> None:
+        if self._file is not None:
+            self._file.close()
+        name = _segment_name(first_seq)
+        self._segments.append((first_seq, name))
+        self._file = open(os.path.join(self.path, name), "ab")
+        self._size = self._file.tell()
+
+    def _write(self, records: typing.List[typing.Tuple[int, bytes]]) -> None:
+        """
+        Writes and fsyncs a batch of encoded records, runs on the journal thread.
+
+        The batch is written entirely or not at all: on error, the segments
+        are truncated back to where the batch started.
+        """
+        segments, size = len(self._segments), self._size
+        try:
+            for seq, data in records:
+                if self._file is None or self._size >= self.segment_size:
+                    self._open_segment(seq)
+                self._file.write(data)
+                self._size += len(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            self._rollback(segments, size)
+            raise
+
+    def _rollback(self, segments: int, size: int) -> None:
+        """Removes the segments after the first `segments` and truncates the last one to `size`."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        while len(self._segments) > segments:
+            _, name = self._segments.pop()
+            os.remove(os.path.join(self.path, name))
+        if not self._segments:
+            return
+        _, name = self._segments[-1]
+        self._file = open(os.path.join(self.path, name), "ab")
+        self._file.truncate(size)
+        self._file.seek(size)
+        self._size = size
+
+    def _compact(self, applied: int) -> None:
+        """Checkpoints `applied` and deletes fully applied segments."""
+        self._write_checkpoint(applied)
+        while len(self._segments) > 1 and self._segments[1][0] <= applied + 1:
+            _, name = self._segments.pop(0)
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                logger.warning("Failed to remove journal segment %s.", name, exc_info=True)
+
+    # Appends
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Starts replaying the journal into the database."""
+        self.loop = loop
+        self._new_records = asyncio.Event()
+        if self._pending:
+            self._new_records.set()
+        self._replayer = loop.create_task(self._replay())
+
+    async def append(self, collection: str, op: str, *args, **kwargs) -> int:
+        """
+        Journals a write, returns once it is durable.
+
+        Parameters
+        ----------
+        collection : str
+            The collection name, plugin partitions use ``plugins.<name>``.
+        op : str
+            The collection method, e.g. ``update_one``.
+        *args, **kwargs
+            The arguments of the method, they must be JSON serializable.
+
+        Returns
+        -------
+        int
+            The sequence number of the record.
+        """
+        record = {"seq": self._seq + 1, "c": collection, "op": op, "a": list(args), "k": kwargs}
+        # Encoded here, so a record that cannot be serialized only fails its caller
+        data = _encode_record(record)
+        self._seq += 1
+        future = self.loop.create_future()
+        self._buffer.append((record, data, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = self.loop.create_task(self._flush())
+        await future
+        return record["seq"]
+
+    async def _flush(self) -> None:
+        while self._buffer:
+            await asyncio.sleep(self.fsync_interval)
+            batch, self._buffer = self._buffer, []
+            records = [(record["seq"], data) for record, data, _ in batch]
+            try:
+                await self.loop.run_in_executor(self.executor, self._write, records)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for record, _, future in batch:
+                self._pending.append(record)
+                self.appended = record["seq"]
+                if not future.done():
+                    future.set_result(None)
+            self._new_records.set()
+
+    async def wait_applied(self, seq: int, timeout: float = None):
+        """
+        Waits until the record `seq` is applied to the database.
+
+        Returns
+        -------
+        Any
+            The return value of the database operation, `None` if it was
+            applied before this call.
+
+        Raises
+        ------
+        asyncio.TimeoutError
+            The record was not applied in time, it stays in the journal.
+        """
+        if seq <= self.applied:
+            return None
+        future = self._waiters.setdefault(seq, self.loop.create_future())
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    # Replay
+
+    def _collection(self, name: str):
+        if name.startswith("plugins."):
+            return self.db.plugins[name[len("plugins.") :]]
+        return self.db[name]
+
+    async def _apply(self, record: dict):
+        method = getattr(self._collection(record["c"]), record["op"])
+        try:
+            return await method(*record["a"], **record["k"])
+        except DuplicateKeyError:
+            # Already applied before a restart
+            return None
+
+    async def _replay(self) -> None:
+        delay = 0.5
+        while True:
+            await self._new_records.wait()
+            self._new_records.clear()
+
+            while self._pending:
+                record = self._pending[0]
+                try:
+                    result = await self._apply(record)
+                except TRANSIENT_ERRORS as e:
+                    logger.warning(
+                        "Database unavailable, %d journaled writes pending (%s).", len(self), e
+                    )
+                    await asyncio.sleep(delay + random.random() * delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                except Exception:
+                    logger.error("Dropping journaled write %s.", record, exc_info=True)
+                    result = None
+                delay = 0.5
+
+                self._pending.popleft()
+                self.applied = record["seq"]
+                waiter = self._waiters.pop(record["seq"], None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(result)
+
+                if not self._pending or record["seq"] % 100 == 0:
+                    await self.loop.run_in_executor(self.executor, self._compact, self.applied)
+
+    async def drain(self, timeout: float = None) -> bool:
+        """Waits until every journaled write is applied, returns whether it did."""
+        if self._flusher is not None:
+            await self._flusher
+        if not self.appended > self.applied:
+            return True
+        try:
+            await self.wait_applied(self.appended, timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def close(self) -> None:
+        if self._replayer is not None:
+            self._replayer.cancel()
+        self.executor.shutdown(wait=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._pending:
+            logger.warning(
+                "%d journaled writes will be replayed on the next start.", len(self._pending)
+            )
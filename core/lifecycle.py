@@ -0,0 +1,135 @@
+"""
+The bot's connection lifecycle.
+
+discord.py dispatches ``on_connect`` on every gateway connection and
+``on_ready`` after every new session, so the startup work done there would
+be repeated on each reconnect. `Lifecycle` tracks the kind of each
+connection and runs the initialization steps exactly once per process, or
+once more after they are invalidated:
+
+- cold start: the first session of the process, every step runs;
+- resume: the gateway resumed the session, nothing is lost, no step runs;
+- re-identify: a new session was started, the caches built from the old
+  one are invalidated and rebuilt.
+"""
+import asyncio
+import logging
+import time
+import typing
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger("Modmail")
+
+
+class Lifecycle:
+    """
+    The connection state of the bot and its initialization steps.
+
+    Parameters
+    ----------
+    profiler : StartupProfiler, optional
+        Where the duration of the steps is recorded.
+
+    Attributes
+    ----------
+    state : str
+        One of `STARTING`, `CONNECTING`, `CONNECTED`, `READY` and
+        `DISCONNECTED`.
+    sessions : int
+        The number of sessions started (``on_ready`` events).
+    history : Deque[Tuple[datetime, str]]
+        The most recent lifecycle events.
+    """
+
+    STARTING = "starting"
+    CONNECTING = "connecting"
+    CONNECTED = "connected"
+    READY = "ready"
+    DISCONNECTED = "disconnected"
+
+    COLD_START = "cold start"
+    RESUME = "resume"
+    REIDENTIFY = "re-identify"
+
+    def __init__(self, profiler=None):
+        self.profiler = profiler
+        self.state = self.STARTING
+        self.sessions = 0
+        self.history = deque(maxlen=50)
+        self._done = set()
+        self._running = {}
+
+    def _event(self, event: str) -> None:
+        self.history.append((datetime.utcnow(), event))
+        logger.debug("Lifecycle: %s (%s).", event, self.state)
+
+    def connected(self) -> None:
+        self.state = self.CONNECTED
+        self._event("connect")
+
+    def disconnected(self) -> None:
+        self.state = self.DISCONNECTED
+        self._event("disconnect")
+
+    def ready(self) -> str:
+        """Records a new session, returns `COLD_START` or `REIDENTIFY`."""
+        self.sessions += 1
+        self.state = self.READY
+        kind = self.COLD_START if self.sessions == 1 else self.REIDENTIFY
+        self._event(kind)
+        return kind
+
+    def resumed(self) -> str:
+        self.state = self.READY
+        self._event(self.RESUME)
+        return self.RESUME
+
+    def done(self, step: str) -> bool:
+        return step in self._done
+
+    def invalidate(self, *steps: str) -> None:
+        """Runs `steps` again on their next `run`."""
+        self._done.difference_update(steps)
+
+    async def run(self, step: str, func: typing.Callable[..., typing.Awaitable], *args) -> bool:
+        """
+        Runs a step unless it already ran, concurrent calls wait for the
+        same run. The step is only marked done when it succeeds, exceptions
+        are propagated.
+
+        Returns
+        -------
+        bool
+            Whether the step ran.
+        """
+        if step in self._done:
+            return False
+        running = self._running.get(step)
+        if running is not None:
+            await asyncio.shield(running)
+            return False
+
+        started = time.perf_counter()
+        running = self._running[step] = asyncio.ensure_future(func(*args))
+        try:
+            await running
+        finally:
+            del self._running[step]
+        self._done.add(step)
+        if self.profiler is not None:
+            self.profiler.add(step, time.perf_counter() - started)
+        return True
+
+    def run_in_background(self, step: str, func, *args) -> None:
+        """Starts a step as a task, errors are logged."""
+        if step in self._done or step in self._running:
+            return
+
+        async def run():
+            try:
+                await self.run(step, func, *args)
+            except Exception:
+                logger.error("Failed to run %s.", step, exc_info=True)
+
+        asyncio.ensure_future(run())
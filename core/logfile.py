@@ -0,0 +1,119 @@
+"""
+Reading of the application log file.
+
+The log file can reach a few megabytes before it is rotated, so it is never
+read as a whole: `LogTail` reads it backwards from the end, one chunk at a
+time, and `read_chunks` streams it for uploads.
+"""
+import os
+import typing
+
+# The size of the chunks read from the log file.
+CHUNK_SIZE = 64 * 1024
+
+
+def paginate(text: str, limit: int = 2000) -> typing.List[str]:
+    """Splits log lines into code block messages of at most `limit` characters."""
+    messages = []
+
+    # Using Scala formatting because it's similar to Python for exceptions
+    # and it does a fine job formatting the logs.
+    msg = "```Scala\n"
+
+    for line in text.splitlines(keepends=True):
+        if msg != "```Scala\n":
+            if len(line) + len(msg) + 3 > limit:
+                msg += "```"
+                messages.append(msg)
+                msg = "```Scala\n"
+        msg += line
+        if len(msg) + 3 > limit:
+            msg = msg[: limit - 7] + "[...]```"
+            messages.append(msg)
+            msg = "```Scala\n"
+
+    if msg != "```Scala\n":
+        msg += "```"
+        messages.append(msg)
+    return messages
+
+
+class LogTail:
+    """
+    Reads a log file backwards, from the most recent lines.
+
+    Parameters
+    ----------
+    path : str
+        The log file.
+    chunk_size : int
+        The number of bytes read at once. Lines are never cut, a chunk
+        starts at the first line starting in it.
+
+    Attributes
+    ----------
+    position : int, optional
+        The offset of the oldest line read so far, `None` before the first read.
+    """
+
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.position = None
+        self._inode = None
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether the start of the file was reached."""
+        return self.position == 0
+
+    def older(self) -> str:
+        """
+        Reads the lines preceding the ones already read.
+
+        Returns
+        -------
+        str
+            The lines, empty once the start of the file is reached or if
+            the file was rotated since the first read.
+        """
+        if self.exhausted:
+            return ""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            self.position = 0
+            return ""
+        with f:
+            stat = os.fstat(f.fileno())
+            if self.position is None:
+                self.position = stat.st_size
+                self._inode = stat.st_ino
+            elif stat.st_ino != self._inode or stat.st_size < self.position:
+                # Rotated, the offsets are in another file now
+                self.position = 0
+                return ""
+
+            start = max(self.position - self.chunk_size, 0)
+            f.seek(start)
+            data = f.read(self.position - start)
+
+        if start > 0:
+            # Leave the partial first line to the next chunk, unless it
+            # fills the whole chunk
+            cut = data.find(b"\n") + 1
+            if cut < len(data):
+                data = data[cut:]
+                start += cut
+        self.position = start
+        return data.decode("utf-8", "replace")
+
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """Yields the content of the file `path`, `chunk_size` bytes at a time."""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
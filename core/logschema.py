@@ -0,0 +1,332 @@
+"""
+The versioned schema of log documents.
+
+Version 1 (the default) repeats the whole author object, a stringified
+timestamp and an attachment list in every message. Version 2 stores each
+author once per log, in the `participants` map keyed by user ID, and
+messages only keep what differs::
+
+    {
+        "version": 2,
+        "participants": {"<user id>": {"name", "discriminator", "avatar_url"}},
+        "messages": [
+            {
+                "message_id": str,
+                "timestamp": datetime,
+                "author": "<user id>",
+                "content": str,
+                "mod": True,            # only for moderators
+                "type": str,            # only when not "thread_message"
+                "attachments": [...],   # only when present
+                "edited": True,         # only when edited
+            }
+        ]
+    }
+
+Participants are keyed by ID rather than by list index so a message and its
+author are written in a single idempotent update, without reading the log.
+Readers go through `expand_log`, which returns version 1 documents whatever
+the stored version, messages are converted one by one so a log can hold
+both formats.
+
+The module can be run as a script to migrate closed logs or to compare
+document sizes on a synthetic corpus::
+
+    python -m core.logschema migrate --mongo-uri <uri>
+    python -m core.logschema bench --logs 200 --messages 150
+"""
+import asyncio
+import logging
+import os
+import random
+import secrets
+import typing
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("Modmail")
+
+SCHEMA_VERSION = 2
+DEFAULT_TYPE = "thread_message"
+PARTICIPANT_FIELDS = ("name", "discriminator", "avatar_url")
+
+
+def _parse_timestamp(value) -> typing.Any:
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return value
+
+
+def compact_author(author: dict) -> typing.Tuple[str, dict]:
+    """Splits an author object into its ID and its participant entry."""
+    return str(author["id"]), {k: author.get(k) for k in PARTICIPANT_FIELDS}
+
+
+def compact_message(message: dict) -> typing.Tuple[dict, typing.Optional[tuple]]:
+    """
+    Converts a version 1 message.
+
+    Returns
+    -------
+    Tuple[Dict[str, Any], Optional[Tuple[str, Dict[str, Any]]]]
+        The compact message and the ``(id, participant)`` of its author,
+        `None` if the message is already compact.
+    """
+    author = message.get("author")
+    if not isinstance(author, dict):
+        return message, None
+
+    author_id, participant = compact_author(author)
+    compact = {
+        "message_id": message.get("message_id"),
+        "timestamp": _parse_timestamp(message.get("timestamp")),
+        "author": author_id,
+        "content": message.get("content"),
+    }
+    if author.get("mod"):
+        compact["mod"] = True
+    if message.get("type", DEFAULT_TYPE) != DEFAULT_TYPE:
+        compact["type"] = message["type"]
+    if message.get("attachments"):
+        compact["attachments"] = message["attachments"]
+    if message.get("edited"):
+        compact["edited"] = True
+    return compact, (author_id, participant)
+
+
+def expand_message(message: dict, participants: dict) -> dict:
+    """Converts a message to the version 1 format, version 1 messages are returned as-is."""
+    author_id = message.get("author")
+    if not isinstance(author_id, str):
+        return message
+
+    participant = participants.get(author_id) or {}
+    timestamp = message.get("timestamp")
+    expanded = {
+        "timestamp": str(timestamp) if timestamp is not None else None,
+        "message_id": message.get("message_id"),
+        "author": {
+            "id": author_id,
+            "name": participant.get("name"),
+            "discriminator": participant.get("discriminator"),
+            "avatar_url": participant.get("avatar_url"),
+            "mod": bool(message.get("mod")),
+        },
+        "content": message.get("content"),
+        "type": message.get("type", DEFAULT_TYPE),
+        "attachments": message.get("attachments", []),
+    }
+    if message.get("edited"):
+        expanded["edited"] = True
+    return expanded
+
+
+def compact_log(log: dict) -> dict:
+    """Returns a copy of a log document in the version 2 format."""
+    compact = {k: v for k, v in log.items() if k != "messages"}
+    participants = dict(log.get("participants") or {})
+    messages = []
+    for message in log.get("messages") or []:
+        message, author = compact_message(message)
+        if author is not None:
+            participants.setdefault(*author)
+        messages.append(message)
+    compact["version"] = SCHEMA_VERSION
+    compact["participants"] = participants
+    compact["messages"] = messages
+    return compact
+
+
+def expand_log(log: typing.Optional[dict]) -> typing.Optional[dict]:
+    """
+    Returns a log document in the version 1 format.
+
+    Documents without compact messages are returned unchanged.
+    """
+    if not log or "participants" not in log:
+        return log
+    participants = log["participants"] or {}
+    expanded = {k: v for k, v in log.items() if k not in {"participants", "version"}}
+    if "messages" in log:
+        expanded["messages"] = [expand_message(m, participants) for m in log["messages"]]
+    return expanded
+
+
+def message_update(message: dict, compact: bool) -> dict:
+    """
+    Returns the update appending a version 1 `message` to a log.
+
+    Parameters
+    ----------
+    message : Dict[str, Any]
+        The message, as built by `ApiClient.append_log`.
+    compact : bool
+        Whether to append it in the version 2 format.
+    """
+    if not compact:
+        return {"$push": {"messages": message}}
+    message, (author_id, participant) = compact_message(message)
+    return {
+        "$push": {"messages": message},
+        "$set": {f"participants.{author_id}": participant, "version": SCHEMA_VERSION},
+    }
+
+
+# Migration
+
+
+async def migrate(collection, batch_size: int = 100, concurrency: int = 8) -> int:
+    """
+    Converts the closed version 1 logs of `collection` to version 2.
+
+    Open logs are left alone, messages are still appended to them.
+    Returns the number of migrated logs.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    migrated = 0
+
+    async def convert(log):
+        nonlocal migrated
+        async with semaphore:
+            result = await collection.replace_one(
+                {"_id": log["_id"], "version": {"$exists": False}}, compact_log(log)
+            )
+            migrated += result.modified_count
+
+    query = {"open": False, "version": {"$exists": False}}
+    batch = []
+    async for log in collection.find(query):
+        batch.append(convert(log))
+        if len(batch) >= batch_size:
+            await asyncio.gather(*batch)
+            batch = []
+            logger.info("Migrated %d logs.", migrated)
+    await asyncio.gather(*batch)
+    return migrated
+
+
+# Benchmark
+
+
+def synthetic_corpus(logs: int, messages: int, seed: int = 0) -> typing.List[dict]:
+    """Generates version 1 logs with two to four participants each."""
+    rng = random.Random(seed)
+    words = "hello thanks ban appeal please help report user server rules mute".split()
+    corpus = []
+    for _ in range(logs):
+        people = [
+            {
+                "id": str(rng.randrange(10 ** 17, 10 ** 18)),
+                "name": "".join(rng.choice("abcdefghij") for _ in range(rng.randint(4, 12))),
+                "discriminator": f"{rng.randint(1, 9999):04d}",
+                "avatar_url": "https://cdn.discordapp.com/avatars/"
+                f"{rng.randrange(10 ** 17, 10 ** 18)}/{secrets.token_hex(16)}.png?size=1024",
+                "mod": i > 0,
+            }
+            for i in range(rng.randint(2, 4))
+        ]
+        start = datetime(2019, 1, 1) + timedelta(minutes=rng.randrange(500000))
+        key = secrets.token_hex(6)
+        log = {
+            "_id": key,
+            "key": key,
+            "open": False,
+            "created_at": str(start),
+            "closed_at": str(start + timedelta(hours=2)),
+            "channel_id": str(rng.randrange(10 ** 17, 10 ** 18)),
+            "guild_id": "1",
+            "bot_id": "2",
+            "recipient": people[0],
+            "creator": people[0],
+            "closer": people[-1],
+            "messages": [],
+        }
+        for n in range(messages):
+            author = rng.choice(people)
+            attachments = []
+            if rng.random() < 0.05:
+                attachments.append(
+                    {
+                        "id": rng.randrange(10 ** 17, 10 ** 18),
+                        "filename": "image.png",
+                        "is_image": True,
+                        "size": rng.randint(1000, 10 ** 6),
+                        "url": "https://cdn.discordapp.com/attachments/image.png",
+                    }
+                )
+            log["messages"].append(
+                {
+                    "timestamp": str(start + timedelta(seconds=n * 30, microseconds=n)),
+                    "message_id": str(rng.randrange(10 ** 17, 10 ** 18)),
+                    "author": dict(author),
+                    "content": " ".join(rng.choice(words) for _ in range(rng.randint(1, 25))),
+                    "type": "thread_message",
+                    "attachments": attachments,
+                }
+            )
+        corpus.append(log)
+    return corpus
+
+
+def _document_size(doc: dict) -> int:
+    try:
+        import bson
+
+        return len(bson.BSON.encode(doc))
+    except ImportError:
+        from core.storage import dumps
+
+        return len(dumps(doc).encode("utf-8"))
+
+
+def benchmark(logs: int, messages: int) -> None:
+    corpus = synthetic_corpus(logs, messages)
+    before = sum(_document_size(log) for log in corpus)
+    compacted = [compact_log(log) for log in corpus]
+    after = sum(_document_size(log) for log in compacted)
+    if any(expand_log(c) != log for c, log in zip(compacted, corpus)):
+        raise RuntimeError("Version 2 logs do not expand back to the original documents.")
+
+    print(f"{logs} logs, {messages} messages each")
+    print(f"version 1: {before / 1024:10.1f} KiB ({before / logs / 1024:.1f} KiB per log)")
+    print(f"version 2: {after / 1024:10.1f} KiB ({after / logs / 1024:.1f} KiB per log)")
+    print(f"saved:     {100 - after * 100 / before:10.1f} %")
+
+
+def main() -> None:
+    import argparse
+
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Log schema tools.")
+    parser.add_argument("action", choices=["migrate", "bench"])
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--logs", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=150)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.action == "bench":
+        benchmark(args.logs, args.messages)
+        return
+
+    storage = StorageBackend.from_config(
+        {
+            "database_type": args.database_type,
+            "mongo_uri": args.mongo_uri,
+            "sqlite_path": args.sqlite_path,
+        },
+        "temp",
+    )
+    loop = asyncio.get_event_loop()
+    count = loop.run_until_complete(migrate(storage.db.logs))
+    logger.info("Migrated %d logs to version %d.", count, SCHEMA_VERSION)
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
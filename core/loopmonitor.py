@@ -0,0 +1,185 @@
+"""
+Event loop health monitoring.
+
+`LoopMonitor` measures the scheduling lag of the event loop: a sampler
+task sleeps for `interval` seconds and records how late it wakes up. The
+lag is how long every callback, listener and relayed message waits before
+it can run.
+
+A watchdog thread checks that the sampler keeps running. When the loop
+is held for longer than `threshold`, it captures the stack of the loop
+thread, i.e. the code blocking it, logs it and keeps it with the stall
+duration. Blocking calls (file reads, ``subprocess.run``, CPU-heavy
+parsing) show up there with their call site.
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+import typing
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger("Modmail")
+
+# The number of stack frames kept for a stall, innermost last.
+STACK_DEPTH = 12
+
+
+def _percentiles(samples: typing.Iterable[float]) -> dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    return {"p50": rank(0.5), "p95": rank(0.95), "p99": rank(0.99), "max": ordered[-1]}
+
+
+class Stall:
+    """
+    A period the event loop was blocked.
+
+    Attributes
+    ----------
+    timestamp : datetime
+        When the stall was detected.
+    duration : float
+        How long the loop was held, in seconds. It grows until the stall ends.
+    stack : List[str]
+        The formatted stack of the loop thread when the stall was detected.
+    ended : bool
+        Whether the loop is running again.
+    """
+
+    __slots__ = ("timestamp", "duration", "stack", "ended")
+
+    def __init__(self, duration: float, stack: typing.List[str]):
+        self.timestamp = datetime.utcnow()
+        self.duration = duration
+        self.stack = stack
+        self.ended = False
+
+    def to_dict(self) -> dict:
+        return {
+            "timestamp": self.timestamp.isoformat(),
+            "duration": self.duration,
+            "ended": self.ended,
+            "stack": self.stack,
+        }
+
+
+class LoopMonitor:
+    """
+    Samples the event loop lag and detects blocking calls.
+
+    Parameters
+    ----------
+    loop : asyncio.AbstractEventLoop
+        The monitored loop.
+    interval : float
+        The sampling interval in seconds.
+    threshold : float
+        The time in seconds the loop must be held to be reported as a stall.
+    window : int
+        The number of lag samples the percentiles are computed on.
+
+    Attributes
+    ----------
+    lag : Deque[float]
+        The recent lag samples, in seconds.
+    stalls : Deque[Stall]
+        The recent stalls.
+    stall_count : int
+        The number of stalls since the start.
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        interval: float = 0.25,
+        threshold: float = 0.5,
+        window: int = 1200,
+    ):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = deque(maxlen=window)
+        self.stalls = deque(maxlen=20)
+        self.stall_count = 0
+        self.started = None
+        self._heartbeat = None
+        self._current = None
+        self._thread_id = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """Starts monitoring, must be called from the thread running the loop."""
+        if self._task is not None:
+            return
+        self.started = datetime.utcnow()
+        self._thread_id = threading.get_ident()
+        self._heartbeat = time.perf_counter()
+        self._stop.clear()
+        self._task = self.loop.create_task(self._sample())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _sample(self) -> None:
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.perf_counter()
+            lag = max(now - expected, 0.0)
+            self.lag.append(lag)
+            self._heartbeat = now
+
+            stall = self._current
+            if stall is not None:
+                self._current = None
+                stall.duration = max(stall.duration, lag)
+                stall.ended = True
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 4):
+            held = time.perf_counter() - self._heartbeat - self.interval
+            if held < self.threshold:
+                continue
+            if self._current is not None:
+                self._current.duration = held
+                continue
+
+            frame = sys._current_frames().get(self._thread_id)
+            stack = traceback.format_stack(frame)[-STACK_DEPTH:] if frame is not None else []
+            self._current = Stall(held, stack)
+            self.stalls.append(self._current)
+            self.stall_count += 1
+            logger.warning(
+                "The event loop is blocked (%.0fms so far) by:\n%s",
+                held * 1000,
+                "".join(stack[-4:]).rstrip(),
+            )
+
+    def percentiles(self) -> dict:
+        """The lag percentiles over the window, in seconds."""
+        return _percentiles(self.lag)
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started.isoformat() if self.started else None,
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "samples": len(self.lag),
+            "lag": self.percentiles(),
+            "stall_count": self.stall_count,
+            "stalls": [stall.to_dict() for stall in self.stalls],
+        }
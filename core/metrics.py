@@ -0,0 +1,425 @@
+"""
+Operational metrics in the Prometheus text format.
+
+`MetricsRegistry` holds counters, gauges and histograms. Recording is a
+dict lookup and an addition, cheap enough for the relay path::
+
+    bot.metrics.commands.labels("reply", "ok").inc()
+    bot.metrics.command_seconds.labels("reply").observe(0.25)
+
+Values that already exist elsewhere (pool statistics, open threads, loop
+lag, database operations) are read when the metrics are scraped, by the
+collectors added with `MetricsRegistry.collector`.
+
+When ``METRICS_PORT`` is set, `MetricsServer` serves them on
+``http://METRICS_HOST:METRICS_PORT/metrics``, with the ``/healthz``
+(liveness) and ``/readyz`` (readiness) probes.
+"""
+import bisect
+import json
+import logging
+import math
+import typing
+
+logger = logging.getLogger("Modmail")
+
+# Histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The loop lag over which the bot is reported as not alive, in seconds.
+LIVENESS_LAG = 5
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: typing.Sequence[str], values: typing.Sequence[str], extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: typing.Sequence[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric:
+    """
+    A metric family, its label values select a child.
+
+    Parameters
+    ----------
+    name : str
+        The metric name, without the registry prefix.
+    documentation : str
+        The ``HELP`` text.
+    labelnames : Sequence[str]
+        The label names, the same for every child.
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _child(self):
+        return _Value()
+
+    def labels(self, *values: str):
+        """Returns the child of the label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects the labels {self.labelnames}.")
+            child = self._children[values] = self._child()
+        return child
+
+    def clear(self) -> None:
+        self._children.clear()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def render(self, name: str) -> typing.List[str]:
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.kind}"]
+        for values, child in self._children.items():
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{name}{labels} {_format_value(child.value)}")
+        return lines
+
+
+class Counter(Metric):
+    """A value that only goes up, like a number of events."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, like a number of open threads."""
+
+    kind = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self._default.dec(amount)
+
+    def set(self, value: float) -> None:
+        self._default.set(value)
+
+
+class Histogram(Metric):
+    """The distribution of observed values, like durations in seconds."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: typing.Sequence[str] = (),
+        buckets: typing.Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.buckets = tuple(sorted(b for b in buckets if b != float("inf")))
+        super().__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default.observe(value)
+
+    def render(self, name: str) -> typing.List[str]:
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} histogram"]
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{name}_count{labels} {child.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    The metrics of the bot.
+
+    Parameters
+    ----------
+    prefix : str
+        Prepended to every metric name.
+    """
+
+    def __init__(self, prefix: str = "modmail_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self._collectors = []
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"The metric {metric.name} is already registered.")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, func: typing.Callable[[], None]) -> typing.Callable[[], None]:
+        """Adds a function run before each scrape, to update the metrics it owns."""
+        self._collectors.append(func)
+        return func
+
+    def collect(self) -> None:
+        for func in self._collectors:
+            try:
+                func()
+            except Exception:
+                logger.warning("Metrics collector %r failed.", func, exc_info=True)
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.extend(metric.render(self.prefix + name))
+        return "\n".join(lines) + "\n"
+
+
+class BotMetrics(MetricsRegistry):
+    """The metrics recorded by the bot itself."""
+
+    def __init__(self, prefix: str = "modmail_"):
+        super().__init__(prefix)
+        self.relayed = self.counter(
+            "messages_relayed_total",
+            "Messages relayed between users and thread channels.",
+            ("direction", "status"),
+        )
+        self.relay_seconds = self.histogram(
+            "relay_seconds", "Time to relay a message.", ("direction",)
+        )
+        self.threads_created = self.counter("threads_created_total", "Threads created.")
+        self.threads_closed = self.counter(
+            "threads_closed_total", "Threads closed.", ("scheduled",)
+        )
+        self.commands = self.counter(
+            "commands_total", "Command invocations.", ("command", "status")
+        )
+        self.command_seconds = self.histogram(
+            "command_seconds", "Duration of command invocations.", ("command",)
+        )
+        self.http_requests = self.counter(
+            "http_requests_total",
+            "HTTP requests, Discord REST calls and external APIs.",
+            ("api", "route", "method", "status"),
+        )
+        self.http_seconds = self.histogram(
+            "http_request_seconds", "Duration of HTTP requests.", ("api", "method")
+        )
+        self.config_writes = self.counter("config_writes_total", "Config writes.")
+
+
+def register_collectors(bot) -> None:
+    """Adds the collectors reading the state of `bot` into `bot.metrics`."""
+    metrics = bot.metrics
+
+    threads_open = metrics.gauge("threads_open", "Threads currently open.")
+    gateway_latency = metrics.gauge("gateway_latency_seconds", "Websocket latency.")
+    connected = metrics.gauge("connected", "Whether the bot is connected to Discord.")
+
+    @metrics.collector
+    def collect_bot():
+        threads_open.set(len(bot.threads.cache))
+        latency = bot.latency
+        gateway_latency.set(0 if math.isnan(latency) else latency)  # NaN before connecting
+        connected.set(int(bot._connected.is_set()))
+
+    pool_gauges = {
+        name: metrics.gauge(f"db_pool_{name}", f"Database connection pool {name}.", ("pool",))
+        for name in ("checkouts", "failed", "in_use", "open", "wait_p50", "wait_p99", "wait_max")
+    }
+
+    @metrics.collector
+    def collect_pools():
+        for pool, stats in bot.storage.pool_stats().items():
+            for name, gauge in pool_gauges.items():
+                gauge.labels(pool).set(stats.get(name, 0))
+
+    if bot.query_profiler is not None:
+        from core.dbprofiler import BUCKETS
+
+        db_seconds = metrics.histogram(
+            "db_operation_seconds",
+            "Duration of database operations.",
+            ("collection", "operation"),
+            buckets=[bound / 1000 for bound in BUCKETS],
+        )
+        db_errors = metrics.counter(
+            "db_operation_errors_total", "Failed database operations.", ("collection", "operation")
+        )
+
+        @metrics.collector
+        def collect_queries():
+            # Rebuilt from the query profiler, `debug queries reset` resets them
+            for (name, op), stats in bot.query_profiler.operations.items():
+                child = db_seconds.labels(name, op)
+                child.counts = list(stats.buckets)
+                child.sum = stats.total / 1000
+                child.count = stats.count
+                db_errors.labels(name, op).value = stats.errors
+
+    if bot.loop_monitor is not None:
+        loop_lag = metrics.gauge("loop_lag_seconds", "Event loop lag.", ("quantile",))
+        loop_stalls = metrics.counter("loop_stalls_total", "Times the event loop was blocked.")
+
+        @metrics.collector
+        def collect_loop():
+            for name, value in bot.loop_monitor.percentiles().items():
+                loop_lag.labels(name).set(value)
+            # Counted by the monitor, the counter mirrors its total
+            loop_stalls.labels().value = bot.loop_monitor.stall_count
+
+    plugins = bot.get_cog("Plugins")
+    workers = getattr(plugins, "workers", None)
+    if workers is not None:
+        worker_gauges = {
+            name: metrics.gauge(f"plugin_worker_{name}", f"Isolated plugin {name}.", ("plugin",))
+            for name in ("events", "dropped", "errors", "restarts", "cpu")
+        }
+
+        @metrics.collector
+        def collect_workers():
+            for gauge in worker_gauges.values():
+                gauge.clear()
+            for key, worker in workers.workers.items():
+                stats = worker.stats.to_dict()
+                for name, gauge in worker_gauges.items():
+                    gauge.labels(key).set(stats[name])
+
+
+class MetricsServer:
+    """
+    Serves the metrics and the health probes over HTTP.
+
+    Parameters
+    ----------
+    bot : ModmailBot
+        The Modmail bot.
+    host : str
+        The address to listen on.
+    port : int
+        The port to listen on.
+    """
+
+    def __init__(self, bot, host: str, port: int):
+        self.bot = bot
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    def liveness(self) -> typing.Tuple[bool, dict]:
+        """The loop answered, and wasn't held too long recently."""
+        monitor = self.bot.loop_monitor
+        lag = max(list(monitor.lag)[-20:], default=0.0) if monitor is not None else 0.0
+        return lag < LIVENESS_LAG, {"lag": lag}
+
+    def readiness(self) -> typing.Tuple[bool, dict]:
+        """Connected to Discord, with the config loaded."""
+        state = self.bot.lifecycle.state
+        checks = {
+            "connected": self.bot._connected.is_set() and not self.bot.is_closed(),
+            "config": self.bot.config.ready_event.is_set(),
+            "state": state,
+        }
+        return checks["connected"] and checks["config"] and state == "ready", checks
+
+    async def start(self) -> None:
+        from aiohttp import web
+
+        async def metrics(request):
+            return web.Response(
+                text=self.bot.metrics.render(), content_type="text/plain", charset="utf-8"
+            )
+
+        def probe(check):
+            async def handler(request):
+                ok, details = check()
+                return web.Response(
+                    status=200 if ok else 503,
+                    text=json.dumps({"status": "ok" if ok else "fail", **details}),
+                    content_type="application/json",
+                )
+
+            return handler
+
+        app = web.Application()
+        app.router.add_get("/metrics", metrics)
+        app.router.add_get("/healthz", probe(self.liveness))
+        app.router.add_get("/readyz", probe(self.readiness))
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Serving metrics on http://%s:%d/metrics.", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
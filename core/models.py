@@ -1,4 +1,13 @@
+import gzip
+import logging
+import os
+import queue
+import re
+import shutil
+import sys
 from enum import IntEnum
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from string import Formatter
 
 from discord import Color, Embed
 from discord.ext import commands
@@ -24,3 +33,133 @@ class InvalidConfigError(commands.BadArgument):
     @property
     def embed(self):
         return Embed(title="Error", description=self.msg, color=Color.red())
+
+
+class SafeFormatter(Formatter):
+    """A `str.format` that only substitutes plain names, for user supplied formats."""
+
+    def get_field(self, field_name, args, kwargs):
+        if "." in field_name or "[" in field_name:
+            return "<Invalid>", field_name
+        return super().get_field(field_name, args, kwargs)
+
+    def get_value(self, key, args, kwargs):
+        try:
+            return super().get_value(key, args, kwargs)
+        except (IndexError, KeyError):
+            return "<Invalid>"
+
+
+class ModmailLogger(logging.Logger):
+    def line(self, level: str = "info") -> None:
+        """Logs a separator line."""
+        getattr(self, level)("-" * 30)
+
+
+logging.setLoggerClass(ModmailLogger)
+
+# The size of the log file before it is rotated, and the number of rotated
+# files kept (compressed).
+LOG_MAX_BYTES = 2 * 1024 * 1024
+LOG_BACKUPS = 5
+
+log_level = logging.INFO
+loggers = set()
+
+ch = logging.StreamHandler(stream=sys.stdout)
+ch.setLevel(log_level)
+ch.setFormatter(
+    logging.Formatter(
+        "%(asctime)s %(name)s[%(lineno)d] - %(levelname)s: %(message)s",
+        datefmt="%m/%d/%y %H:%M:%S",
+    )
+)
+
+# Once logging is configured, records are put in a queue and written to the
+# console and the log file by a listener thread, so the event loop never
+# waits on a write, a flush or a rotation.
+_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_queue)
+_listener = None
+
+
+def getLogger(name: str = None) -> ModmailLogger:
+    logger = logging.getLogger(name)
+    logger.setLevel(log_level)
+    logger.addHandler(ch if _listener is None else _queue_handler)
+    loggers.add(logger)
+    return logger
+
+
+class FileFormatter(logging.Formatter):
+    """Strips the terminal colors from the records."""
+
+    ansi_escape = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
+
+    def format(self, record):
+        return self.ansi_escape.sub("", super().format(record))
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """A `RotatingFileHandler` that gzips the rotated files."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.namer = lambda name: name + ".gz"
+
+    def rotator(self, source: str, dest: str) -> None:
+        with open(source, "rb") as src, gzip.open(dest, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+
+def configure_logging(name: str, level: int = None) -> None:
+    """
+    Starts writing the logs to the file `name`, through the logging queue.
+
+    Parameters
+    ----------
+    name : str
+        The path of the log file, rotated to ``name.1.gz``, ``name.2.gz``...
+    level : int, optional
+        The logging level, defaults to the current one.
+    """
+    global _listener, log_level
+
+    file_handler = CompressedRotatingFileHandler(
+        name, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    file_handler.setFormatter(
+        FileFormatter(
+            "%(asctime)s %(name)s[%(lineno)d] - %(levelname)s: %(message)s",
+            datefmt="%Y-%m-%d %H:%M:%S",
+        )
+    )
+    file_handler.setLevel(logging.DEBUG)
+
+    if level is not None:
+        log_level = level
+    ch.setLevel(log_level)
+
+    stop_logging()
+    _listener = QueueListener(_queue, ch, file_handler, respect_handler_level=True)
+    _listener.start()
+
+    # The modules log to the "Modmail" logger
+    loggers.add(logging.getLogger("Modmail"))
+    for logger in loggers:
+        logger.setLevel(log_level)
+        logger.removeHandler(ch)
+        logger.addHandler(_queue_handler)
+
+
+def stop_logging() -> None:
+    """Writes the queued records and stops the listener thread."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        if handler is not ch:
+            handler.close()
+    _listener = None
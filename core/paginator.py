@@ -5,6 +5,8 @@ from discord import User, Reaction, Message, Embed
 from discord import HTTPException, InvalidArgument
 from discord.ext import commands
 
+from core.logfile import paginate
+
 
 class PaginatorSession:
     """
@@ -408,3 +410,51 @@ class MessagePaginatorSession:
         Go to the last page.
         """
         await self.show_page(len(self.messages) - 1)
+
+
+class LogPaginatorSession(MessagePaginatorSession):
+    """
+    A `MessagePaginatorSession` over a log file, starting from its end.
+
+    The older pages are only read when they are reached.
+
+    Parameters
+    ----------
+    ctx : Context
+        The context of the command.
+    tail : LogTail
+        The reader of the log file.
+    messages : List[str]
+        The pages of the most recent lines.
+    """
+
+    def __init__(self, ctx: commands.Context, tail, *messages, **options):
+        super().__init__(ctx, *messages, **options)
+        self.tail = tail
+        self.current = len(self.messages) - 1
+        if not tail.exhausted:
+            # There are always older pages to go to
+            self.reaction_map.pop("⏮")
+
+    async def load_older(self) -> bool:
+        """
+        Prepends the pages of the previous chunk of the file.
+
+        Returns
+        -------
+        bool
+            Whether there were older pages.
+        """
+        loop = self.ctx.bot.loop
+        while not self.tail.exhausted:
+            pages = paginate(await loop.run_in_executor(None, self.tail.older))
+            if pages:
+                self.messages[:0] = pages
+                self.current += len(pages)
+                return True
+        return False
+
+    async def previous_page(self) -> None:
+        if self.current == 0:
+            await self.load_older()
+        await super().previous_page()
@@ -0,0 +1,231 @@
+"""
+Latency profiling of event listeners and commands.
+
+Every listener scheduled by ``dispatch`` (the bot's own ``on_*`` methods,
+cog and plugin listeners) and every command invocation is timed and
+recorded in a `LatencyProfiler`. Three durations are measured:
+
+- wall: from the start of the handler until it returns, awaits included;
+- busy: the time the handler held the event loop, the sum of its steps
+  between awaits. This is the time it delayed every other handler;
+- cpu: the CPU time of the loop thread during those steps, a busy time
+  well above the CPU time means blocking I/O on the loop.
+
+For commands, the checks and argument converters are also timed apart.
+The durations are inclusive: ``on_message`` includes the commands it
+invokes.
+
+Statistics are kept per handler and per cog, over a rolling window of
+the most recent calls.
+"""
+import json
+import time
+import typing
+from collections import deque
+from datetime import datetime
+
+# The number of recent calls the percentiles are computed on.
+WINDOW = 512
+
+
+def _percentiles(samples: typing.Iterable[float]) -> dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    return {"p50": rank(0.5), "p95": rank(0.95), "p99": rank(0.99), "max": ordered[-1]}
+
+
+class HandlerStats:
+    """The statistics of a handler or a cog, durations are in milliseconds."""
+
+    __slots__ = ("count", "errors", "wall_total", "busy_total", "cpu_total", "wall", "busy")
+
+    def __init__(self, window: int = WINDOW):
+        self.count = 0
+        self.errors = 0
+        self.wall_total = 0.0
+        self.busy_total = 0.0
+        self.cpu_total = 0.0
+        self.wall = deque(maxlen=window)
+        self.busy = deque(maxlen=window)
+
+    def add(self, wall: float, busy: float, cpu: float, error: bool) -> None:
+        self.count += 1
+        self.errors += error
+        self.wall_total += wall
+        self.busy_total += busy
+        self.cpu_total += cpu
+        self.wall.append(wall)
+        self.busy.append(busy)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "wall_mean": self.wall_total / self.count if self.count else 0.0,
+            "busy_total": self.busy_total,
+            "cpu_total": self.cpu_total,
+            "wall": _percentiles(self.wall),
+            "busy": _percentiles(self.busy),
+        }
+
+
+class TimedCoroutine:
+    """
+    Awaits a coroutine while measuring the time its steps hold the loop.
+
+    Attributes
+    ----------
+    busy : float
+        The wall time of the steps, in milliseconds.
+    cpu : float
+        The CPU time of the loop thread during the steps, in milliseconds.
+    """
+
+    __slots__ = ("coro", "busy", "cpu")
+
+    def __init__(self, coro: typing.Coroutine):
+        self.coro = coro
+        self.busy = 0.0
+        self.cpu = 0.0
+
+    def __await__(self):
+        coro = self.coro
+        value = None
+        error = None
+        while True:
+            started = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                if error is None:
+                    future = coro.send(value)
+                else:
+                    future = coro.throw(error)
+            except StopIteration as exc:
+                return exc.value
+            finally:
+                self.busy += (time.perf_counter() - started) * 1000
+                self.cpu += (time.thread_time() - cpu) * 1000
+            value = error = None
+            try:
+                value = yield future
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as exc:
+                error = exc
+
+
+class LatencyProfiler:
+    """
+    Records the latency of listeners and commands.
+
+    Parameters
+    ----------
+    window : int
+        The number of recent calls the percentiles are computed on.
+
+    Attributes
+    ----------
+    handlers : Dict[Tuple[str, str, str], HandlerStats]
+        The statistics by kind (``listener``, ``command`` or ``checks``),
+        cog and handler.
+    cogs : Dict[Tuple[str, str], HandlerStats]
+        The statistics by kind and cog.
+    started : datetime
+        When the statistics started.
+    """
+
+    def __init__(self, window: int = WINDOW):
+        self.window = window
+        self.handlers = {}
+        self.cogs = {}
+        self.started = datetime.utcnow()
+
+    def reset(self) -> None:
+        self.handlers.clear()
+        self.cogs.clear()
+        self.started = datetime.utcnow()
+
+    def record(
+        self,
+        kind: str,
+        cog: str,
+        name: str,
+        wall: float,
+        busy: float = 0.0,
+        cpu: float = 0.0,
+        error: bool = False,
+    ) -> None:
+        """Records a call, the durations are in milliseconds."""
+        for stats, key in ((self.handlers, (kind, cog, name)), (self.cogs, (kind, cog))):
+            entry = stats.get(key)
+            if entry is None:
+                entry = stats[key] = HandlerStats(self.window)
+            entry.add(wall, busy, cpu, error)
+
+    async def time(self, kind: str, cog: str, name: str, coro: typing.Coroutine) -> typing.Any:
+        """Awaits `coro` and records it as a call of `name`."""
+        timed = TimedCoroutine(coro)
+        started = time.perf_counter()
+        error = True
+        try:
+            result = await timed
+            error = False
+            return result
+        finally:
+            wall = (time.perf_counter() - started) * 1000
+            self.record(kind, cog, name, wall, timed.busy, timed.cpu, error)
+
+    def wrap_listener(self, func: typing.Callable, event_name: str) -> typing.Callable:
+        """Returns `func` timed as a listener of `event_name`."""
+        owner = getattr(func, "__self__", None)
+        if owner is None:
+            cog = func.__module__
+        else:
+            cog = getattr(owner, "qualified_name", None) or type(owner).__name__
+        name = func.__name__
+        if name != event_name:
+            name = f"{event_name}:{name}"
+
+        async def timed(*args, **kwargs):
+            return await self.time("listener", cog, name, func(*args, **kwargs))
+
+        return timed
+
+    def summary(self, kind: str = None, by_cog: bool = False) -> typing.List[tuple]:
+        """
+        Returns ``(kind, cog[, name], stats)`` tuples sorted by the total
+        time the handlers held the loop.
+        """
+        stats = self.cogs if by_cog else self.handlers
+        rows = [
+            key + (entry.to_dict(),)
+            for key, entry in stats.items()
+            if kind is None or key[0] == kind
+        ]
+        rows.sort(key=lambda row: (row[-1]["busy_total"], row[-1]["wall_mean"]), reverse=True)
+        return rows
+
+    def to_dict(self) -> dict:
+        return {
+            "started": self.started.isoformat(),
+            "window": self.window,
+            "cogs": [
+                {"kind": kind, "cog": cog, **stats}
+                for kind, cog, stats in self.summary(by_cog=True)
+            ],
+            "handlers": [
+                {"kind": kind, "cog": cog, "name": name, **stats}
+                for kind, cog, name, stats in self.summary()
+            ],
+        }
+
+    def dump(self, path: str) -> None:
+        """Writes the statistics to a JSON file."""
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2)
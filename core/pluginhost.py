@@ -0,0 +1,501 @@
+"""
+Isolated plugins, run in worker processes.
+
+`PluginHost` starts a worker (see `core.pluginworker`) for each plugin
+in ``isolated_plugins``. Each event the worker listens to is serialized
+once and queued for it. The bot never waits for a worker: an event is
+dropped when the worker's queue is full, and a worker that holds an
+event longer than `EVENT_TIMEOUT` is restarted.
+
+Events
+------
+message
+    ``id``, ``channel_id``, ``guild_id`` (``None`` in DMs), ``author``,
+    ``content``, ``created_at``, ``attachments`` (``url``, ``filename``,
+    ``size``) and ``embeds`` (Discord API dicts).
+thread_ready
+    ``id`` (the recipient's ID), ``channel_id`` and ``recipient``.
+thread_close
+    ``thread``, ``closer``, ``silent``, ``delete_channel``, ``message``
+    and ``scheduled``.
+
+Users are ``id``, ``name``, ``discriminator`` and ``bot``.
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+import typing
+from collections import deque
+
+import discord
+
+logger = logging.getLogger("Modmail")
+
+# The number of events queued for a worker before new ones are dropped.
+WORKER_QUEUE_SIZE = 1000
+# A worker holding an event longer than this (seconds) is restarted.
+EVENT_TIMEOUT = 30
+# The number of actions of a worker performed at once.
+ACTION_CONCURRENCY = 5
+# A worker crashing more than MAX_RESTARTS times in RESTART_WINDOW seconds is stopped.
+MAX_RESTARTS = 5
+RESTART_WINDOW = 300
+# The maximum size of a protocol line.
+LINE_LIMIT = 2 ** 22
+
+
+def serialize_user(user) -> typing.Optional[dict]:
+    if user is None:
+        return None
+    return {
+        "id": user.id,
+        "name": user.name,
+        "discriminator": user.discriminator,
+        "bot": user.bot,
+    }
+
+
+def serialize_message(message) -> dict:
+    return {
+        "id": message.id,
+        "channel_id": message.channel.id,
+        "guild_id": message.guild.id if message.guild is not None else None,
+        "author": serialize_user(message.author),
+        "content": message.content,
+        "created_at": message.created_at.isoformat(),
+        "attachments": [
+            {"url": a.url, "filename": a.filename, "size": a.size} for a in message.attachments
+        ],
+        "embeds": [e.to_dict() for e in message.embeds],
+    }
+
+
+def serialize_thread(thread) -> dict:
+    return {
+        "id": thread.id,
+        "channel_id": thread.channel.id if thread.channel is not None else None,
+        "recipient": serialize_user(thread.recipient),
+    }
+
+
+class WorkerStats:
+    """
+    The accounting of a worker, kept across restarts.
+
+    Attributes
+    ----------
+    events : int
+        The events handled.
+    dropped : int
+        The events dropped because the worker was stopped or its queue was full.
+    errors : int
+        The events a listener raised on.
+    timeouts : int
+        The restarts caused by an event held longer than `EVENT_TIMEOUT`.
+    restarts : int
+        The number of restarts.
+    actions : int
+        The actions performed.
+    cpu : float
+        The CPU time of the workers in seconds, including previous processes.
+    latencies : Deque[float]
+        The time from queueing to completion of the recent events.
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.dropped = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.actions = 0
+        self.cpu = 0.0
+        self.handler_cpu = 0.0
+        self.latencies = deque(maxlen=1000)
+        self._cpu_base = 0.0
+
+    def process_started(self) -> None:
+        """The CPU time of a new process adds to the previous ones."""
+        self._cpu_base = self.cpu
+
+    def record(self, latency: typing.Optional[float], payload: dict) -> None:
+        """Records a handled event from the ``done`` message of the worker."""
+        self.events += 1
+        if latency is not None:
+            self.latencies.append(latency)
+        self.handler_cpu += payload.get("cpu") or 0.0
+        self.cpu = self._cpu_base + (payload.get("cpu_total") or 0.0)
+        if payload.get("error"):
+            self.errors += 1
+
+    def percentile(self, percent: float) -> typing.Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "events": self.events,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "actions": self.actions,
+            "cpu": self.cpu,
+            "handler_cpu": self.handler_cpu,
+            "latency_p50": self.percentile(50),
+            "latency_p95": self.percentile(95),
+            "latency_max": max(self.latencies, default=None),
+        }
+
+
+class PluginWorker:
+    """
+    The bot side of a worker process.
+
+    Attributes
+    ----------
+    key : str
+        The plugin, ``user/repo/name@branch``.
+    extension : str
+        The plugin module.
+    status : str
+        ``starting``, ``running``, ``stopped`` or ``crashed``.
+    events : Set[str]
+        The events the plugin listens to.
+    """
+
+    def __init__(self, host: "PluginHost", key: str, extension: str):
+        self.host = host
+        self.key = key
+        self.extension = extension
+        self.status = "stopped"
+        self.events = set()
+        self.pid = None
+        self.started_at = None
+        self.stats = WorkerStats()
+        self._process = None
+        self._queue = None
+        self._pending = {}
+        self._next_id = 0
+        self._tasks = []
+        self._ready = None
+        self._stopping = False
+        self._crashes = deque()
+        self._actions = asyncio.Semaphore(ACTION_CONCURRENCY)
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.host.bot.loop
+
+    async def start(self, timeout: float = 30) -> None:
+        """
+        Starts the worker process and waits for the plugin to be set up.
+
+        Raises
+        ------
+        RuntimeError
+            The plugin failed to start.
+        """
+        self._stopping = False
+        self.status = "starting"
+        self._queue = asyncio.Queue(maxsize=WORKER_QUEUE_SIZE)
+        self._pending = {}
+        self._ready = self.loop.create_future()
+        self._process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "core.pluginworker",
+            self.extension,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=LINE_LIMIT,
+        )
+        self.pid = self._process.pid
+        self.stats.process_started()
+        self._tasks = [
+            self.loop.create_task(self._read()),
+            self.loop.create_task(self._log()),
+            self.loop.create_task(self._write()),
+            self.loop.create_task(self._watch()),
+        ]
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready), timeout)
+        except (asyncio.TimeoutError, RuntimeError) as exc:
+            await self.stop()
+            self.status = "crashed"
+            raise RuntimeError(f"The worker of {self.key} failed to start: {exc}") from exc
+        self.status = "running"
+        self.started_at = time.time()
+        logger.info("Started the worker of %s (pid %s).", self.key, self.pid)
+
+    async def stop(self, timeout: float = 5) -> None:
+        """Asks the worker to exit, it is killed after `timeout` seconds."""
+        self._stopping = True
+        process = self._process
+        if process is not None and process.returncode is None:
+            try:
+                process.stdin.write(b'{"op":"stop"}\n')
+                process.stdin.close()
+            except (OSError, RuntimeError):
+                pass
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Killing the worker of %s.", self.key)
+                process.kill()
+                await process.wait()
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        self._tasks = []
+        if self._queue is not None:
+            self.stats.dropped += self._queue.qsize() + len(self._pending)
+        self._pending = {}
+        self.status = "stopped"
+
+    async def restart(self) -> None:
+        await self.stop()
+        self.stats.restarts += 1
+        await self.start()
+
+    def post(self, event: str, data: dict) -> bool:
+        """Queues an event for the worker, returns `False` if it was dropped."""
+        if self.status != "running" or event not in self.events:
+            return False
+        self._next_id += 1
+        try:
+            self._queue.put_nowait(
+                {"op": "event", "id": self._next_id, "event": event, "data": data}
+            )
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            return False
+        self._pending[self._next_id] = time.perf_counter()
+        return True
+
+    def _send(self, payload: dict) -> None:
+        line = json.dumps(payload, separators=(",", ":"), default=str).encode() + b"\n"
+        self._process.stdin.write(line)
+
+    async def _write(self) -> None:
+        try:
+            while True:
+                self._send(await self._queue.get())
+                await self._process.stdin.drain()
+        except (OSError, RuntimeError):
+            # The worker exited, _read handles it
+            pass
+
+    async def _read(self) -> None:
+        stdout = self._process.stdout
+        while True:
+            try:
+                line = await stdout.readline()
+            except (ValueError, asyncio.LimitOverrunError):
+                logger.error("The worker of %s sent an oversized line.", self.key)
+                self._process.kill()
+                break
+            if not line:
+                break
+            try:
+                payload = json.loads(line)
+            except ValueError:
+                continue
+            self._received(payload)
+
+        await self._process.wait()
+        if not self._ready.done():
+            self._ready.set_exception(
+                RuntimeError(f"the worker exited with code {self._process.returncode}")
+            )
+        if not self._stopping and self.status == "running":
+            self.loop.create_task(self._crashed())
+
+    def _received(self, payload: dict) -> None:
+        op = payload.get("op")
+        if op == "hello":
+            self.events = set(payload.get("events", ()))
+            if not self._ready.done():
+                self._ready.set_result(None)
+        elif op == "done":
+            queued = self._pending.pop(payload.get("id"), None)
+            latency = time.perf_counter() - queued if queued is not None else None
+            self.stats.record(latency, payload)
+        elif op == "action":
+            self.loop.create_task(self._perform(payload))
+
+    async def _perform(self, payload: dict) -> None:
+        async with self._actions:
+            result = {"op": "result", "id": payload.get("id")}
+            try:
+                result["data"] = await self.host.perform(
+                    payload.get("action"), payload.get("args") or {}
+                )
+            except Exception as exc:
+                result["error"] = f"{type(exc).__name__}: {exc}"
+            self.stats.actions += 1
+            if self._process.returncode is None:
+                try:
+                    self._send(result)
+                except (OSError, RuntimeError):
+                    pass
+
+    async def _log(self) -> None:
+        async for line in self._process.stderr:
+            line = line.decode("utf-8", errors="replace").rstrip()
+            if line:
+                logger.info("[%s] %s", self.key, line)
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(5)
+            if self.status != "running" or not self._pending:
+                continue
+            held = time.perf_counter() - min(self._pending.values())
+            if held > EVENT_TIMEOUT:
+                logger.warning(
+                    "The worker of %s held an event for %.0fs, restarting it.", self.key, held
+                )
+                self.stats.timeouts += 1
+                self.loop.create_task(self.restart())
+                return
+
+    async def _crashed(self) -> None:
+        now = time.monotonic()
+        self._crashes.append(now)
+        while self._crashes and now - self._crashes[0] > RESTART_WINDOW:
+            self._crashes.popleft()
+        await self.stop()
+        if len(self._crashes) > MAX_RESTARTS:
+            self.status = "crashed"
+            logger.error(
+                "The worker of %s keeps crashing, it won't be restarted automatically.",
+                self.key,
+            )
+            return
+        delay = 2 ** (len(self._crashes) - 1)
+        logger.warning("The worker of %s exited, restarting it in %ds.", self.key, delay)
+        await asyncio.sleep(delay)
+        if self.status != "stopped" or self.host.workers.get(self.key) is not self:
+            return
+        try:
+            self.stats.restarts += 1
+            await self.start()
+        except RuntimeError as exc:
+            logger.error(str(exc))
+
+    def to_dict(self) -> dict:
+        return {
+            "plugin": self.key,
+            "status": self.status,
+            "pid": self.pid,
+            "listens_to": sorted(self.events),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "uptime": time.time() - self.started_at if self.status == "running" else None,
+            **self.stats.to_dict(),
+        }
+
+
+class PluginHost:
+    """
+    The worker processes of the isolated plugins.
+
+    Parameters
+    ----------
+    bot : ModmailBot
+        The Modmail bot.
+
+    Attributes
+    ----------
+    workers : Dict[str, PluginWorker]
+        The workers, by plugin.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.workers = {}
+
+    async def start(self, key: str, extension: str) -> PluginWorker:
+        worker = self.workers.get(key)
+        if worker is None:
+            worker = self.workers[key] = PluginWorker(self, key, extension)
+        elif worker.status in {"starting", "running"}:
+            return worker
+        try:
+            await worker.start()
+        except RuntimeError:
+            del self.workers[key]
+            raise
+        return worker
+
+    async def stop(self, key: str) -> None:
+        worker = self.workers.pop(key, None)
+        if worker is not None:
+            await worker.stop()
+            logger.info("Stopped the worker of %s.", key)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(self.stop(key) for key in list(self.workers)))
+
+    def dispatch(self, event: str, serialize: typing.Callable[..., dict], *args) -> None:
+        """Serializes an event once and posts it to the workers listening to it."""
+        workers = [w for w in self.workers.values() if event in w.events]
+        if not workers:
+            return
+        data = serialize(*args)
+        for worker in workers:
+            worker.post(event, data)
+
+    # Actions
+
+    async def perform(self, action: str, args: dict) -> typing.Any:
+        handler = getattr(self, f"_action_{action}", None)
+        if handler is None:
+            raise ValueError(f"Unknown action {action}.")
+        return await handler(**args)
+
+    async def _channel(self, channel_id: int = None, user_id: int = None):
+        if user_id is not None:
+            user = self.bot.get_user(int(user_id))
+            if user is None:
+                raise ValueError(f"Unknown user {user_id}.")
+            return user.dm_channel or await user.create_dm()
+
+        channel = self.bot.get_channel(int(channel_id or 0))
+        if isinstance(channel, discord.DMChannel):
+            return channel
+        # Plugins only act in the Modmail servers
+        guilds = {self.bot.guild, self.bot.modmail_guild}
+        if channel is None or getattr(channel, "guild", None) not in guilds:
+            raise ValueError(f"Unknown channel {channel_id}.")
+        return channel
+
+    async def _message(self, channel_id: int, message_id: int) -> discord.Message:
+        channel = await self._channel(channel_id)
+        return await channel.fetch_message(int(message_id))
+
+    async def _action_send_message(
+        self, channel_id=None, user_id=None, content=None, embed=None
+    ) -> dict:
+        channel = await self._channel(channel_id, user_id)
+        embed = discord.Embed.from_dict(embed) if embed else None
+        return serialize_message(await channel.send(content, embed=embed))
+
+    async def _action_edit_message(self, channel_id, message_id, content=None, embed=None):
+        message = await self._message(channel_id, message_id)
+        kwargs = {"content": content}
+        if embed is not None:
+            kwargs["embed"] = discord.Embed.from_dict(embed)
+        await message.edit(**kwargs)
+        return serialize_message(message)
+
+    async def _action_delete_message(self, channel_id, message_id) -> None:
+        await (await self._message(channel_id, message_id)).delete()
+
+    async def _action_add_reaction(self, channel_id, message_id, emoji) -> None:
+        await (await self._message(channel_id, message_id)).add_reaction(emoji)
@@ -0,0 +1,260 @@
+"""
+A local cache of plugin repositories.
+
+Each GitHub repository is kept once as a bare mirror, fetched shallowly
+(``--depth 1 --filter=blob:none``) one branch at a time. Every installed
+``user/repo@branch`` is a detached worktree of its mirror, checked out at
+a pinned commit recorded in ``pins.json``:
+
+- installing a branch that was fetched before is a local checkout, and
+  works offline;
+- startup checks the worktree against its pin without fetching, modified
+  files are restored;
+- updating fetches the branch, checks out the new commit and moves the pin
+  only once the checkout is verified.
+
+All methods are blocking, they are meant to run in an executor.
+"""
+import json
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import threading
+import typing
+
+logger = logging.getLogger("Modmail")
+
+GITHUB_URL = "https://github.com/{username}/{repo}"
+
+
+class RepoError(Exception):
+    """A git command failed, the message is git's error output."""
+
+
+def _onerror(func, path, exc_info):  # pylint: disable=W0613
+    if not os.access(path, os.W_OK):
+        # Is the error an access error?
+        os.chmod(path, stat.S_IWUSR)
+        func(path)
+
+
+class PluginRepoCache:
+    """
+    Bare mirrors of plugin repositories and their worktrees.
+
+    Parameters
+    ----------
+    mirror_dir : str
+        Where the bare mirrors and the pins are stored.
+    worktree_dir : str
+        Where the worktrees are checked out, ``plugins``.
+    """
+
+    def __init__(self, mirror_dir: str, worktree_dir: str):
+        self.mirror_dir = os.path.abspath(mirror_dir)
+        self.worktree_dir = os.path.abspath(worktree_dir)
+        self.pins_path = os.path.join(self.mirror_dir, "pins.json")
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._pins_lock = threading.Lock()
+
+    @staticmethod
+    def _git(*args: str, cwd: str = None) -> str:
+        try:
+            result = subprocess.run(
+                ["git", *args],
+                cwd=cwd,
+                check=True,
+                capture_output=True,
+                env=dict(os.environ, GIT_TERMINAL_PROMPT="0"),
+            )
+        except subprocess.CalledProcessError as exc:
+            raise RepoError(exc.stderr.decode("utf-8", errors="replace").strip()) from exc
+        return result.stdout.decode("utf-8", errors="replace").strip()
+
+    def _lock(self, username: str, repo: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault((username, repo), threading.Lock())
+
+    def mirror_path(self, username: str, repo: str) -> str:
+        return os.path.join(self.mirror_dir, f"{username}-{repo}.git")
+
+    def worktree_path(self, username: str, repo: str, branch: str) -> str:
+        return os.path.join(self.worktree_dir, f"{username}-{repo}-{branch}")
+
+    # Pins
+
+    def pins(self) -> typing.Dict[str, str]:
+        """Returns the pinned commits, keyed by ``user/repo@branch``."""
+        try:
+            with open(self.pins_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _set_pin(self, key: str, sha: typing.Optional[str]) -> None:
+        with self._pins_lock:
+            pins = self.pins()
+            if sha is None:
+                pins.pop(key, None)
+            else:
+                pins[key] = sha
+            with open(self.pins_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(pins, f, indent=2, sort_keys=True)
+            os.replace(self.pins_path + ".tmp", self.pins_path)
+
+    # Mirror
+
+    def _ensure_mirror(self, username: str, repo: str) -> str:
+        mirror = self.mirror_path(username, repo)
+        if not os.path.isdir(mirror):
+            tmp = mirror + ".tmp"
+            shutil.rmtree(tmp, onerror=_onerror, ignore_errors=True)
+            self._git("init", "--bare", "-q", tmp)
+            url = GITHUB_URL.format(username=username, repo=repo)
+            self._git("remote", "add", "origin", url, cwd=tmp)
+            os.replace(tmp, mirror)
+        return mirror
+
+    def _fetch(self, mirror: str, branch: str) -> str:
+        """Fetches the head of `branch` into the mirror, returns its commit."""
+        self._git(
+            "fetch",
+            "-q",
+            "--depth",
+            "1",
+            "--filter=blob:none",
+            "origin",
+            f"+refs/heads/{branch}:refs/heads/{branch}",
+            cwd=mirror,
+        )
+        return self._git("rev-parse", f"refs/heads/{branch}^{{commit}}", cwd=mirror)
+
+    def _has_commit(self, mirror: str, sha: str) -> bool:
+        try:
+            self._git("cat-file", "-e", f"{sha}^{{commit}}", cwd=mirror)
+        except RepoError:
+            return False
+        return True
+
+    def _cached_head(self, mirror: str, branch: str) -> typing.Optional[str]:
+        try:
+            ref = f"refs/heads/{branch}^{{commit}}"
+            return self._git("rev-parse", "-q", "--verify", ref, cwd=mirror)
+        except RepoError:
+            return None
+
+    # Worktrees
+
+    def _head(self, worktree: str) -> typing.Optional[str]:
+        try:
+            return self._git("rev-parse", "HEAD", cwd=worktree)
+        except (RepoError, OSError):
+            return None
+
+    def _is_worktree_of(self, worktree: str, mirror: str) -> bool:
+        git_file = os.path.join(worktree, ".git")
+        if not os.path.isfile(git_file):
+            return False
+        with open(git_file, encoding="utf-8") as f:
+            return os.path.abspath(mirror) in f.read()
+
+    def _is_clean(self, worktree: str) -> bool:
+        return not self._git("status", "--porcelain", "--untracked-files=no", cwd=worktree)
+
+    def _checkout(self, mirror: str, worktree: str, sha: str) -> None:
+        """Checks out `sha` in `worktree`, which is created if needed, and verifies it."""
+        if os.path.exists(worktree) and not self._is_worktree_of(worktree, mirror):
+            # A full clone made by older versions, replaced by a worktree
+            logger.info("Converting %s to a worktree.", worktree)
+            shutil.rmtree(worktree, onerror=_onerror)
+        if not os.path.exists(worktree):
+            self._git("worktree", "prune", cwd=mirror)
+            self._git("worktree", "add", "-q", "--force", "--detach", worktree, sha, cwd=mirror)
+        else:
+            # Untracked files are kept, plugins may store their data there
+            self._git("checkout", "-q", "--force", "--detach", sha, cwd=worktree)
+
+        if self._head(worktree) != sha:
+            raise RepoError(f"{worktree} is not at {sha} after the checkout.")
+        if not self._is_clean(worktree):
+            raise RepoError(f"{worktree} differs from {sha} after the checkout.")
+
+    def install(self, username: str, repo: str, branch: str) -> str:
+        """
+        Makes sure the worktree of a plugin repository is at its pinned commit.
+
+        The branch is only fetched when it isn't pinned yet, or when the
+        pinned commit is missing from the mirror.
+
+        Returns
+        -------
+        str
+            The checked out commit.
+
+        Raises
+        ------
+        RepoError
+            The repository could not be fetched or checked out.
+        """
+        key = f"{username}/{repo}@{branch}"
+        worktree = self.worktree_path(username, repo, branch)
+        with self._lock(username, repo):
+            mirror = self._ensure_mirror(username, repo)
+            sha = self.pins().get(key)
+            if sha is None or not self._has_commit(mirror, sha):
+                try:
+                    sha = self._fetch(mirror, branch)
+                except RepoError:
+                    sha = self._cached_head(mirror, branch)
+                    if sha is None:
+                        raise
+                    logger.warning("Failed to fetch %s, using the cached %s.", key, sha[:7])
+                self._set_pin(key, sha)
+            if (
+                self._head(worktree) == sha
+                and self._is_worktree_of(worktree, mirror)
+                and self._is_clean(worktree)
+            ):
+                return sha
+            self._checkout(mirror, worktree, sha)
+            return sha
+
+    def update(self, username: str, repo: str, branch: str) -> typing.Tuple[str, str]:
+        """
+        Fetches the branch and moves the worktree and the pin to its head.
+
+        Returns
+        -------
+        Tuple[str, str]
+            The previous and the new commit, equal if there was no update.
+        """
+        key = f"{username}/{repo}@{branch}"
+        worktree = self.worktree_path(username, repo, branch)
+        with self._lock(username, repo):
+            mirror = self._ensure_mirror(username, repo)
+            previous = self.pins().get(key)
+            sha = self._fetch(mirror, branch)
+            if sha != previous or self._head(worktree) != sha:
+                self._checkout(mirror, worktree, sha)
+                self._set_pin(key, sha)
+            return previous, sha
+
+    def remove(self, username: str, repo: str, branch: str) -> None:
+        """Removes the worktree of a plugin, the mirror is kept as a cache."""
+        worktree = self.worktree_path(username, repo, branch)
+        mirror = self.mirror_path(username, repo)
+        with self._lock(username, repo):
+            if os.path.isdir(mirror):
+                try:
+                    self._git("worktree", "remove", "--force", worktree, cwd=mirror)
+                except RepoError:
+                    pass
+            if os.path.exists(worktree):
+                shutil.rmtree(worktree, onerror=_onerror)
+            if os.path.isdir(mirror):
+                self._git("worktree", "prune", cwd=mirror)
+            self._set_pin(f"{username}/{repo}@{branch}", None)
@@ -0,0 +1,230 @@
+"""
+The runtime of isolated plugins.
+
+A plugin listed in ``isolated_plugins`` isn't loaded into the bot, it runs
+in its own process started with ``python -m core.pluginworker <extension>``.
+The bot sends the events the plugin listens to, the plugin answers with
+actions, both as JSON lines over the process' stdin and stdout. A plugin
+doing blocking I/O or heavy CPU work only slows its own process, and it
+can be restarted without restarting the bot.
+
+An isolated plugin defines ``setup_worker`` next to (or instead of)
+``setup``::
+
+    def setup_worker(worker):
+        @worker.listen()
+        async def on_message(message):
+            if "badword" in message["content"]:
+                await worker.delete_message(message["channel_id"], message["id"])
+
+Events are plain dicts, see `core.pluginhost` for their fields. They are
+handled one at a time, in order. Anything the plugin prints or logs goes
+to the bot's log.
+
+This module only uses the standard library, so workers start quickly.
+"""
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import typing
+
+EVENTS = ("message", "thread_ready", "thread_close")
+
+
+class ActionError(Exception):
+    """The bot failed to perform an action."""
+
+
+class Worker:
+    """
+    The plugin side of a worker process.
+
+    Attributes
+    ----------
+    listeners : Dict[str, List[Callable]]
+        The listeners of each event.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, output: typing.BinaryIO):
+        self.loop = loop
+        self.listeners = {}
+        self._output = output
+        self._write_lock = threading.Lock()
+        self._requests = {}
+        self._next_id = 0
+        self._events = asyncio.Queue()
+
+    def listen(self, name: str = None):
+        """
+        Registers a coroutine as the listener of an event, the event name
+        defaults to the function name without the ``on_`` prefix.
+        """
+
+        def decorator(func):
+            event = name or func.__name__
+            if event.startswith("on_"):
+                event = event[3:]
+            if event not in EVENTS:
+                raise ValueError(f"Unknown event {event}, expected one of {', '.join(EVENTS)}.")
+            if not asyncio.iscoroutinefunction(func):
+                raise TypeError("Listeners must be coroutines.")
+            self.listeners.setdefault(event, []).append(func)
+            return func
+
+        return decorator
+
+    def _send(self, payload: dict) -> None:
+        line = json.dumps(payload, separators=(",", ":"), default=str).encode() + b"\n"
+        with self._write_lock:
+            self._output.write(line)
+            self._output.flush()
+
+    async def request(self, action: str, **args) -> typing.Any:
+        """
+        Asks the bot to perform an action, returns its result.
+
+        Raises
+        ------
+        ActionError
+            The action failed.
+        """
+        self._next_id += 1
+        future = self.loop.create_future()
+        self._requests[self._next_id] = future
+        self._send({"op": "action", "id": self._next_id, "action": action, "args": args})
+        return await future
+
+    async def send_message(
+        self,
+        channel_id: int = None,
+        content: str = None,
+        *,
+        user_id: int = None,
+        embed: dict = None,
+    ) -> dict:
+        """
+        Sends a message to a channel, or to a user by DM. `embed` is a
+        dict in the Discord API format. Returns the sent message.
+        """
+        return await self.request(
+            "send_message", channel_id=channel_id, user_id=user_id, content=content, embed=embed
+        )
+
+    async def edit_message(
+        self, channel_id: int, message_id: int, content: str = None, *, embed: dict = None
+    ) -> dict:
+        return await self.request(
+            "edit_message",
+            channel_id=channel_id,
+            message_id=message_id,
+            content=content,
+            embed=embed,
+        )
+
+    async def delete_message(self, channel_id: int, message_id: int) -> None:
+        await self.request("delete_message", channel_id=channel_id, message_id=message_id)
+
+    async def add_reaction(self, channel_id: int, message_id: int, emoji: str) -> None:
+        await self.request(
+            "add_reaction", channel_id=channel_id, message_id=message_id, emoji=emoji
+        )
+
+    def _received(self, payload: typing.Optional[dict]) -> None:
+        if payload is None or payload.get("op") == "stop":
+            self._events.put_nowait(None)
+        elif payload.get("op") == "event":
+            self._events.put_nowait(payload)
+        elif payload.get("op") == "result":
+            future = self._requests.pop(payload.get("id"), None)
+            if future is None or future.done():
+                return
+            if payload.get("error"):
+                future.set_exception(ActionError(payload["error"]))
+            else:
+                future.set_result(payload.get("data"))
+
+    async def run(self) -> None:
+        """Handles the events until the bot stops the worker."""
+        self._send({"op": "hello", "pid": os.getpid(), "events": sorted(self.listeners)})
+        while True:
+            payload = await self._events.get()
+            if payload is None:
+                break
+            started = time.perf_counter()
+            cpu = time.process_time()
+            error = None
+            for listener in self.listeners.get(payload["event"], []):
+                try:
+                    await listener(payload["data"])
+                except Exception as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                    traceback.print_exc()
+            self._send(
+                {
+                    "op": "done",
+                    "id": payload["id"],
+                    "wall": time.perf_counter() - started,
+                    "cpu": time.process_time() - cpu,
+                    "cpu_total": time.process_time(),
+                    "error": error,
+                }
+            )
+
+
+def _read(worker: Worker, stream: typing.BinaryIO) -> None:
+    for line in stream:
+        try:
+            payload = json.loads(line)
+        except ValueError:
+            continue
+        worker.loop.call_soon_threadsafe(worker._received, payload)
+    # The bot closed the pipe, or exited
+    worker.loop.call_soon_threadsafe(worker._received, None)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run an isolated plugin, started by the bot.")
+    parser.add_argument("extension", help="The plugin module, as passed to load_extension.")
+    args = parser.parse_args()
+
+    # The protocol uses the original stdout, what the plugin prints goes to stderr
+    output = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    logging.basicConfig(
+        stream=sys.stderr, level=logging.INFO, format="%(levelname)s %(name)s: %(message)s"
+    )
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = Worker(loop, output)
+
+    module = importlib.import_module(args.extension)
+    setup = getattr(module, "setup_worker", None)
+    if setup is None:
+        sys.exit(f"{args.extension} has no setup_worker function, it can't run isolated.")
+    setup(worker)
+
+    threading.Thread(target=_read, args=(worker, sys.stdin.buffer), daemon=True).start()
+    code = 0
+    try:
+        loop.run_until_complete(worker.run())
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        loop.close()
+        sys.stderr.flush()
+        # The reader thread is blocked on stdin, exit without waiting for it
+        os._exit(code)
+
+
+if __name__ == "__main__":
+    main()
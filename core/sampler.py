@@ -0,0 +1,176 @@
+"""
+On-demand sampling CPU profiler.
+
+`StackSampler` runs a thread that captures the stack of the event loop
+thread (and optionally of every thread) every `interval` seconds, with
+``sys._current_frames``. Nothing is hooked into the profiled code, the only
+cost is the sampler thread taking the GIL for a few microseconds per
+sample, so it can run while the bot handles traffic.
+
+The samples are aggregated:
+
+- by function: the samples where it was running (self) or on the stack
+  (total);
+- by coroutine: the asyncio task the loop was running, or ``(idle)`` when
+  it was waiting for I/O.
+
+The stacks are also kept in the collapsed format (``frame;frame;frame
+count``), which ``flamegraph.pl`` or speedscope turn into a flame graph.
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+import typing
+from collections import Counter
+
+# The deepest stack recorded, the outermost frames are dropped.
+MAX_DEPTH = 128
+
+
+def _location(code) -> str:
+    path = code.co_filename
+    parent = os.path.basename(os.path.dirname(path))
+    return f"{parent}/{os.path.basename(path)}:{code.co_firstlineno}"
+
+
+class StackSampler:
+    """
+    Samples the stacks of the running process.
+
+    Parameters
+    ----------
+    loop : asyncio.AbstractEventLoop
+        The event loop, the task it runs is recorded with each sample.
+    interval : float
+        The time between two samples, in seconds.
+    all_threads : bool
+        Whether the threads other than the loop one are sampled too.
+
+    Attributes
+    ----------
+    samples : int
+        The number of samples, one per sampled thread each interval.
+    functions : Counter
+        The samples where a function was running, by function.
+    cumulative : Counter
+        The samples where a function was on the stack, by function.
+    coroutines : Counter
+        The loop thread samples by running coroutine.
+    stacks : Counter
+        The samples by collapsed stack, outermost frame first.
+    duration : float
+        The time sampled, in seconds.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, interval: float = 0.005, all_threads: bool = False
+    ):
+        self.loop = loop
+        self.interval = interval
+        self.all_threads = all_threads
+        self.samples = 0
+        self.functions = Counter()
+        self.cumulative = Counter()
+        self.coroutines = Counter()
+        self.stacks = Counter()
+        self.duration = 0.0
+        self._loop_thread = None
+        self._thread_names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        """Starts sampling, must be called from the thread running the loop."""
+        if self._thread is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    async def profile(self, duration: float) -> None:
+        """Samples for `duration` seconds."""
+        self.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            # The sampler wakes up every interval, joining it is quick
+            self.stop()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        started = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own or (not self.all_threads and ident != self._loop_thread):
+                    continue
+                self._record(ident, frame)
+            # Do not keep the frames, and their locals, alive until the next sample
+            frames = frame = None
+        self.duration += time.perf_counter() - started
+
+    def _current_coroutine(self, frame) -> str:
+        try:
+            task = asyncio.current_task(self.loop)
+        except RuntimeError:
+            task = None
+        if task is not None:
+            coro = task.get_coro()
+            return getattr(coro, "__qualname__", None) or repr(coro)
+        if frame.f_code.co_filename.endswith("selectors.py"):
+            return "(idle)"
+        return "(callbacks)"
+
+    def _thread_name(self, ident: int) -> str:
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            name = self._thread_names.get(ident, str(ident))
+        return name
+
+    def _record(self, ident: int, top) -> None:
+        stack = []
+        frame = top
+        while frame is not None and len(stack) < MAX_DEPTH:
+            stack.append(f"{frame.f_code.co_name} ({_location(frame.f_code)})")
+            frame = frame.f_back
+        if not stack:
+            return
+
+        self.samples += 1
+        self.functions[stack[0]] += 1
+        # Recursive functions are counted once per sample
+        self.cumulative.update(set(stack))
+
+        root = [self._thread_name(ident)]
+        if ident == self._loop_thread:
+            coroutine = self._current_coroutine(top)
+            self.coroutines[coroutine] += 1
+            root.append(coroutine)
+        self.stacks[";".join(root + stack[::-1])] += 1
+
+    def top(self, count: int = 15, cumulative: bool = False) -> typing.List[tuple]:
+        """Returns ``(function, self samples, total samples)`` by decreasing samples."""
+        ranked = (self.cumulative if cumulative else self.functions).most_common(count)
+        return [
+            (function, self.functions[function], self.cumulative[function])
+            for function, _ in ranked
+        ]
+
+    def collapsed(self) -> str:
+        """The stacks in the collapsed format, one ``stack count`` per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
@@ -0,0 +1,729 @@
+"""
+A small, self-contained full-text search engine for thread logs.
+
+The index is an inverted index split into hash shards. Each shard is made
+of a sorted lexicon (``shard-XX.lex``), loaded in memory, and a postings
+file (``shard-XX.dat``) which is memory-mapped for reads. New messages are
+buffered in memory and merged into the affected shards periodically.
+
+The module can also be run as a script to rebuild the index offline or to
+benchmark it against MongoDB's ``$text`` search::
+
+    python -m core.search rebuild --mongo-uri <uri> --guild-id <id>
+    python -m core.search bench --mongo-uri <uri> --guild-id <id> "some query"
+"""
+import asyncio
+import bisect
+import contextlib
+import copy
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import typing
+import zlib
+from collections import defaultdict
+from datetime import datetime
+
+from core.logschema import expand_log
+
+logger = logging.getLogger("Modmail")
+
+TOKEN_REGEX = re.compile(r"\w+", re.UNICODE)
+FILTER_REGEX = re.compile(r"^(after|before|closer|recipient):(\S+)$", re.IGNORECASE)
+
+POSTING = struct.Struct("<IH")  # (doc id, term frequency)
+MAX_TOKEN_LENGTH = 64
+MAX_PREFIX_EXPANSION = 64
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text: typing.Optional[str]) -> typing.List[str]:
+    """
+    Splits a text into lowercase search terms.
+
+    Parameters
+    ----------
+    text : str
+        The text to tokenize.
+
+    Returns
+    -------
+    List[str]
+        The terms found in `text`.
+    """
+    if not text:
+        return []
+    return [t for t in TOKEN_REGEX.findall(str(text).lower()) if len(t) <= MAX_TOKEN_LENGTH]
+
+
+class SearchQuery:
+    """
+    A parsed search query.
+
+    Terms ending with ``*`` are prefix terms. The special
+    ``after:``, ``before:``, ``closer:`` and ``recipient:`` tokens are
+    turned into filters, dates use the ``YYYY-MM-DD`` format.
+    """
+
+    def __init__(self, text: str):
+        self.terms = []
+        self.prefixes = []
+        self.after = None
+        self.before = None
+        self.closer_id = None
+        self.recipient_id = None
+
+        for word in text.replace('"', " ").split():
+            match = FILTER_REGEX.match(word)
+            if match is not None:
+                self._add_filter(match.group(1).lower(), match.group(2))
+                continue
+            if word.endswith("*"):
+                self.prefixes.extend(tokenize(word[:-1]))
+            else:
+                self.terms.extend(tokenize(word))
+
+    def _add_filter(self, name: str, value: str) -> None:
+        if name in {"after", "before"}:
+            try:
+                setattr(self, name, str(datetime.fromisoformat(value)))
+            except ValueError as e:
+                raise ValueError(f"Invalid date for `{name}`, use YYYY-MM-DD.") from e
+        else:
+            setattr(self, f"{name}_id", value.strip("<@!>"))
+
+    @property
+    def empty(self) -> bool:
+        return not self.terms and not self.prefixes
+
+
+class _Shard:
+    """A single memory-mapped shard of the index."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.terms: typing.List[str] = []
+        self.entries: typing.List[typing.Tuple[int, int]] = []
+        self._file = None
+        self._map = None
+        self.load()
+
+    @property
+    def lex_path(self) -> str:
+        return self.path + ".lex"
+
+    @property
+    def dat_path(self) -> str:
+        return self.path + ".dat"
+
+    def load(self) -> None:
+        self.close()
+        terms, entries = [], []
+        if os.path.exists(self.lex_path):
+            with open(self.lex_path, encoding="utf-8") as f:
+                for line in f:
+                    term, offset, count = line.rstrip("\n").split("\t")
+                    terms.append(term)
+                    entries.append((int(offset), int(count)))
+        self.terms, self.entries = terms, entries
+
+        if os.path.exists(self.dat_path) and os.path.getsize(self.dat_path):
+            self._file = open(self.dat_path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def postings(self, term: str) -> typing.Dict[int, int]:
+        index = bisect.bisect_left(self.terms, term)
+        if index == len(self.terms) or self.terms[index] != term:
+            return {}
+        offset, count = self.entries[index]
+        return dict(
+            POSTING.unpack_from(self._map, offset + i * POSTING.size) for i in range(count)
+        )
+
+    def expand(self, prefix: str) -> typing.List[str]:
+        index = bisect.bisect_left(self.terms, prefix)
+        found = []
+        while index < len(self.terms) and self.terms[index].startswith(prefix):
+            found.append(self.terms[index])
+            index += 1
+            if len(found) >= MAX_PREFIX_EXPANSION:
+                break
+        return found
+
+    def build(self, additions: typing.Dict[str, typing.Dict[int, int]], dead: set) -> None:
+        """Writes the shard merged with `additions` next to the current files."""
+        merged = {}
+        for term in self.terms:
+            postings = {d: tf for d, tf in self.postings(term).items() if d not in dead}
+            if postings:
+                merged[term] = postings
+        for term, postings in additions.items():
+            current = merged.setdefault(term, {})
+            for doc_id, tf in postings.items():
+                if doc_id not in dead:
+                    current[doc_id] = min(current.get(doc_id, 0) + tf, 0xFFFF)
+            if not current:
+                del merged[term]
+
+        offset = 0
+        with open(self.dat_path + ".tmp", "wb") as dat, open(
+            self.lex_path + ".tmp", "w", encoding="utf-8"
+        ) as lex:
+            for term in sorted(merged):
+                postings = sorted(merged[term].items())
+                dat.write(b"".join(POSTING.pack(d, tf) for d, tf in postings))
+                lex.write(f"{term}\t{offset}\t{len(postings)}\n")
+                offset += len(postings) * POSTING.size
+            dat.flush()
+            os.fsync(dat.fileno())
+            lex.flush()
+            os.fsync(lex.fileno())
+
+    def swap(self) -> None:
+        """Replaces the shard files with the ones written by `build`."""
+        self.close()
+        os.replace(self.dat_path + ".tmp", self.dat_path)
+        os.replace(self.lex_path + ".tmp", self.lex_path)
+        self.load()
+
+
+class LogSearchIndex:
+    """
+    Sharded inverted index over the Modmail thread logs.
+
+    Parameters
+    ----------
+    path : str
+        The directory where the index files are stored.
+    shards : int, optional
+        The number of shards, only used when creating a new index.
+        Defaults to 16.
+
+    Attributes
+    ----------
+    path : str
+        The directory where the index files are stored.
+    docs : Dict[int, Dict[str, Any]]
+        The indexed logs metadata, keyed by internal document ID.
+    """
+
+    def __init__(self, path: str, shards: int = 16):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = defaultdict(lambda: defaultdict(int))
+        self._flushing = {}
+        self._dead = set()
+        self._dirty = False
+        self._task = None
+        # The updates fed while the index is rebuilt, see `record`
+        self._recorded = None
+
+        self.docs: typing.Dict[int, dict] = {}
+        self._by_key: typing.Dict[str, int] = {}
+        self._by_channel: typing.Dict[str, int] = {}
+        self._next_id = 0
+
+        meta = self._read_meta()
+        self.shard_count = meta.get("shards", shards)
+        self.shards = [
+            _Shard(os.path.join(path, f"shard-{i:02d}")) for i in range(self.shard_count)
+        ]
+        for doc in meta.get("docs", []):
+            self._register(doc)
+        self._next_id = meta.get("next_id", self._next_id)
+
+    def __len__(self):
+        return len(self.docs)
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.path, "docs.json")
+
+    def _read_meta(self) -> dict:
+        if not os.path.exists(self.meta_path):
+            return {}
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning("Search index metadata is corrupted, rebuild the index.")
+            return {}
+
+    def _register(self, doc: dict) -> None:
+        self.docs[doc["id"]] = doc
+        self._by_key[doc["key"]] = doc["id"]
+        if doc.get("open"):
+            self._by_channel[doc["channel_id"]] = doc["id"]
+        self._next_id = max(self._next_id, doc["id"] + 1)
+
+    def _shard_for(self, term: str) -> _Shard:
+        return self.shards[zlib.crc32(term.encode("utf-8")) % self.shard_count]
+
+    def _add_terms(self, doc_id: int, terms: typing.Iterable[str]) -> None:
+        count = 0
+        with self._lock:
+            for term in terms:
+                self._pending[term][doc_id] += 1
+                count += 1
+            self.docs[doc_id]["length"] += count
+            self._dirty = True
+
+    # Feeding
+
+    def add_log(self, log: dict) -> None:
+        """
+        Indexes a log document, including the messages it already has.
+
+        Parameters
+        ----------
+        log : Dict[str, Any]
+            A log document, in the `ApiClient.create_log_entry` format.
+        """
+        self._record("add_log", log)
+        key = log["key"]
+        if key in self._by_key:
+            # Already indexed, the messages were fed as they were appended
+            self._update_log(log.get("channel_id"), log)
+            return
+
+        doc_id = self._next_id
+        self._next_id += 1
+        doc = {
+            "id": doc_id,
+            "key": key,
+            "channel_id": str(log.get("channel_id")),
+            "guild_id": str(log.get("guild_id")),
+            "recipient_id": str((log.get("recipient") or {}).get("id")),
+            "closer_id": str((log.get("closer") or {}).get("id")),
+            "created_at": str(log.get("created_at") or ""),
+            "closed_at": str(log.get("closed_at") or ""),
+            "open": bool(log.get("open")),
+            "length": 0,
+        }
+        with self._lock:
+            self._register(doc)
+        self._add_terms(doc_id, tokenize(key))
+        for message in log.get("messages") or []:
+            author = message.get("author") or {}
+            self._add_message_terms(doc_id, message.get("content"), author.get("name"))
+
+    def _add_message_terms(self, doc_id, content, author_name) -> None:
+        self._add_terms(doc_id, tokenize(content) + tokenize(author_name))
+
+    def add_message(self, channel_id: typing.Union[int, str], content: str, author_name: str):
+        """Indexes a message appended to the open log of `channel_id`."""
+        self._record("add_message", channel_id, content, author_name)
+        doc_id = self._by_channel.get(str(channel_id))
+        if doc_id is None:
+            logger.debug("Search index has no open log for channel %s.", channel_id)
+            return
+        self._add_message_terms(doc_id, content, author_name)
+
+    def update_log(self, channel_id: typing.Union[int, str], data: dict) -> None:
+        """Applies the fields of a `post_log` update to the open log of `channel_id`."""
+        self._record("update_log", channel_id, data)
+        self._update_log(channel_id, data)
+
+    def _update_log(self, channel_id: typing.Union[int, str], data: dict) -> None:
+        doc_id = self._by_channel.get(str(channel_id))
+        if doc_id is None:
+            return
+        with self._lock:
+            doc = self.docs[doc_id]
+            if "closer" in data:
+                doc["closer_id"] = str((data["closer"] or {}).get("id"))
+            if "closed_at" in data:
+                doc["closed_at"] = str(data["closed_at"] or "")
+            if "open" in data:
+                doc["open"] = bool(data["open"])
+                if not doc["open"]:
+                    self._by_channel.pop(str(channel_id), None)
+            self._dirty = True
+
+    def remove(self, keys: typing.Iterable[str]) -> None:
+        """Drops logs from the index, their postings are purged on the next flush."""
+        keys = list(keys)
+        self._record("remove", keys)
+        with self._lock:
+            for key in keys:
+                doc_id = self._by_key.pop(key, None)
+                if doc_id is None:
+                    continue
+                doc = self.docs.pop(doc_id)
+                self._by_channel.pop(doc["channel_id"], None)
+                self._dead.add(doc_id)
+                self._dirty = True
+
+    # Persistence
+
+    def flush(self) -> None:
+        """Merges the buffered postings into the shards and writes the metadata."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._flushing, self._pending = self._pending, defaultdict(
+                    lambda: defaultdict(int)
+                )
+                dead, self._dead = self._dead, set()
+                docs = [dict(d) for d in self.docs.values()]
+                self._dirty = False
+
+            by_shard = defaultdict(dict)
+            for term, postings in self._flushing.items():
+                by_shard[self._shard_for(term)][term] = postings
+
+            rewritten = [s for s in self.shards if s in by_shard or dead]
+            for shard in rewritten:
+                shard.build(by_shard.get(shard, {}), dead)
+
+            tmp = self.meta_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"shards": self.shard_count, "next_id": self._next_id, "docs": docs}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.meta_path)
+
+            with self._lock:
+                for shard in rewritten:
+                    shard.swap()
+                self._flushing = {}
+
+    async def _flush_loop(self, interval: float) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.flush)
+            except Exception:
+                logger.error("Failed to flush the search index.", exc_info=True)
+
+    def start(self, loop: asyncio.AbstractEventLoop, interval: float = 30) -> None:
+        """Starts flushing the index every `interval` seconds."""
+        if self._task is None:
+            self._task = loop.create_task(self._flush_loop(interval))
+
+    def stop(self) -> None:
+        """Stops flushing the index."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # Rebuilding
+
+    def _record(self, method: str, *args) -> None:
+        if self._recorded is not None:
+            # The logs are mutated as they are fed, they are copied
+            self._recorded.append((method, copy.deepcopy(args)))
+
+    def record(self) -> None:
+        """Starts recording the updates fed to the index, until `stop_recording`."""
+        self._recorded = []
+
+    def stop_recording(self) -> typing.List[tuple]:
+        """Returns the recorded updates, to `replay` them on a rebuilt index."""
+        recorded, self._recorded = self._recorded or [], None
+        return recorded
+
+    def replay(self, updates: typing.List[tuple]) -> None:
+        """Applies updates recorded on another index."""
+        for method, args in updates:
+            getattr(self, method)(*args)
+
+    def close(self, flush: bool = True) -> None:
+        """Flushes pending postings and releases the memory maps."""
+        self.stop()
+        if flush:
+            self.flush()
+        for shard in self.shards:
+            shard.close()
+
+    # Querying
+
+    def _postings(self, term: str) -> typing.Dict[int, int]:
+        postings = dict(self._shard_for(term).postings(term))
+        for buffer in (self._flushing, self._pending):
+            for doc_id, tf in buffer.get(term, {}).items():
+                postings[doc_id] = postings.get(doc_id, 0) + tf
+        return postings
+
+    def _expand(self, prefix: str) -> typing.Set[str]:
+        terms = set()
+        for shard in self.shards:
+            terms.update(shard.expand(prefix))
+        for buffer in (self._flushing, self._pending):
+            terms.update(t for t in list(buffer) if t.startswith(prefix))
+        return terms
+
+    def _accepts(self, doc: dict, query: SearchQuery, guild_id, include_open) -> bool:
+        if guild_id is not None and doc["guild_id"] != str(guild_id):
+            return False
+        if not include_open and doc["open"]:
+            return False
+        if query.after is not None and doc["created_at"] < query.after:
+            return False
+        if query.before is not None and doc["created_at"] >= query.before:
+            return False
+        if query.closer_id is not None and doc["closer_id"] != query.closer_id:
+            return False
+        if query.recipient_id is not None and doc["recipient_id"] != query.recipient_id:
+            return False
+        return True
+
+    def search(
+        self,
+        query: typing.Union[str, SearchQuery],
+        *,
+        guild_id: typing.Union[int, str] = None,
+        include_open: bool = False,
+        limit: int = None,
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        Searches the index.
+
+        Every term of the query must match, prefix terms match any term
+        starting with the prefix. Results are ranked with BM25.
+
+        Parameters
+        ----------
+        query : str or SearchQuery
+            The search query.
+        guild_id : int or str, optional
+            Only return logs from this guild.
+        include_open : bool, optional
+            Whether logs of open threads should be returned.
+        limit : int, optional
+            The maximum number of results.
+
+        Returns
+        -------
+        List[Tuple[str, float]]
+            The matching log keys with their score, best match first.
+        """
+        if isinstance(query, str):
+            query = SearchQuery(query)
+        if query.empty:
+            return []
+
+        # The lock is only held to read the postings, the feeding methods
+        # take it on the event loop while the scoring runs in an executor
+        with self._lock:
+            docs = dict(self.docs)
+        total = max(len(docs), 1)
+        average = sum(d["length"] for d in docs.values()) / total or 1.0
+
+        groups = [[term] for term in query.terms]
+        for prefix in query.prefixes:
+            with self._lock:
+                groups.append(sorted(self._expand(prefix)))
+
+        scores = None
+        for group in groups:
+            group_scores = defaultdict(float)
+            for term in group:
+                with self._lock:
+                    postings = self._postings(term)
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    doc = docs.get(doc_id)
+                    if doc is None:
+                        continue
+                    norm = tf + K1 * (1 - B + B * doc["length"] / average)
+                    group_scores[doc_id] += idf * tf * (K1 + 1) / norm
+            if scores is None:
+                scores = group_scores
+            else:
+                scores = {
+                    doc_id: score + group_scores[doc_id]
+                    for doc_id, score in scores.items()
+                    if doc_id in group_scores
+                }
+            if not scores:
+                return []
+
+        results = [
+            (docs[doc_id]["key"], score)
+            for doc_id, score in scores.items()
+            if self._accepts(docs[doc_id], query, guild_id, include_open)
+        ]
+
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results[:limit] if limit else results
+
+
+SEARCH_PROJECTION = {
+    "key": 1,
+    "channel_id": 1,
+    "guild_id": 1,
+    "open": 1,
+    "created_at": 1,
+    "closed_at": 1,
+    "recipient.id": 1,
+    "closer.id": 1,
+    "messages.content": 1,
+    "messages.author": 1,
+    "participants": 1,
+}
+
+
+async def rebuild_index(
+    path: str, collection, batch_size: int = 500, live: LogSearchIndex = None
+) -> LogSearchIndex:
+    """
+    Builds a new index from every document of a logs collection.
+
+    The index is built next to `path` and swapped in once complete. The
+    `live` index keeps serving searches meanwhile, the updates it is fed
+    are replayed on the new one, which must replace it before the event
+    loop runs anything else.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the index to replace.
+    collection : AsyncIOMotorCollection
+        The logs collection.
+    batch_size : int, optional
+        The number of logs indexed between two flushes.
+    live : LogSearchIndex, optional
+        The index in use at `path`, it is closed once replaced.
+
+    Returns
+    -------
+    LogSearchIndex
+        The rebuilt index.
+    """
+    loop = asyncio.get_event_loop()
+    building = path.rstrip(os.sep) + ".building"
+    replaced = path.rstrip(os.sep) + ".old"
+    shutil.rmtree(building, ignore_errors=True)
+    index = LogSearchIndex(building)
+    if live is not None:
+        live.record()
+
+    try:
+        count = 0
+        async for log in collection.find({}, SEARCH_PROJECTION):
+            index.add_log(expand_log(log))
+            count += 1
+            if count % batch_size == 0:
+                await loop.run_in_executor(None, index.flush)
+                logger.debug("Indexed %d logs.", count)
+
+        await loop.run_in_executor(None, index.close)
+        if live is not None:
+            # The live index is not flushed anymore, its files are replaced
+            live.stop()
+        await loop.run_in_executor(None, _replace_files, building, path, replaced, live)
+        index = await loop.run_in_executor(None, LogSearchIndex, path)
+    except BaseException:
+        if live is not None:
+            live.stop_recording()
+        raise
+
+    if live is not None:
+        # A message both read from the collection and fed during the
+        # rebuild is counted twice, which barely changes its log's score
+        index.replay(live.stop_recording())
+        loop.run_in_executor(None, _discard, live, replaced)
+    else:
+        shutil.rmtree(replaced, ignore_errors=True)
+    logger.info("Search index rebuilt with %d logs.", count)
+    return index
+
+
+def _replace_files(building: str, path: str, replaced: str, live: LogSearchIndex) -> None:
+    # Waits for a flush of the live index still writing its files
+    with live._flush_lock if live is not None else contextlib.nullcontext():
+        shutil.rmtree(replaced, ignore_errors=True)
+        if os.path.exists(path):
+            os.replace(path, replaced)
+        os.replace(building, path)
+
+
+def _discard(index: LogSearchIndex, path: str) -> None:
+    try:
+        index.close(flush=False)
+        shutil.rmtree(path, ignore_errors=True)
+    except Exception:
+        logger.warning("Failed to discard the replaced search index.", exc_info=True)
+
+
+async def _benchmark(index: LogSearchIndex, collection, guild_id, queries, rounds) -> None:
+    loop = asyncio.get_event_loop()
+    print(f"{'query':30} {'$text (ms)':>12} {'hits':>6} {'local (ms)':>12} {'hits':>6}")
+    for text in queries:
+        mongo_query = {"guild_id": str(guild_id), "open": False, "$text": {"$search": text}}
+        start = loop.time()
+        for _ in range(rounds):
+            mongo_hits = await collection.count_documents(mongo_query)
+        mongo_time = (loop.time() - start) / rounds * 1000
+
+        start = loop.time()
+        for _ in range(rounds):
+            local_hits = len(index.search(text, guild_id=guild_id))
+        local_time = (loop.time() - start) / rounds * 1000
+        print(
+            f"{text[:30]:30} {mongo_time:12.2f} {mongo_hits:6d} {local_time:12.2f} {local_hits:6d}"
+        )
+
+
+def main() -> None:
+    import argparse
+
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Manage the local log search index.")
+    parser.add_argument("action", choices=["rebuild", "bench"])
+    parser.add_argument("queries", nargs="*", help="Queries to benchmark.")
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--guild-id", default=os.getenv("GUILD_ID"))
+    parser.add_argument("--path", default=os.path.join("temp", "search"))
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    storage = StorageBackend.from_config(
+        {
+            "database_type": args.database_type,
+            "mongo_uri": args.mongo_uri,
+            "sqlite_path": args.sqlite_path,
+        },
+        "temp",
+    )
+    collection = storage.db.logs
+    loop = asyncio.get_event_loop()
+
+    if args.action == "rebuild":
+        loop.run_until_complete(rebuild_index(args.path, collection))
+    else:
+        index = LogSearchIndex(args.path)
+        queries = args.queries or ["hello", "help*", "ban appeal"]
+        loop.run_until_complete(_benchmark(index, collection, args.guild_id, queries, args.rounds))
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
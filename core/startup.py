@@ -0,0 +1,158 @@
+"""
+Startup phase profiler.
+
+The wall time of each startup phase (imports, cog loading, database
+connection, config refresh, index setup, thread cache, pending closures,
+plugins) is recorded, logged once the bot is ready and appended to
+``temp/startup.jsonl``, so regressions show up across restarts::
+
+    python -m core.startup
+"""
+import asyncio
+import json
+import logging
+import os
+import statistics
+import time
+import typing
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger("Modmail")
+
+HISTORY_SIZE = 100
+
+
+class StartupProfiler:
+    """
+    Records the duration of the startup phases.
+
+    Parameters
+    ----------
+    path : str
+        The JSONL file where the startup profiles are stored.
+    started : float, optional
+        The `time.perf_counter` value when the process started,
+        defaults to now.
+
+    Attributes
+    ----------
+    phases : Dict[str, float]
+        The duration of each phase in seconds, in completion order.
+    reported : bool
+        Whether the profile was reported.
+    """
+
+    def __init__(self, path: str, started: float = None):
+        self.path = path
+        self.started = time.perf_counter() if started is None else started
+        self.phases = {}
+        self.reported = False
+        self._events = {}
+
+    def _event(self, name: str) -> asyncio.Event:
+        if name not in self._events:
+            self._events[name] = asyncio.Event()
+        return self._events[name]
+
+    def add(self, name: str, seconds: float) -> None:
+        """Adds `seconds` to the duration of a phase."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+        self._event(name).set()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Times the wrapped block as the phase `name`, it can be async code."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def wait(self, *names: str, timeout: float = None) -> bool:
+        """Waits until the phases are recorded, returns `False` on timeout."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(self._event(name).wait() for name in names)), timeout
+            )
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def history(self) -> typing.List[dict]:
+        """Returns the stored startup profiles, oldest first."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (OSError, ValueError):
+            return []
+
+    def format(self, history: typing.List[dict] = None) -> typing.List[str]:
+        """
+        Formats the phases, compared to the median of the previous startups.
+        """
+        history = self.history() if history is None else history
+        total = time.perf_counter() - self.started
+        lines = []
+        for name, seconds in list(self.phases.items()) + [("total", total)]:
+            previous = [h["phases"].get(name) for h in history if name in h.get("phases", {})]
+            line = f"{name:<16}{seconds * 1000:>9.0f}ms"
+            if previous:
+                median = statistics.median(previous)
+                line += f"  (median {median * 1000:.0f}ms, {(seconds - median) * 1000:+.0f}ms)"
+            lines.append(line)
+        return lines
+
+    def report(self, version: str = None) -> None:
+        """Logs the phases and appends the profile to the history file."""
+        if self.reported:
+            return
+        self.reported = True
+        history = self.history()
+        logger.info("Startup profile:")
+        for line in self.format(history):
+            logger.info(line)
+
+        total = time.perf_counter() - self.started
+        history.append(
+            {
+                "timestamp": str(datetime.utcnow()),
+                "version": version,
+                "phases": dict(self.phases, total=total),
+            }
+        )
+        try:
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                for entry in history[-HISTORY_SIZE:]:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            logger.warning("Failed to store the startup profile.", exc_info=True)
+
+
+def main() -> None:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the recorded startup profiles.")
+    parser.add_argument("--path", default=os.path.join("temp", "startup.jsonl"))
+    parser.add_argument("--last", type=int, default=10)
+    args = parser.parse_args()
+
+    history = StartupProfiler(args.path).history()[-args.last :]
+    if not history:
+        print("No startup profile recorded.")
+        return
+    names = []
+    for entry in history:
+        names.extend(n for n in entry["phases"] if n not in names)
+    print(f"{'':<28}" + "".join(f"{name[:12]:>13}" for name in names))
+    for entry in history:
+        row = f"{entry['timestamp'][:19]:<20}{entry.get('version') or '':<8}"
+        for name in names:
+            seconds = entry["phases"].get(name)
+            row += f"{seconds * 1000:>11.0f}ms" if seconds is not None else f"{'-':>13}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
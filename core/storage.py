@@ -0,0 +1,1293 @@
+"""
+Storage backends for Modmail's logs, config and plugin partitions.
+
+The rest of the bot talks to the database through a small subset of Motor's
+collection API (``find``, ``find_one``, ``insert_one``, ``update_one``,
+``find_one_and_update``, ...). `MongoBackend` hands out Motor collections
+directly, `SQLiteBackend` implements the same subset on top of an embedded
+SQLite database in WAL mode, which is enough for small deployments.
+
+Both backends are tested against the same suite in tests/test_storage.py.
+The module can be run as a script to compare their per-message append
+latency::
+
+    python -m core.storage --mongo-uri <uri> --messages 500
+"""
+import asyncio
+import base64
+import copy
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import typing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+try:
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
+    from pymongo.monitoring import ConnectionPoolListener
+except ImportError:  # motor (and pymongo) are optional with the SQLite backend
+    ConnectionPoolListener = object
+
+    class DuplicateKeyError(Exception):
+        pass
+
+    class BulkWriteError(Exception):
+        def __init__(self, details):
+            super().__init__("batch op errors occurred")
+            self.details = details
+
+
+logger = logging.getLogger("Modmail")
+
+MISSING = object()
+
+# Fields that are looked up on every relayed message get an SQLite
+# expression index, equality filters on them are pushed down to SQL.
+INDEXED_FIELDS = {
+    "logs": ("key", "channel_id", "recipient.id", "guild_id", "open", "closer.id"),
+    "config": ("bot_id",),
+}
+
+# Config vars tuning the MongoDB connection pools, mapped to client options.
+MONGO_POOL_OPTIONS = {
+    "mongo_max_pool_size": "maxPoolSize",
+    "mongo_min_pool_size": "minPoolSize",
+    "mongo_max_idle_time": "maxIdleTimeMS",
+    "mongo_wait_queue_timeout": "waitQueueTimeoutMS",
+    "mongo_connect_timeout": "connectTimeoutMS",
+    "mongo_server_selection_timeout": "serverSelectionTimeoutMS",
+}
+
+DEFAULT_READ_PREFERENCE = "secondaryPreferred"
+DEFAULT_RELAY_TIMEOUT = 2000  # ms
+
+
+class StorageBackend:
+    """
+    The base class of Modmail storage backends.
+
+    Attributes
+    ----------
+    name : str
+        The name of the backend, as set with the `database_type` config var.
+    db : Any
+        The database object, `db.logs` and `db.config` are the log and
+        config collections, `db.plugins[name]` is a plugin partition.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.db = None
+
+    @staticmethod
+    def from_config(config, data_dir: str) -> "StorageBackend":
+        """
+        Creates the backend selected by the `database_type` config var.
+
+        Parameters
+        ----------
+        config : ConfigManager
+            The bot's config.
+        data_dir : str
+            The directory where local databases are stored by default.
+
+        Returns
+        -------
+        StorageBackend
+            The `MongoBackend` (default) or `SQLiteBackend`.
+        """
+        database_type = str(config.get("database_type") or "mongodb").lower()
+        if database_type == "sqlite":
+            path = config.get("sqlite_path") or os.path.join(data_dir, "modmail.db")
+            return SQLiteBackend(path)
+        if database_type != "mongodb":
+            logger.warning("Invalid database type %s, using mongodb.", database_type)
+        return MongoBackend(config)
+
+    @property
+    def read_db(self):
+        """
+        The database used for heavy reads (search, history, analytics), these
+        may be served by a secondary. Defaults to `db`.
+        """
+        return self.db
+
+    @property
+    def relay_db(self):
+        """The database used for relayed message writes. Defaults to `db`."""
+        return self.db
+
+    @property
+    def relay_options(self) -> dict:
+        """Extra keyword arguments passed to relay writes."""
+        return {}
+
+    def get_partition(self, name: str):
+        """Returns the collection used by the plugin `name`."""
+        return self.db.plugins[name]
+
+    def pool_stats(self) -> typing.Dict[str, dict]:
+        """Returns the connection pool statistics, keyed by pool name."""
+        return {}
+
+    def profile(self, profiler) -> None:
+        """
+        Records the operations of every collection handed out by the
+        backend in `profiler`, a `QueryProfiler`.
+
+        Must be called before the databases are handed out.
+        """
+        from core.dbprofiler import ProfiledDatabase
+
+        self.db = ProfiledDatabase(self.db, profiler)
+
+    async def validate(self) -> None:
+        """Raises an exception if the database cannot be reached."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Releases the resources held by the backend."""
+
+
+class PoolMonitor(ConnectionPoolListener):
+    """
+    Records connection checkouts and pool wait times of a MongoDB client.
+
+    Checkout events are published on the thread waiting for a connection,
+    so the wait time is measured per thread.
+
+    Attributes
+    ----------
+    checkouts : int
+        The number of successful connection checkouts.
+    failed : int
+        The number of checkouts that failed, mostly because of
+        ``waitQueueTimeoutMS``.
+    in_use : int
+        The number of connections currently checked out.
+    open : int
+        The number of open connections.
+    waits : Deque[float]
+        The most recent pool wait times, in milliseconds.
+    """
+
+    def __init__(self, samples: int = 1024):
+        self.checkouts = 0
+        self.failed = 0
+        self.in_use = 0
+        self.open = 0
+        self.total_wait = 0.0
+        self.waits = deque(maxlen=samples)
+        self._local = threading.local()
+
+    def _waited(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        if started is None:
+            return 0.0
+        return (time.perf_counter() - started) * 1000
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event) -> None:
+        wait = self._waited()
+        self.checkouts += 1
+        self.in_use += 1
+        self.total_wait += wait
+        self.waits.append(wait)
+
+    def connection_check_out_failed(self, event) -> None:
+        self.waits.append(self._waited())
+        self.failed += 1
+
+    def connection_checked_in(self, event) -> None:
+        self.in_use = max(self.in_use - 1, 0)
+
+    def connection_created(self, event) -> None:
+        self.open += 1
+
+    def connection_closed(self, event) -> None:
+        self.open = max(self.open - 1, 0)
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        pass
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+
+        def percentile(p):
+            if not waits:
+                return 0.0
+            return waits[min(int(len(waits) * p), len(waits) - 1)]
+
+        return {
+            "checkouts": self.checkouts,
+            "failed": self.failed,
+            "in_use": self.in_use,
+            "open": self.open,
+            "wait_mean": self.total_wait / self.checkouts if self.checkouts else 0.0,
+            "wait_p50": percentile(0.5),
+            "wait_p99": percentile(0.99),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
+
+
+class MongoBackend(StorageBackend):
+    """
+    The MongoDB backend, Motor collections are used as-is.
+
+    Three clients are created so that heavy reads cannot starve the relay
+    of connections: the main client (primary reads, writes), a read client
+    with its own pool and read preference, which defaults to
+    secondary-preferred, and a relay client for relayed message writes.
+
+    ``maxTimeMS`` only bounds the time spent on the server, so the relay
+    client also bounds the pool checkout, the server selection and the
+    socket reads to `relay_timeout`: a relay write fails fast instead of
+    waiting for the driver defaults (up to 30 seconds or more) when the
+    database is unreachable.
+    """
+
+    name = "mongodb"
+
+    def __init__(self, config):
+        super().__init__()
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from pymongo import ReadPreference, WriteConcern
+
+        mongo_uri = config.get("mongo_uri")
+        if mongo_uri is None:
+            raise ValueError("A Mongo URI is necessary for the mongodb database type.")
+
+        options = {}
+        for key, option in MONGO_POOL_OPTIONS.items():
+            value = config.get(key)
+            if value is not None:
+                options[option] = int(value)
+
+        read_options = dict(options)
+        if config.get("mongo_read_pool_size") is not None:
+            read_options["maxPoolSize"] = int(config.get("mongo_read_pool_size"))
+
+        self.relay_timeout = int(config.get("mongo_relay_timeout") or DEFAULT_RELAY_TIMEOUT)
+        relay_options = dict(
+            options,
+            waitQueueTimeoutMS=self.relay_timeout,
+            serverSelectionTimeoutMS=self.relay_timeout,
+            socketTimeoutMS=self.relay_timeout,
+        )
+
+        self.monitors = {"main": PoolMonitor(), "read": PoolMonitor(), "relay": PoolMonitor()}
+        self.client = AsyncIOMotorClient(
+            mongo_uri, event_listeners=[self.monitors["main"]], **options
+        )
+        self.read_client = AsyncIOMotorClient(
+            mongo_uri,
+            readPreference=config.get("mongo_read_preference") or DEFAULT_READ_PREFERENCE,
+            event_listeners=[self.monitors["read"]],
+            **read_options,
+        )
+        self.relay_client = AsyncIOMotorClient(
+            mongo_uri, event_listeners=[self.monitors["relay"]], **relay_options
+        )
+        self.db = self.client.modmail_bot
+        self._read_db = self.read_client.modmail_bot
+        self._relay_db = self.relay_client.get_database(
+            "modmail_bot", read_preference=ReadPreference.PRIMARY, write_concern=WriteConcern(w=1)
+        )
+
+    @property
+    def read_db(self):
+        return self._read_db
+
+    @property
+    def relay_db(self):
+        return self._relay_db
+
+    @property
+    def relay_options(self) -> dict:
+        return {"maxTimeMS": self.relay_timeout}
+
+    def pool_stats(self) -> typing.Dict[str, dict]:
+        return {name: monitor.stats() for name, monitor in self.monitors.items()}
+
+    def profile(self, profiler) -> None:
+        from core.dbprofiler import ProfiledDatabase
+
+        super().profile(profiler)
+        self._read_db = ProfiledDatabase(self._read_db, profiler)
+        self._relay_db = ProfiledDatabase(self._relay_db, profiler)
+
+    async def validate(self) -> None:
+        await self.db.command("buildinfo")
+
+    def close(self) -> None:
+        self.client.close()
+        self.read_client.close()
+        self.relay_client.close()
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded SQLite backend.
+
+    Every collection is a table of JSON documents. Writes are serialized on a
+    single worker thread, reads run on a small thread pool, so the event loop
+    never blocks on the database file.
+
+    Parameters
+    ----------
+    path : str
+        The path to the database file.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        super().__init__()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+        self.readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sqlite-reader")
+        self.db = SQLiteDatabase(self)
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns the SQLite connection of the current thread."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    async def write(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.writer, func, *args)
+
+    async def read(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.readers, func, *args)
+
+    async def validate(self) -> None:
+        await self.read(lambda: self.connection().execute("SELECT 1").fetchone())
+
+    def close(self) -> None:
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+class SQLiteDatabase:
+    """A Motor database look-alike, collections are created on first access."""
+
+    def __init__(self, backend: SQLiteBackend):
+        self.backend = backend
+        self._collections = {}
+        self.plugins = SQLitePartitions(self)
+
+    def __getattr__(self, name: str) -> "SQLiteCollection":
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name: str) -> "SQLiteCollection":
+        if name not in self._collections:
+            self._collections[name] = SQLiteCollection(self.backend, name)
+        return self._collections[name]
+
+    async def command(self, name: str) -> dict:
+        if name.lower() == "buildinfo":
+            return {"version": sqlite3.sqlite_version, "backend": "sqlite"}
+        raise NotImplementedError(f"Unsupported command: {name}.")
+
+
+class SQLitePartitions:
+    """Gives access to plugin partitions, as in `db.plugins[name]`."""
+
+    def __init__(self, db: SQLiteDatabase):
+        self.db = db
+
+    def __getitem__(self, name: str) -> "SQLiteCollection":
+        return self.db[f"plugins.{name}"]
+
+    def __getattr__(self, name: str) -> "SQLiteCollection":
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+# Document codec
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, bytes):
+        return {"$binary": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _decode(obj: dict):
+    if len(obj) == 1:
+        if "$date" in obj:
+            return datetime.fromisoformat(obj["$date"])
+        if "$binary" in obj:
+            return base64.b64decode(obj["$binary"])
+    return obj
+
+
+def dumps(doc) -> str:
+    return json.dumps(doc, default=_encode, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(text: str):
+    return json.loads(text, object_hook=_decode)
+
+
+# Query language
+
+
+def _resolve(doc, path: str) -> list:
+    """Returns every value found at a dotted `path`, traversing arrays like MongoDB."""
+    values = [doc]
+    for part in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(v[part] for v in value if isinstance(v, dict) and part in v)
+        values = found
+    return values
+
+
+def _candidates(values: list) -> list:
+    """Array values also match on their elements."""
+    out = []
+    for value in values:
+        out.append(value)
+        if isinstance(value, list):
+            out.extend(value)
+    return out
+
+
+def _compare(op: str, value, target) -> bool:
+    try:
+        if op == "$gt":
+            return value > target
+        if op == "$gte":
+            return value >= target
+        if op == "$lt":
+            return value < target
+        if op == "$lte":
+            return value <= target
+    except TypeError:
+        return False
+    raise ValueError(f"Unsupported operator: {op}.")
+
+
+def _match_condition(values: list, condition) -> bool:
+    if not isinstance(condition, dict) or not any(k.startswith("$") for k in condition):
+        if condition is None:
+            return not values or None in _candidates(values)
+        return condition in _candidates(values)
+
+    for op, target in condition.items():
+        candidates = _candidates(values)
+        if op == "$eq":
+            ok = _match_condition(values, target)
+        elif op == "$ne":
+            ok = not _match_condition(values, target)
+        elif op == "$in":
+            ok = any(_match_condition(values, t) for t in target)
+        elif op == "$nin":
+            ok = not any(_match_condition(values, t) for t in target)
+        elif op == "$exists":
+            ok = bool(values) == bool(target)
+        elif op == "$regex":
+            flags = re.IGNORECASE if "i" in condition.get("$options", "") else 0
+            ok = any(isinstance(c, str) and re.search(target, c, flags) for c in candidates)
+        elif op == "$options":
+            continue
+        elif op == "$size":
+            ok = any(isinstance(v, list) and len(v) == target for v in values)
+        elif op == "$elemMatch":
+            ok = any(
+                isinstance(v, dict) and matches(v, target)
+                for value in values
+                if isinstance(value, list)
+                for v in value
+            )
+        else:
+            ok = any(_compare(op, c, target) for c in candidates)
+        if not ok:
+            return False
+    return True
+
+
+TEXT_FIELDS = ("messages.content", "messages.author.name", "key")
+
+
+def _match_text(doc: dict, search: str) -> bool:
+    # Approximates MongoDB's "$text": a phrase match when quoted, any word otherwise.
+    texts = [str(v).lower() for f in TEXT_FIELDS for v in _candidates(_resolve(doc, f))]
+    search = search.lower()
+    if search.startswith('"') and search.endswith('"'):
+        return any(search.strip('"') in t for t in texts)
+    return any(word in t for word in search.split() for t in texts)
+
+
+def matches(doc: dict, query: typing.Optional[dict]) -> bool:
+    """
+    Checks if a document matches a MongoDB-style query.
+
+    Parameters
+    ----------
+    doc : Dict[str, Any]
+        The document.
+    query : Dict[str, Any]
+        The query.
+
+    Returns
+    -------
+    bool
+        Whether `doc` matches `query`.
+    """
+    for key, condition in (query or {}).items():
+        if key == "$and":
+            ok = all(matches(doc, q) for q in condition)
+        elif key == "$or":
+            ok = any(matches(doc, q) for q in condition)
+        elif key == "$nor":
+            ok = not any(matches(doc, q) for q in condition)
+        elif key == "$text":
+            ok = _match_text(doc, condition["$search"])
+        else:
+            ok = _match_condition(_resolve(doc, key), condition)
+        if not ok:
+            return False
+    return True
+
+
+def _positional_index(doc: dict, query: dict, array: str) -> int:
+    """Finds the array element matched by `query`, for the positional `$` operator."""
+    items = _resolve(doc, array)
+    items = items[0] if items and isinstance(items[0], list) else []
+    prefix = array + "."
+    conditions = {k[len(prefix) :]: v for k, v in (query or {}).items() if k.startswith(prefix)}
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and matches(item, conditions):
+            return i
+    raise ValueError("The positional operator did not find the match needed from the query.")
+
+
+def _walk(doc: dict, path: str, query: dict, create: bool = True):
+    """Returns the container and last key of a dotted `path`."""
+    parts = path.split(".")
+    target = doc
+    for i, part in enumerate(parts[:-1]):
+        if part == "$":
+            part = str(_positional_index(doc, query, ".".join(parts[:i])))
+        if isinstance(target, list):
+            index = int(part)
+            while create and len(target) <= index:
+                target.append(None)
+            if target[index] is None and create:
+                target[index] = {}
+            target = target[index]
+        else:
+            if part not in target:
+                if not create:
+                    return None, None
+                target[part] = {}
+            target = target[part]
+        if target is None:
+            return None, None
+    last = parts[-1]
+    if last == "$":
+        last = str(_positional_index(doc, query, ".".join(parts[:-1])))
+    return target, last
+
+
+def _set(container, key: str, value) -> None:
+    if isinstance(container, list):
+        index = int(key)
+        while len(container) <= index:
+            container.append(None)
+        container[index] = value
+    else:
+        container[key] = value
+
+
+def _get(container, key: str, default=None):
+    if isinstance(container, list):
+        index = int(key)
+        return container[index] if index < len(container) else default
+    return container.get(key, default)
+
+
+def apply_update(doc: dict, update: dict, query: dict = None) -> dict:
+    """
+    Applies a MongoDB-style update to a document in place.
+
+    Supports ``$set``, ``$unset``, ``$inc``, ``$push``, ``$addToSet`` and
+    ``$pull``, including the positional ``$`` operator. ``$setOnInsert`` is
+    ignored, upserts apply it to the new document. A document without
+    operators replaces `doc`.
+    """
+    if not any(k.startswith("$") for k in update):
+        replacement = copy.deepcopy(update)
+        replacement["_id"] = doc.get("_id", replacement.get("_id"))
+        doc.clear()
+        doc.update(replacement)
+        return doc
+
+    for op, fields in update.items():
+        if op == "$setOnInsert":
+            continue
+        for path, value in fields.items():
+            value = copy.deepcopy(value)
+            container, key = _walk(doc, path, query, create=op != "$unset")
+            if container is None:
+                continue
+            if op in {"$set", "$setOnInsert"}:
+                _set(container, key, value)
+            elif op == "$unset":
+                if isinstance(container, list):
+                    _set(container, key, None)
+                else:
+                    container.pop(key, None)
+            elif op == "$inc":
+                _set(container, key, (_get(container, key) or 0) + value)
+            elif op in {"$push", "$addToSet"}:
+                current = _get(container, key)
+                if current is None:
+                    current = []
+                    _set(container, key, current)
+                items = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+                for item in items:
+                    if op == "$push" or item not in current:
+                        current.append(item)
+            elif op == "$pull":
+                current = _get(container, key) or []
+                if isinstance(value, dict) and any(k.startswith("$") for k in value):
+                    keep = [v for v in current if not _match_condition([v], value)]
+                elif isinstance(value, dict):
+                    keep = [v for v in current if not (isinstance(v, dict) and matches(v, value))]
+                else:
+                    keep = [v for v in current if v != value]
+                _set(container, key, keep)
+            else:
+                raise ValueError(f"Unsupported update operator: {op}.")
+    return doc
+
+
+def _slice(values, spec):
+    if not isinstance(values, list):
+        return values
+    if isinstance(spec, list):
+        skip, limit = spec
+        return values[skip:][:limit] if skip >= 0 else values[skip:][:limit]
+    return values[:spec] if spec >= 0 else values[spec:]
+
+
+def _merge(out: dict, parts: typing.List[str], value) -> None:
+    if len(parts) == 1:
+        out[parts[0]] = value
+        return
+    existing = out.get(parts[0])
+    if isinstance(value, list) and isinstance(existing, list):
+        for target, item in zip(existing, value):
+            target.update(item)
+    elif isinstance(existing, dict) and isinstance(value, dict):
+        _merge_dict(existing, value)
+    else:
+        out[parts[0]] = value if not isinstance(value, dict) else {}
+        if isinstance(value, dict):
+            _merge_dict(out[parts[0]], value)
+
+
+def _merge_dict(target: dict, value: dict) -> None:
+    for k, v in value.items():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge_dict(target[k], v)
+        else:
+            target[k] = v
+
+
+def project(doc: dict, projection: typing.Optional[dict]) -> dict:
+    """
+    Applies a MongoDB-style projection.
+
+    Supports inclusion and exclusion of (dotted) fields and ``$slice``.
+    """
+    if not projection:
+        return doc
+
+    slices = {k: v["$slice"] for k, v in projection.items() if isinstance(v, dict)}
+    plain = {k: v for k, v in projection.items() if k not in slices}
+    inclusion = any(v for k, v in plain.items() if k != "_id")
+
+    if inclusion:
+        out = {}
+        if plain.get("_id", 1) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        for path in [k for k, v in plain.items() if v and k != "_id"] + list(slices):
+            parts = path.split(".")
+            if len(parts) == 1:
+                if path in doc:
+                    out[path] = copy.deepcopy(doc[path])
+                continue
+            value = _rebuild(doc.get(parts[0], MISSING), parts[1:])
+            if value is not MISSING:
+                # Combined with the other sub-fields of parts[0] already projected
+                _merge(out, parts, value)
+    else:
+        out = copy.deepcopy(doc)
+        for path, value in plain.items():
+            if not value:
+                container, key = _walk(out, path, None, create=False)
+                if isinstance(container, dict):
+                    container.pop(key, None)
+
+    for path, spec in slices.items():
+        container, key = _walk(out, path, None, create=False)
+        if isinstance(container, dict) and key in container:
+            container[key] = _slice(container[key], spec)
+    return out
+
+
+def _rebuild(value, parts: typing.List[str]):
+    """Keeps only the sub-path `parts` of `value`, through arrays."""
+    if isinstance(value, list):
+        return [r for r in (_rebuild(v, parts) for v in value) if r is not MISSING]
+    if not isinstance(value, dict) or parts[0] not in value:
+        return {} if isinstance(value, dict) else MISSING
+    if len(parts) == 1:
+        return {parts[0]: copy.deepcopy(value[parts[0]])}
+    inner = _rebuild(value[parts[0]], parts[1:])
+    return {parts[0]: inner} if inner is not MISSING else {}
+
+
+def _sort_key(doc: dict, fields: typing.List[typing.Tuple[str, int]]):
+    key = []
+    for field, _ in fields:
+        values = _resolve(doc, field)
+        value = values[0] if values else None
+        # None sorts first, as in MongoDB
+        key.append((value is not None, str(type(value).__name__), value))
+    return key
+
+
+class SQLiteCursor:
+    """
+    A Motor cursor look-alike over an `SQLiteCollection` query.
+
+    Documents are read `BATCH_SIZE` at a time. A sorted cursor first scans
+    the matching documents and keeps only their sort keys and row IDs in
+    memory, the documents themselves are then read in batches, so sorting
+    large collections costs a few dozen bytes per document, not the
+    documents.
+    """
+
+    BATCH_SIZE = 200
+
+    def __init__(self, collection: "SQLiteCollection", query: dict, projection: dict = None):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+        self._buffer = None
+        self._rowids = None
+        self._last_rowid = 0
+        self._scanned_until = None
+        self._exhausted = False
+        self._returned = 0
+
+    def sort(self, key, direction: int = 1) -> "SQLiteCursor":
+        self._sort = list(key) if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def skip(self, count: int) -> "SQLiteCursor":
+        self._skip = count
+        return self
+
+    def limit(self, count: int) -> "SQLiteCursor":
+        self._limit = count
+        return self
+
+    async def to_list(self, length: typing.Optional[int] = None) -> typing.List[dict]:
+        docs = []
+        async for doc in self:
+            docs.append(doc)
+            if length and len(docs) >= length:
+                break
+        return docs
+
+    async def explain(self) -> dict:
+        """Returns the SQLite query plan, filters on indexed fields are pushed down to SQL."""
+        collection = self.collection
+
+        def explain():
+            conn = collection.backend.connection()
+            collection._setup(conn)
+            where, params = collection._where(self.query)
+            sql = f"SELECT rowid, doc FROM {collection.table} WHERE {where} ORDER BY rowid"
+            plan = [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+            return {
+                "queryPlanner": {
+                    "sql": sql,
+                    "plan": plan,
+                    "pushedDown": [k for k in self.query if k in collection.indexed or k == "_id"],
+                    "sort": self._sort,
+                }
+            }
+
+        return await collection.backend.read(explain)
+
+    def __aiter__(self):
+        return self
+
+    async def _next_sorted(self) -> dict:
+        backend = self.collection.backend
+        if self._rowids is None:
+            rowids = await backend.read(self.collection._sorted_rowids, self.query, self._sort)
+            rowids = rowids[self._skip :]
+            if self._limit:
+                rowids = rowids[: self._limit]
+            self._rowids = rowids
+            self._buffer = []
+        while not self._buffer:
+            if not self._rowids:
+                raise StopAsyncIteration
+            batch, self._rowids = self._rowids[: self.BATCH_SIZE], self._rowids[self.BATCH_SIZE :]
+            self._buffer = await backend.read(self.collection._fetch, batch)
+        return project(self._buffer.pop(0), self.projection)
+
+    async def __anext__(self) -> dict:
+        if self._sort:
+            return await self._next_sorted()
+        while True:
+            while not self._buffer:
+                if self._exhausted:
+                    raise StopAsyncIteration
+                docs, self._last_rowid = await self.collection.backend.read(
+                    self.collection._scan, self.query, self._last_rowid, self.BATCH_SIZE
+                )
+                self._exhausted = not docs and self._last_rowid == self._scanned_until
+                self._scanned_until = self._last_rowid
+                self._buffer = docs
+            doc = self._buffer.pop(0)
+
+            self._returned += 1
+            if self._returned > self._skip:
+                break
+        if self._limit and self._returned > self._limit + self._skip:
+            self._exhausted = True
+            self._buffer = []
+            raise StopAsyncIteration
+        return project(doc, self.projection)
+
+
+class SQLiteCollection:
+    """
+    A collection stored in an SQLite table, with Motor's async API.
+
+    Parameters
+    ----------
+    backend : SQLiteBackend
+        The backend owning the database file.
+    name : str
+        The name of the collection.
+    """
+
+    def __init__(self, backend: SQLiteBackend, name: str):
+        self.backend = backend
+        self.name = name
+        self.table = '"' + name.replace('"', '""') + '"'
+        self.indexed = set(INDEXED_FIELDS.get(name, ()))
+        self._ready = False
+
+    def __repr__(self):
+        return f"SQLiteCollection({self.name!r})"
+
+    # Internals, always called from a backend thread
+
+    def _setup(self, conn: sqlite3.Connection) -> None:
+        if self._ready:
+            return
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} (id TEXT PRIMARY KEY, doc TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS _indexes "
+            "(collection TEXT, field TEXT, PRIMARY KEY (collection, field))"
+        )
+        rows = conn.execute("SELECT field FROM _indexes WHERE collection = ?", (self.name,))
+        self.indexed.update(row[0] for row in rows)
+        for field in self.indexed:
+            self._create_index(conn, field)
+        self._ready = True
+
+    def _create_index(self, conn: sqlite3.Connection, field: str) -> str:
+        name = f"ix_{self.name}_{field}".replace('"', "")
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "{name}" ON {self.table} '
+            f"(json_extract(doc, '$.{field}'))"
+        )
+        return name
+
+    def _where(self, query: dict) -> typing.Tuple[str, list]:
+        clauses, params = [], []
+        for key, value in (query or {}).items():
+            if key not in self.indexed:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (str, int, float)):
+                clauses.append(f"json_extract(doc, '$.{key}') = ?")
+                params.append(value)
+            elif isinstance(value, dict) and set(value) == {"$in"}:
+                values = [int(v) if isinstance(v, bool) else v for v in value["$in"]]
+                if values and all(isinstance(v, (str, int, float)) for v in values):
+                    marks = ", ".join("?" * len(values))
+                    clauses.append(f"json_extract(doc, '$.{key}') IN ({marks})")
+                    params.extend(values)
+        if "_id" in (query or {}) and not isinstance(query["_id"], dict):
+            clauses.append("id = ?")
+            params.append(dumps(query["_id"]))
+        return (" AND ".join(clauses) or "1"), params
+
+    def _scan(self, query, after=0, limit=None, max_docs=None):
+        """
+        Returns the matching documents and the last row scanned.
+
+        `limit` bounds the number of rows read, `max_docs` the number of matches.
+        """
+        conn = self.backend.connection()
+        self._setup(conn)
+        where, params = self._where(query)
+        sql = f"SELECT rowid, doc FROM {self.table} WHERE {where} AND rowid > ? ORDER BY rowid"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        found, last = [], after
+        for rowid, text in conn.execute(sql, params + [after]):
+            last = rowid
+            doc = loads(text)
+            if matches(doc, query):
+                found.append(doc)
+                if max_docs and len(found) >= max_docs:
+                    break
+        return found, last
+
+    def _sorted_rowids(self, query, sort) -> typing.List[int]:
+        """Returns the row IDs of the matching documents, in `sort` order."""
+        conn = self.backend.connection()
+        self._setup(conn)
+        where, params = self._where(query)
+        sql = f"SELECT rowid, doc FROM {self.table} WHERE {where} ORDER BY rowid"
+
+        entries = []
+        for rowid, text in conn.execute(sql, params):
+            doc = loads(text)
+            if matches(doc, query):
+                entries.append((rowid, [_sort_key(doc, [field]) for field in sort]))
+        # Stable sorts from the last field, so equal keys stay in insertion order
+        for i, (_, direction) in reversed(list(enumerate(sort))):
+            entries.sort(key=lambda entry, i=i: entry[1][i], reverse=direction < 0)
+        return [rowid for rowid, _ in entries]
+
+    def _fetch(self, rowids: typing.List[int]) -> typing.List[dict]:
+        """Returns the documents of `rowids` in this order, deleted ones are left out."""
+        conn = self.backend.connection()
+        self._setup(conn)
+        marks = ", ".join("?" * len(rowids))
+        rows = conn.execute(
+            f"SELECT rowid, doc FROM {self.table} WHERE rowid IN ({marks})", rowids
+        )
+        docs = dict(rows)
+        return [loads(docs[rowid]) for rowid in rowids if rowid in docs]
+
+    def _select_sync(self, query, max_docs=None):
+        return self._scan(query, max_docs=max_docs)[0]
+
+    async def _select(self, query):
+        return await self.backend.read(self._select_sync, query)
+
+    def _write(self, conn, doc: dict, insert: bool = False) -> None:
+        if insert:
+            try:
+                conn.execute(
+                    f"INSERT INTO {self.table} (id, doc) VALUES (?, ?)",
+                    (dumps(doc["_id"]), dumps(doc)),
+                )
+            except sqlite3.IntegrityError as e:
+                raise DuplicateKeyError(f"E11000 duplicate key error _id: {doc['_id']}") from e
+        else:
+            conn.execute(
+                f"UPDATE {self.table} SET doc = ? WHERE id = ?", (dumps(doc), dumps(doc["_id"]))
+            )
+
+    def _update_sync(self, query, update, upsert, multi, return_document=None, projection=None):
+        conn = self.backend.connection()
+        self._setup(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            docs = self._select_sync(query, max_docs=None if multi else 1)
+            before = None
+            upserted_id = None
+            for doc in docs:
+                if return_document is False:
+                    before = copy.deepcopy(doc)
+                apply_update(doc, update, query)
+                self._write(conn, doc)
+            if not docs and upsert:
+                doc = {
+                    k: v
+                    for k, v in query.items()
+                    if not k.startswith("$") and not isinstance(v, dict) and "." not in k
+                }
+                update = dict(update)
+                on_insert = update.pop("$setOnInsert", None)
+                apply_update(doc, update, query)
+                if on_insert:
+                    apply_update(doc, {"$set": on_insert})
+                doc.setdefault("_id", secrets.token_hex(12))
+                upserted_id = doc["_id"]
+                self._write(conn, doc, insert=True)
+                docs = [doc]
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        if return_document is not None:
+            result = before if return_document is False else (docs[0] if docs else None)
+            return project(result, projection) if result is not None else None
+        return SimpleNamespace(
+            acknowledged=True,
+            matched_count=len(docs) if upserted_id is None else 0,
+            modified_count=len(docs) if upserted_id is None else 0,
+            upserted_id=upserted_id,
+        )
+
+    def _insert_sync(self, docs: typing.List[dict], ordered: bool = True):
+        conn = self.backend.connection()
+        self._setup(conn)
+        inserted, errors = [], []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for i, doc in enumerate(docs):
+                doc.setdefault("_id", secrets.token_hex(12))
+                try:
+                    self._write(conn, doc, insert=True)
+                    inserted.append(doc["_id"])
+                except DuplicateKeyError as exc:
+                    errors.append({"index": i, "code": 11000, "errmsg": str(exc), "op": doc})
+                    if ordered:
+                        break
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return inserted, errors
+
+    def _delete_sync(self, query, multi: bool):
+        conn = self.backend.connection()
+        self._setup(conn)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            docs = self._select_sync(query, max_docs=None if multi else 1)
+            for doc in docs:
+                conn.execute(f"DELETE FROM {self.table} WHERE id = ?", (dumps(doc["_id"]),))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return SimpleNamespace(acknowledged=True, deleted_count=len(docs))
+
+    # Motor API
+
+    def find(self, filter: dict = None, projection: dict = None, **kwargs) -> SQLiteCursor:
+        cursor = SQLiteCursor(self, filter, projection or kwargs.get("projection"))
+        if kwargs.get("sort"):
+            cursor.sort(kwargs["sort"])
+        if kwargs.get("limit"):
+            cursor.limit(kwargs["limit"])
+        return cursor
+
+    async def find_one(self, filter: dict = None, projection: dict = None, **kwargs):
+        docs = await self.find(filter, projection, **kwargs).to_list(1)
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: dict = None, **kwargs) -> int:
+        return len(await self._select(filter or {}))
+
+    async def estimated_document_count(self, **kwargs) -> int:
+        def count():
+            conn = self.backend.connection()
+            self._setup(conn)
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+        return await self.backend.read(count)
+
+    async def insert_one(self, document: dict, **kwargs):
+        inserted, errors = await self.backend.write(self._insert_sync, [document])
+        if errors:
+            raise DuplicateKeyError(errors[0]["errmsg"])
+        return SimpleNamespace(acknowledged=True, inserted_id=inserted[0])
+
+    async def insert_many(self, documents: typing.Iterable[dict], ordered: bool = True, **kwargs):
+        documents = list(documents)
+        inserted, errors = await self.backend.write(self._insert_sync, documents, ordered)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nInserted": len(inserted)})
+        return SimpleNamespace(acknowledged=True, inserted_ids=inserted)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        return await self.backend.write(self._update_sync, filter, update, upsert, False)
+
+    async def update_many(self, filter: dict, update: dict, upsert: bool = False, **kwargs):
+        return await self.backend.write(self._update_sync, filter, update, upsert, True)
+
+    async def replace_one(self, filter: dict, replacement: dict, upsert: bool = False, **kwargs):
+        return await self.backend.write(self._update_sync, filter, replacement, upsert, False)
+
+    async def find_one_and_update(
+        self,
+        filter: dict,
+        update: dict,
+        projection: dict = None,
+        upsert: bool = False,
+        return_document: bool = False,
+        **kwargs,
+    ):
+        return await self.backend.write(
+            self._update_sync, filter, update, upsert, False, bool(return_document), projection
+        )
+
+    async def delete_one(self, filter: dict, **kwargs):
+        return await self.backend.write(self._delete_sync, filter, False)
+
+    async def delete_many(self, filter: dict, **kwargs):
+        return await self.backend.write(self._delete_sync, filter, True)
+
+    async def create_index(self, keys, **kwargs) -> str:
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        # Text indexes are served by scanning, only plain fields are indexed
+        fields = [field for field, kind in keys if kind != "text"]
+        if not fields:
+            return ""
+
+        def create():
+            conn = self.backend.connection()
+            self._setup(conn)
+            for field in fields:
+                conn.execute(
+                    "INSERT OR IGNORE INTO _indexes (collection, field) VALUES (?, ?)",
+                    (self.name, field),
+                )
+                self.indexed.add(field)
+                name = self._create_index(conn, field)
+            return name
+
+        return await self.backend.write(create)
+
+    async def index_information(self) -> dict:
+        return {f"ix_{self.name}_{field}": {"key": [(field, 1)]} for field in self.indexed}
+
+    async def drop_index(self, name: str, **kwargs) -> None:
+        pass
+
+
+# Benchmark
+
+
+async def _bench(backend: StorageBackend, messages: int) -> None:
+    loop = asyncio.get_event_loop()
+    logs = backend.db["bench_logs"]
+    await logs.delete_many({})
+    await logs.insert_one({"_id": "bench", "key": "bench", "channel_id": "0", "messages": []})
+    timings = []
+    for i in range(messages):
+        data = {
+            "timestamp": str(datetime.utcnow()),
+            "message_id": str(i),
+            "author": {"id": "1", "name": "bench", "discriminator": "0001", "mod": False},
+            "content": "Lorem ipsum dolor sit amet " * 4,
+            "type": "thread_message",
+            "attachments": [],
+        }
+        start = loop.time()
+        await logs.find_one_and_update(
+            {"channel_id": "0"}, {"$push": {"messages": data}}, return_document=True
+        )
+        timings.append((loop.time() - start) * 1000)
+    await logs.delete_many({})
+    timings.sort()
+    print(
+        f"{backend.name:8} mean {sum(timings) / len(timings):8.2f} ms"
+        f"  p50 {timings[len(timings) // 2]:8.2f} ms"
+        f"  p99 {timings[int(len(timings) * 0.99)]:8.2f} ms"
+    )
+
+
+def main() -> None:
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmark the storage backends.")
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.path.join(tempfile.mkdtemp(), "bench.db"))
+    parser.add_argument("--messages", type=int, default=500)
+    args = parser.parse_args()
+
+    backends = [SQLiteBackend(args.sqlite_path)]
+    if args.mongo_uri:
+        backends.insert(0, MongoBackend({"mongo_uri": args.mongo_uri}))
+
+    loop = asyncio.get_event_loop()
+    for backend in backends:
+        loop.run_until_complete(_bench(backend, args.messages))
+    for backend in backends:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Thread summaries, stored on each log when it is closed.
+
+The `summary` sub-document answers the usual analytics questions without
+walking the messages::
+
+    {
+        "version": 1,
+        "duration": float,              # seconds from creation to closing
+        "first_response": float,        # seconds from the first recipient message
+                                        # to the first moderator reply, or None
+        "messages": {"recipient": int, "mod": int},
+        "notes": int,
+        "responders": int,              # distinct moderators who replied
+        "top_responder": {"id", "name", "messages"},  # or None
+    }
+
+Logs closed before summaries existed are backfilled in the background::
+
+    python -m core.summary backfill --mongo-uri <uri>
+"""
+import asyncio
+import logging
+import os
+import typing
+from collections import Counter
+from datetime import datetime
+
+from core.logschema import expand_log
+
+logger = logging.getLogger("Modmail")
+
+SUMMARY_VERSION = 1
+
+# Enough of a log to summarize it, without the message contents.
+SUMMARY_PROJECTION = {
+    "key": 1,
+    "created_at": 1,
+    "closed_at": 1,
+    "participants": 1,
+    "archived": 1,
+    "messages.timestamp": 1,
+    "messages.author": 1,
+    "messages.mod": 1,
+    "messages.type": 1,
+}
+
+
+def _parse(value) -> typing.Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+class SummaryBuilder:
+    """
+    Accumulates the summary of a log, one message at a time.
+
+    Parameters
+    ----------
+    created_at : Union[str, datetime]
+        The creation date of the log.
+    """
+
+    def __init__(self, created_at):
+        self.created_at = _parse(created_at)
+        self.counts = Counter()
+        self.replies = Counter()
+        self.names = {}
+        self.first_message = None
+        self.first_response = None
+
+    def add(self, message: dict) -> None:
+        """Adds a message, in the version 1 log format."""
+        type_ = message.get("type", "thread_message")
+        if type_ == "note":
+            self.counts["notes"] += 1
+            return
+        if type_ not in {"thread_message", "anonymous"}:
+            return
+
+        author = message.get("author") or {}
+        timestamp = _parse(message.get("timestamp"))
+        if not author.get("mod"):
+            self.counts["recipient"] += 1
+            if self.first_message is None:
+                self.first_message = timestamp
+            return
+
+        self.counts["mod"] += 1
+        self.replies[author.get("id")] += 1
+        self.names[author.get("id")] = author.get("name")
+        if self.first_response is None and self.first_message is not None:
+            self.first_response = timestamp
+
+    def result(self, closed_at) -> dict:
+        closed_at = _parse(closed_at)
+        duration = first_response = None
+        if closed_at is not None and self.created_at is not None:
+            duration = (closed_at - self.created_at).total_seconds()
+        if self.first_response is not None and self.first_message is not None:
+            first_response = (self.first_response - self.first_message).total_seconds()
+
+        top_responder = None
+        if self.replies:
+            top_id, count = self.replies.most_common(1)[0]
+            top_responder = {"id": top_id, "name": self.names[top_id], "messages": count}
+
+        return {
+            "version": SUMMARY_VERSION,
+            "duration": duration,
+            "first_response": first_response,
+            "messages": {"recipient": self.counts["recipient"], "mod": self.counts["mod"]},
+            "notes": self.counts["notes"],
+            "responders": len(self.replies),
+            "top_responder": top_responder,
+        }
+
+
+def summarize_log(log: dict, closed_at=None) -> dict:
+    """
+    Computes the summary of a log document.
+
+    Parameters
+    ----------
+    log : Dict[str, Any]
+        The log, in any schema version, `SUMMARY_PROJECTION` is enough.
+    closed_at : Union[str, datetime], optional
+        The closing date, defaults to the `closed_at` of the log.
+    """
+    log = expand_log(log)
+    builder = SummaryBuilder(log.get("created_at"))
+    for message in log.get("messages") or []:
+        builder.add(message)
+    return builder.result(closed_at or log.get("closed_at"))
+
+
+async def backfill(collection, archive=None, batch_size: int = 200, concurrency: int = 4) -> int:
+    """
+    Stores the summary of the closed logs which don't have one.
+
+    Parameters
+    ----------
+    collection : AsyncIOMotorCollection
+        The logs collection.
+    archive : ArchiveStore, optional
+        Where archived logs are read from, they are skipped without it.
+    batch_size : int, optional
+        The number of logs read per batch.
+    concurrency : int, optional
+        The maximum number of concurrent updates.
+
+    Returns
+    -------
+    int
+        The number of summarized logs.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+    skipped = set()
+
+    async def summarize(log):
+        nonlocal done
+        async with semaphore:
+            if "archived" in log:
+                full = await archive.fetch(log) if archive is not None else None
+                if full is None:
+                    skipped.add(log["_id"])
+                    return
+                log = full
+            await collection.update_one(
+                {"_id": log["_id"]}, {"$set": {"summary": summarize_log(log)}}
+            )
+            done += 1
+
+    query = {"open": False, "summary": {"$exists": False}}
+    while True:
+        batch_query = dict(query, _id={"$nin": list(skipped)}) if skipped else query
+        logs = await collection.find(batch_query, SUMMARY_PROJECTION).to_list(batch_size)
+        if not logs:
+            break
+        await asyncio.gather(*(summarize(log) for log in logs))
+        logger.info("Summarized %d logs.", done)
+        if len(logs) < batch_size:
+            break
+    return done
+
+
+def main() -> None:
+    import argparse
+
+    from core.storage import StorageBackend
+
+    parser = argparse.ArgumentParser(description="Backfill the summaries of closed logs.")
+    parser.add_argument("action", choices=["backfill"])
+    parser.add_argument("--database-type", default=os.getenv("DATABASE_TYPE"))
+    parser.add_argument("--mongo-uri", default=os.getenv("MONGO_URI"))
+    parser.add_argument("--sqlite-path", default=os.getenv("SQLITE_PATH"))
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    storage = StorageBackend.from_config(
+        {
+            "database_type": args.database_type,
+            "mongo_uri": args.mongo_uri,
+            "sqlite_path": args.sqlite_path,
+        },
+        "temp",
+    )
+    loop = asyncio.get_event_loop()
+    count = loop.run_until_complete(
+        backfill(storage.db.logs, batch_size=args.batch_size, concurrency=args.concurrency)
+    )
+    logger.info("Summarized %d logs.", count)
+    storage.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
 import asyncio
 import logging
-import os
 import re
 import string
+import time
 import typing
 from datetime import datetime, timedelta
 from types import SimpleNamespace as param
@@ -12,6 +12,7 @@ import isodate
 from discord.ext.commands import MissingRequiredArgument, CommandError
 
 from core.time import human_timedelta
+from core.tracing import set_status, span, traced
 from core.utils import is_image_url, days, match_user_id
 from core.utils import truncate, ignore, error
 
@@ -80,6 +81,7 @@ class Thread:
         """Create the thread channel and other io related initialisation tasks"""
 
         self.bot.dispatch("thread_create", self)
+        self.bot.metrics.threads_created.inc()
 
         recipient = self.recipient
 
@@ -116,16 +118,20 @@ class Thread:
 
         self._channel = channel
 
-        try:
-            log_url, log_data = await asyncio.gather(
-                self.bot.api.create_log_entry(recipient, channel, creator or recipient),
-                self.bot.api.get_user_logs(recipient.id),
-            )
-
+        log_url, log_data = await asyncio.gather(
+            self.bot.api.create_log_entry(recipient, channel, creator or recipient),
+            self.bot.api.get_user_logs(recipient.id),
+            return_exceptions=True,
+        )
+        # Something went wrong with database? ensure core functionality still works
+        if isinstance(log_url, Exception):
+            logger.error("Failed to create the log entry.", exc_info=log_url)
+            log_url = None
+        if isinstance(log_data, Exception):
+            logger.warning("Failed to fetch previous logs: %s", log_data)
+            log_count = None
+        else:
             log_count = sum(1 for log in log_data if not log["open"])
-        except:  # Something went wrong with database?
-            log_url = log_count = None
-            # ensure core functionality still works
 
         topic = f"User ID: {recipient.id}"
         if creator:
@@ -213,23 +219,36 @@ class Thread:
             }
             self.bot.config.closures[str(self.id)] = items
             await self.bot.config.update()
-
-            task = self.bot.loop.call_later(
-                after, self._close_after, closer, silent, delete_channel, message
-            )
-
-            if auto_close:
-                self.auto_close_task = task
-            else:
-                self.close_task = task
+            self.schedule_close(after, closer, silent, delete_channel, message, auto_close)
         else:
             await self._close(closer, silent, delete_channel, message)
 
+    def schedule_close(
+        self,
+        after: float,
+        closer: typing.Union[discord.Member, discord.User],
+        silent: bool,
+        delete_channel: bool,
+        message: str,
+        auto_close: bool,
+    ) -> None:
+        """Schedules the closing of the thread, without storing it in `closures`."""
+        task = self.bot.loop.call_later(
+            after, self._close_after, closer, silent, delete_channel, message
+        )
+        if auto_close:
+            self.auto_close_task = task
+        else:
+            self.close_task = task
+
     async def _close(
         self, closer, silent=False, delete_channel=True, message=None, scheduled=False
     ):
         del self.manager.cache[self.id]
 
+        self.bot.dispatch("thread_close", self, closer, silent, delete_channel, message, scheduled)
+        self.bot.metrics.threads_closed.labels("yes" if scheduled else "no").inc()
+
         await self.cancel_closure(all=True)
 
         # Cancel auto closing the thread if closed by any means.
@@ -255,13 +274,10 @@ class Thread:
         )
 
         if log_data is not None and isinstance(log_data, dict):
-            prefix = os.getenv("LOG_URL_PREFIX", "/logs")
-            if prefix == "NONE":
-                prefix = ""
-            log_url = f"{self.bot.config.log_url.strip('/')}{prefix}/{log_data['key']}"
+            log_url = self.bot.api.format_log_link(log_data["key"])
 
-            if log_data["messages"]:
-                content = str(log_data["messages"][0]["content"])
+            if log_data["preview"] is not None:
+                content = str(log_data["preview"])
                 sneak_peak = content.replace("\n", "")
             else:
                 sneak_peak = "Pas de message."
@@ -455,6 +471,10 @@ class Thread:
         return msg
 
     async def reply(self, message: discord.Message, anonymous: bool = False) -> None:
+        with self.bot.tracer.trace("to_user", user=self.id, message=message.id):
+            await self._reply(message, anonymous)
+
+    async def _reply(self, message: discord.Message, anonymous: bool = False) -> None:
         if not message.content and not message.attachments:
             raise MissingRequiredArgument(param(name="msg"))
         if all(not g.get_member(self.id) for g in self.bot.guilds):
@@ -468,12 +488,16 @@ class Thread:
 
         tasks = []
 
+        started = time.perf_counter()
         try:
-            await self.send(
-                message, destination=self.recipient, from_mod=True, anonymous=anonymous
-            )
+            with span("thread.send.recipient"):
+                await self.send(
+                    message, destination=self.recipient, from_mod=True, anonymous=anonymous
+                )
         except Exception:
             logger.info(error("Erreur :"), exc_info=True)
+            set_status("failed")
+            self.bot.metrics.relayed.labels("to_user", "failed").inc()
             tasks.append(
                 message.channel.send(
                     embed=discord.Embed(
@@ -486,21 +510,31 @@ class Thread:
                 )
             )
         else:
+            self.bot.metrics.relayed.labels("to_user", "sent").inc()
+            self.bot.metrics.relay_seconds.labels("to_user").observe(
+                time.perf_counter() - started
+            )
             # Send the same thing in the thread channel.
             tasks.append(
-                self.send(
-                    message,
-                    destination=self.channel,
-                    from_mod=True,
-                    anonymous=anonymous,
+                traced(
+                    "thread.send.channel",
+                    self.send(
+                        message,
+                        destination=self.channel,
+                        from_mod=True,
+                        anonymous=anonymous,
+                    ),
                 )
             )
 
             tasks.append(
-                self.bot.api.append_log(
-                    message,
-                    self.channel.id,
-                    type_="anonymous" if anonymous else "thread_message",
+                traced(
+                    "append_log",
+                    self.bot.api.append_log(
+                        message,
+                        self.channel.id,
+                        type_="anonymous" if anonymous else "thread_message",
+                    ),
                 )
             )
 
@@ -546,15 +580,19 @@ class Thread:
             )
 
         if not self.ready:
-            await self.wait_until_ready()
+            with span("thread.wait_until_ready"):
+                await self.wait_until_ready()
 
         if not from_mod and not note:
-            self.bot.loop.create_task(self.bot.api.append_log(message, self.channel.id))
+            self.bot.loop.create_task(
+                traced("append_log", self.bot.api.append_log(message, self.channel.id))
+            )
 
         destination = destination or self.channel
 
         author = message.author
 
+        build_embed = span("build_embed")
         embed = discord.Embed(description=message.content, timestamp=message.created_at)
 
         system_avatar_url = (
@@ -667,18 +705,23 @@ class Thread:
             # noinspection PyUnresolvedReferences,PyDunderSlots
             embed.color = self.bot.recipient_color  # pylint: disable=E0237
 
-        await destination.trigger_typing()
+        build_embed.finish()
+
+        with span("trigger_typing"):
+            await destination.trigger_typing()
 
         if not from_mod and not note:
             mentions = self.get_notifications()
         else:
             mentions = None
 
-        _msg = await destination.send(mentions, embed=embed)
+        with span("destination.send"):
+            _msg = await destination.send(mentions, embed=embed)
 
         if additional_images:
             self.ready = False
-            await asyncio.gather(*additional_images)
+            with span("additional_images"):
+                await asyncio.gather(*additional_images)
             self.ready = True
 
         if delete_message:
@@ -717,6 +760,24 @@ class ThreadManager:
                 continue
             await self.find(channel=channel)
 
+    def resync(self) -> None:
+        """
+        Points the cached threads to the channels of the current gateway
+        session, threads whose channel was deleted are closed.
+        """
+        for thread in list(self.cache.values()):
+            if thread.channel is None:
+                # Still being set up
+                continue
+            channel = self.bot.get_channel(thread.channel.id)
+            if channel is None:
+                self.bot.loop.create_task(
+                    thread.close(closer=self.bot.user, silent=True, delete_channel=False)
+                )
+                continue
+            thread._channel = channel
+            thread._recipient = self.bot.get_user(thread.id) or thread._recipient
+
     def __len__(self):
         return len(self.cache)
 
@@ -816,7 +877,9 @@ class ThreadManager:
         self.cache[recipient.id] = thread
 
         # Schedule thread setup for later
-        self.bot.loop.create_task(thread.setup(creator=creator, category=category))
+        self.bot.loop.create_task(
+            traced("thread.setup", thread.setup(creator=creator, category=category))
+        )
         return thread
 
     async def find_or_create(self, recipient) -> Thread:
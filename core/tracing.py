@@ -0,0 +1,231 @@
+"""
+End-to-end tracing of relayed messages.
+
+A `Trace` follows one message from its receipt to its post in the thread
+channel (``to_thread``) or in the recipient's DMs (``to_user``). Each
+stage on the way is a `Span`::
+
+    with span("threads.find"):
+        thread = await self.threads.find(recipient=message.author)
+
+The current trace is held in a context variable: it follows the message
+through awaits and into the tasks started while handling it (thread
+setup, log append), and code running outside of a trace records nothing.
+
+Every relay is traced, it only costs a few clock reads per stage. When a
+trace ends it is kept in a ring buffer if it was sampled, or if it was
+slower than `slow_threshold`, so the slow relays are never missed.
+"""
+import contextvars
+import random
+import time
+import typing
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+_depth = contextvars.ContextVar("trace_depth", default=0)
+
+
+class Span:
+    """
+    A stage of a trace, also a context manager timing the wrapped block.
+
+    Attributes
+    ----------
+    name : str
+        The stage.
+    depth : int
+        The nesting level of the span.
+    start : float
+        The `time.perf_counter` value when the span started.
+    end : float, optional
+        The `time.perf_counter` value when the span ended.
+    """
+
+    __slots__ = ("trace", "name", "depth", "start", "end", "_token")
+
+    def __init__(self, trace: "Trace", name: str):
+        self.trace = trace
+        self.name = name
+        self.depth = _depth.get()
+        self.start = time.perf_counter()
+        self.end = None
+        self._token = None
+
+    def __enter__(self) -> "Span":
+        self._token = _depth.set(self.depth + 1)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.finish()
+        _depth.reset(self._token)
+
+    def finish(self) -> None:
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def to_dict(self) -> dict:
+        started = self.trace.started
+        return {
+            "name": self.name,
+            "depth": self.depth,
+            "start": (self.start - started) * 1000,
+            "duration": (self.end - self.start) * 1000 if self.end is not None else None,
+            # Started by the relay but still running when it ended
+            "background": self.trace.ended is not None
+            and (self.end is None or self.end > self.trace.ended),
+        }
+
+
+class _NoSpan:
+    """Stands for a span outside of a trace."""
+
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """
+    The stages of one relayed message.
+
+    Attributes
+    ----------
+    kind : str
+        ``to_thread`` or ``to_user``.
+    attributes : Dict[str, Any]
+        The message and user IDs, and how long after its creation the
+        message was received (``received_after``, in seconds).
+    status : str
+        ``ok``, or what stopped the relay.
+    spans : List[Span]
+        The stages, in start order.
+    """
+
+    __slots__ = ("kind", "attributes", "timestamp", "started", "ended", "status", "spans")
+
+    def __init__(self, kind: str, attributes: dict):
+        self.kind = kind
+        self.attributes = attributes
+        self.timestamp = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.ended = None
+        self.status = "ok"
+        self.spans = []
+
+    @property
+    def duration(self) -> float:
+        """The duration of the relay in seconds, up to now if it is running."""
+        return (self.ended or time.perf_counter()) - self.started
+
+    def span(self, name: str) -> Span:
+        child = Span(self, name)
+        self.spans.append(child)
+        return child
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "timestamp": self.timestamp.isoformat(),
+            "duration": self.duration * 1000,
+            "status": self.status,
+            **self.attributes,
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+
+def span(name: str) -> typing.Union[Span, _NoSpan]:
+    """Starts a span in the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is None:
+        return NO_SPAN
+    return trace.span(name)
+
+
+def set_status(status: str) -> None:
+    """Sets the status of the current trace, if there is one."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.status = status
+
+
+async def traced(name: str, coro: typing.Awaitable) -> typing.Any:
+    """Awaits `coro` in a span, for coroutines started as tasks."""
+    with span(name):
+        return await coro
+
+
+class Tracer:
+    """
+    Traces the relayed messages and keeps a sample of them.
+
+    Parameters
+    ----------
+    sample_rate : float
+        The proportion of the traces kept, between 0 and 1.
+    slow_threshold : float
+        The relays slower than this, in seconds, are always kept.
+    size : int
+        The number of sampled traces, and of slow traces, kept.
+
+    Attributes
+    ----------
+    count : int
+        The number of traced relays.
+    """
+
+    def __init__(self, sample_rate: float = 0.1, slow_threshold: float = 5, size: int = 200):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.sampled = deque(maxlen=size)
+        self.slow = deque(maxlen=size)
+        self.count = 0
+
+    @contextmanager
+    def trace(self, kind: str, **attributes):
+        """Traces the wrapped block as a relay, the trace is the current one inside."""
+        trace = Trace(kind, attributes)
+        token = current_trace.set(trace)
+        try:
+            yield trace
+        except BaseException as exc:
+            trace.status = type(exc).__name__
+            raise
+        finally:
+            current_trace.reset(token)
+            self.finish(trace)
+
+    def finish(self, trace: Trace) -> None:
+        trace.ended = time.perf_counter()
+        self.count += 1
+        if trace.ended - trace.started >= self.slow_threshold:
+            self.slow.append(trace)
+        elif random.random() < self.sample_rate:
+            self.sampled.append(trace)
+
+    def traces(self) -> typing.List[Trace]:
+        """Returns the kept traces, most recent first."""
+        return sorted({*self.sampled, *self.slow}, key=lambda trace: trace.started, reverse=True)
+
+    def slowest(self, count: int = 10) -> typing.List[Trace]:
+        return sorted(self.traces(), key=lambda trace: trace.duration, reverse=True)[:count]
+
+    def to_dict(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_threshold": self.slow_threshold,
+            "count": self.count,
+            "traces": [trace.to_dict() for trace in self.traces()],
+        }
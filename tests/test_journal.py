@@ -0,0 +1,185 @@
+"""
+The write journal must not lose, reorder or resurrect writes: records are
+replayed in order, survive restarts and torn writes, and a record or batch
+whose append failed is never replayed.
+"""
+import asyncio
+import os
+import sqlite3
+
+import pytest
+
+from core import journal as journal_module
+from core.journal import CHECKPOINT, SEGMENT_PREFIX, WriteJournal
+from core.storage import SQLiteBackend
+
+
+class UnavailableDatabase:
+    """A database whose every operation fails like an unreachable one."""
+
+    def __getitem__(self, name):
+        return self
+
+    def __getattr__(self, name):
+        async def operation(*args, **kwargs):
+            raise sqlite3.OperationalError("database is locked")
+
+        return operation
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # Let the cancelled replayers finish
+    loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "modmail.db"))
+    yield backend
+    backend.close()
+
+
+def open_journal(loop, path, db, **kwargs) -> WriteJournal:
+    journal = WriteJournal(str(path), db, **kwargs)
+    journal.start(loop)
+    return journal
+
+
+def segments(path) -> list:
+    return sorted(name for name in os.listdir(path) if name.startswith(SEGMENT_PREFIX))
+
+
+def test_replay_order(loop, backend, tmp_path):
+    journal = open_journal(loop, tmp_path / "journal", backend.db)
+
+    async def test():
+        await asyncio.gather(
+            *(
+                journal.append(
+                    "logs", "update_one", {"_id": "a"}, {"$push": {"n": i}}, upsert=True
+                )
+                for i in range(250)
+            )
+        )
+        assert await journal.drain(timeout=10)
+        doc = await backend.db.logs.find_one({"_id": "a"})
+        assert doc["n"] == list(range(250))
+
+    loop.run_until_complete(test())
+    assert journal.applied == journal.appended == 250
+    journal.close()
+
+
+def test_recovery(loop, backend, tmp_path):
+    path = tmp_path / "journal"
+    journal = open_journal(loop, path, UnavailableDatabase())
+
+    async def append():
+        for i in range(3):
+            await journal.append("logs", "insert_one", {"_id": i})
+
+    loop.run_until_complete(append())
+    assert len(journal) == 3
+    journal.close()
+
+    journal = open_journal(loop, path, backend.db)
+    assert len(journal) == 3
+
+    async def test():
+        assert await journal.drain(timeout=10)
+        assert await backend.db.logs.count_documents({}) == 3
+
+    loop.run_until_complete(test())
+    journal.close()
+    with open(path / CHECKPOINT) as f:
+        assert f.read() == "3"
+
+    # Applied records are not replayed again
+    assert len(WriteJournal(str(path), backend.db)) == 0
+
+
+def test_torn_tail_truncated(loop, tmp_path):
+    path = tmp_path / "journal"
+    journal = open_journal(loop, path, UnavailableDatabase())
+    loop.run_until_complete(journal.append("logs", "insert_one", {"_id": 1}))
+    journal.close()
+
+    segment = path / segments(path)[0]
+    size = os.path.getsize(segment)
+    with open(segment, "ab") as f:
+        f.write(b'1234abcd {"seq":2,"c":"lo')
+
+    journal = WriteJournal(str(path), UnavailableDatabase())
+    assert len(journal) == 1
+    assert os.path.getsize(segment) == size
+
+
+def test_checkpoint_compaction(loop, backend, tmp_path):
+    path = tmp_path / "journal"
+    journal = open_journal(loop, path, backend.db, segment_size=256)
+
+    async def test():
+        for i in range(50):
+            await journal.append("logs", "insert_one", {"_id": i, "key": str(i)})
+        assert await journal.drain(timeout=10)
+
+    loop.run_until_complete(test())
+    journal.close()
+    # Every segment but the one being written to is applied and removed
+    assert len(segments(path)) == 1
+    with open(path / CHECKPOINT) as f:
+        assert f.read() == "50"
+
+
+def test_unserializable_record_rejected(loop, tmp_path):
+    path = tmp_path / "journal"
+    journal = open_journal(loop, path, UnavailableDatabase())
+
+    async def test():
+        results = await asyncio.gather(
+            journal.append("logs", "insert_one", {"_id": 1}),
+            journal.append("plugins.test", "insert_one", {"_id": object()}),
+            journal.append("logs", "insert_one", {"_id": 2}),
+            return_exceptions=True,
+        )
+        assert results[0] == 1
+        assert isinstance(results[1], TypeError)
+        assert results[2] == 2
+
+    loop.run_until_complete(test())
+    journal.close()
+
+    journal = WriteJournal(str(path), UnavailableDatabase())
+    assert [record["a"][0]["_id"] for record in journal._pending] == [1, 2]
+
+
+def test_failed_batch_rolled_back(loop, tmp_path, monkeypatch):
+    path = tmp_path / "journal"
+    journal = open_journal(loop, path, UnavailableDatabase(), segment_size=64)
+    loop.run_until_complete(journal.append("logs", "insert_one", {"_id": 1}))
+
+    def fsync(fd):
+        raise OSError("No space left on device")
+
+    async def test():
+        results = await asyncio.gather(
+            *(journal.append("logs", "insert_one", {"_id": i}) for i in range(2, 5)),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, OSError) for result in results)
+
+    monkeypatch.setattr(journal_module.os, "fsync", fsync)
+    loop.run_until_complete(test())
+    monkeypatch.undo()
+
+    loop.run_until_complete(journal.append("logs", "insert_one", {"_id": 5}))
+    journal.close()
+
+    journal = WriteJournal(str(path), UnavailableDatabase())
+    assert [record["a"][0]["_id"] for record in journal._pending] == [1, 5]
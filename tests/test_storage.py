@@ -0,0 +1,289 @@
+"""
+The storage backends must behave the same, the SQLite backend implements
+the subset of Motor's API the bot uses.
+
+The tests run against SQLite, and against MongoDB too when ``MONGO_URI`` is
+set (they use the ``modmail_bot.storage_tests`` collection).
+"""
+import asyncio
+import os
+
+import pytest
+
+from core.storage import BulkWriteError, DuplicateKeyError, MongoBackend, SQLiteBackend
+
+BACKENDS = ["sqlite"]
+if os.getenv("MONGO_URI"):
+    BACKENDS.append("mongodb")
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    """Runs a test coroutine with the collection of a backend."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def create():
+        if request.param == "mongodb":
+            return MongoBackend({"mongo_uri": os.environ["MONGO_URI"]})
+        return SQLiteBackend(str(tmp_path / "modmail.db"))
+
+    backend = loop.run_until_complete(create())
+    collection = backend.db["storage_tests"]
+    loop.run_until_complete(collection.delete_many({}))
+
+    def run_test(test):
+        return loop.run_until_complete(test(collection))
+
+    yield run_test
+
+    loop.run_until_complete(collection.delete_many({}))
+    backend.close()
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+LOGS = [
+    {"_id": "a", "key": "a", "n": 3, "open": True, "recipient": {"id": "1", "name": "x"}},
+    {"_id": "b", "key": "b", "n": 1, "open": False, "recipient": {"id": "1", "name": "y"}},
+    {"_id": "c", "key": "c", "n": 2, "open": False, "recipient": {"id": "2", "name": "z"}},
+    {"_id": "d", "key": "d", "n": 5, "open": False, "recipient": {"id": "1", "name": "w"}},
+]
+
+
+async def insert_logs(collection):
+    await collection.insert_many([dict(log) for log in LOGS])
+
+
+def test_find_projection(run):
+    async def test(collection):
+        await insert_logs(collection)
+        assert await collection.find_one({"key": "a"}, {"key": 1}) == {"_id": "a", "key": "a"}
+        assert await collection.find_one({"key": "a"}, {"recipient.id": 1, "_id": 0}) == {
+            "recipient": {"id": "1"}
+        }
+        doc = await collection.find_one({"key": "a"}, {"recipient": 0, "open": 0})
+        assert doc == {"_id": "a", "key": "a", "n": 3}
+        assert await collection.find_one({"key": "missing"}) is None
+
+    run(test)
+
+
+def test_find_projection_array_fields(run):
+    async def test(collection):
+        messages = [
+            {"content": "a", "author": {"id": "1", "name": "x"}, "type": "thread_message"},
+            {"content": "b", "author": {"id": "2", "name": "y"}, "type": "note"},
+        ]
+        await collection.insert_one(
+            {"_id": "a", "meta": {"x": 1, "y": 2, "z": 3}, "messages": messages}
+        )
+        doc = await collection.find_one(
+            {"_id": "a"},
+            {"messages.content": 1, "messages.author.name": 1, "meta.x": 1, "meta.y": 1},
+        )
+        assert doc == {
+            "_id": "a",
+            "meta": {"x": 1, "y": 2},
+            "messages": [
+                {"content": "a", "author": {"name": "x"}},
+                {"content": "b", "author": {"name": "y"}},
+            ],
+        }
+
+    run(test)
+
+
+def test_find_sort_skip_limit(run):
+    async def test(collection):
+        await insert_logs(collection)
+        cursor = collection.find({"recipient.id": "1"}, {"key": 1, "_id": 0})
+        assert await cursor.sort("n", -1).to_list(None) == [
+            {"key": "d"},
+            {"key": "a"},
+            {"key": "b"},
+        ]
+
+        cursor = collection.find({}, {"key": 1}).sort("n", 1).skip(1).limit(2)
+        assert [doc["key"] for doc in await cursor.to_list(None)] == ["c", "a"]
+
+        cursor = collection.find({"open": False}).sort([("recipient.id", 1), ("n", -1)])
+        assert [doc["key"] for doc in await cursor.to_list(None)] == ["d", "b", "c"]
+
+        keys = [doc["key"] async for doc in collection.find({"n": {"$gte": 2}}).sort("key")]
+        assert keys == ["a", "c", "d"]
+
+    run(test)
+
+
+def test_find_large_skip(run):
+    async def test(collection):
+        await collection.insert_many([{"_id": i, "n": i % 7} for i in range(3000)])
+        cursor = collection.find({}).skip(2500)
+        assert [doc["_id"] async for doc in cursor] == list(range(2500, 3000))
+
+        # Sorted documents are read in batches too
+        cursor = collection.find({"n": 0}, {"_id": 1}).sort("_id", -1).skip(400).limit(10)
+        expected = list(range(2996, -1, -7))[400:410]
+        assert [doc["_id"] for doc in await cursor.to_list(None)] == expected
+
+    run(test)
+
+
+def test_slice_projection(run):
+    async def test(collection):
+        messages = [{"message_id": str(i)} for i in range(5)]
+        await collection.insert_one({"_id": "a", "messages": messages})
+        doc = await collection.find_one({"_id": "a"}, {"messages": {"$slice": 2}})
+        assert doc["messages"] == messages[:2]
+        doc = await collection.find_one({"_id": "a"}, {"messages": {"$slice": -1}})
+        assert doc["messages"] == messages[-1:]
+
+    run(test)
+
+
+def test_count_documents(run):
+    async def test(collection):
+        await insert_logs(collection)
+        assert await collection.count_documents({}) == 4
+        assert await collection.count_documents({"open": False}) == 3
+        assert await collection.count_documents({"key": {"$in": ["a", "c", "x"]}}) == 2
+        assert await collection.count_documents({"recipient.id": "1", "n": {"$lt": 3}}) == 1
+
+    run(test)
+
+
+def test_update_operators(run):
+    async def test(collection):
+        await collection.insert_one(
+            {"_id": "a", "n": 1, "tags": ["x"], "meta": {"a": 1, "b": 2}, "messages": []}
+        )
+        result = await collection.update_one(
+            {"_id": "a"},
+            {
+                "$set": {"meta.c": 3, "open": False},
+                "$unset": {"meta.a": 1},
+                "$inc": {"n": 2},
+                "$push": {"tags": "y"},
+            },
+        )
+        assert result.matched_count == 1
+        await collection.update_one(
+            {"_id": "a"}, {"$push": {"messages": {"$each": [{"id": "1"}, {"id": "2"}]}}}
+        )
+        await collection.update_one({"_id": "a"}, {"$pull": {"tags": "x"}})
+        await collection.update_one({"_id": "a"}, {"$pull": {"messages": {"id": "1"}}})
+        await collection.update_one({"_id": "a"}, {"$addToSet": {"tags": "y"}})
+
+        assert await collection.find_one({"_id": "a"}) == {
+            "_id": "a",
+            "n": 3,
+            "open": False,
+            "tags": ["y"],
+            "meta": {"b": 2, "c": 3},
+            "messages": [{"id": "2"}],
+        }
+
+    run(test)
+
+
+def test_update_positional(run):
+    async def test(collection):
+        messages = [{"message_id": "1", "content": "a"}, {"message_id": "2", "content": "b"}]
+        await collection.insert_one({"_id": "a", "messages": messages})
+        await collection.update_one(
+            {"messages.message_id": "2"},
+            {"$set": {"messages.$.content": "edited", "messages.$.edited": True}},
+        )
+        doc = await collection.find_one({"_id": "a"})
+        assert doc["messages"][0] == {"message_id": "1", "content": "a"}
+        assert doc["messages"][1] == {"message_id": "2", "content": "edited", "edited": True}
+
+    run(test)
+
+
+def test_update_many_and_upsert(run):
+    async def test(collection):
+        await insert_logs(collection)
+        result = await collection.update_many({"recipient.id": "1"}, {"$set": {"flag": True}})
+        assert result.matched_count == 3
+        assert await collection.count_documents({"flag": True}) == 3
+
+        result = await collection.update_one({"key": "missing"}, {"$set": {"flag": False}})
+        assert result.matched_count == 0 and result.upserted_id is None
+
+        result = await collection.update_one(
+            {"key": "e"}, {"$set": {"n": 9}, "$setOnInsert": {"open": True}}, upsert=True
+        )
+        assert result.upserted_id is not None
+        doc = await collection.find_one({"key": "e"}, {"_id": 0})
+        assert doc == {"key": "e", "n": 9, "open": True}
+
+        await collection.update_one(
+            {"key": "e"}, {"$set": {"n": 10}, "$setOnInsert": {"open": False}}, upsert=True
+        )
+        assert await collection.find_one({"key": "e"}, {"_id": 0}) == {
+            "key": "e",
+            "n": 10,
+            "open": True,
+        }
+
+    run(test)
+
+
+def test_find_one_and_update(run):
+    async def test(collection):
+        await collection.insert_one({"_id": "a", "channel_id": "1", "messages": []})
+        for i in range(3):
+            doc = await collection.find_one_and_update(
+                {"channel_id": "1"}, {"$push": {"messages": {"id": i}}}, return_document=True
+            )
+            assert len(doc["messages"]) == i + 1
+
+        before = await collection.find_one_and_update(
+            {"channel_id": "1"}, {"$set": {"open": False}}, projection={"open": 1}
+        )
+        assert before == {"_id": "a"}
+        after = await collection.find_one_and_update(
+            {"channel_id": "1"},
+            {"$set": {"closed": True}},
+            projection={"open": 1, "closed": 1, "_id": 0},
+            return_document=True,
+        )
+        assert after == {"open": False, "closed": True}
+        assert (
+            await collection.find_one_and_update({"channel_id": "2"}, {"$set": {"x": 1}}) is None
+        )
+
+    run(test)
+
+
+def test_insert_duplicate_key(run):
+    async def test(collection):
+        await collection.insert_one({"_id": "a"})
+        with pytest.raises(DuplicateKeyError):
+            await collection.insert_one({"_id": "a"})
+
+        with pytest.raises(BulkWriteError) as exc:
+            await collection.insert_many([{"_id": "b"}, {"_id": "a"}, {"_id": "c"}])
+        details = exc.value.details
+        assert details["nInserted"] == 1
+        assert [(e["index"], e["code"]) for e in details["writeErrors"]] == [(1, 11000)]
+        assert await collection.count_documents({}) == 2
+
+        with pytest.raises(BulkWriteError) as exc:
+            await collection.insert_many([{"_id": "a"}, {"_id": "c"}, {"_id": "d"}], ordered=False)
+        assert exc.value.details["nInserted"] == 2
+        assert await collection.count_documents({}) == 4
+
+    run(test)
+
+
+def test_delete(run):
+    async def test(collection):
+        await insert_logs(collection)
+        assert (await collection.delete_one({"open": False})).deleted_count == 1
+        assert (await collection.delete_many({"recipient.id": "1"})).deleted_count == 2
+        assert [doc["key"] async for doc in collection.find({})] == ["c"]
+
+    run(test)